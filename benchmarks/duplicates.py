@@ -0,0 +1,74 @@
+"""Duration of the duplicate clustering for growing libraries.
+
+Compares the multi-index hashing of server.perceptual with the comparison
+of every pair of hashes. Each library has random hashes and 5% of near
+copies (up to 3 different bits):
+
+    python benchmarks/duplicates.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from environment import ROOT
+
+sys.path.insert(0, ROOT)
+
+from server.perceptual import distance, duplicate_clusters
+
+
+def make_hashes(count: int, rng: random.Random) -> dict:
+    hashes = {}
+    for i in range(count):
+        if i and rng.random() < 0.05:
+            value = hashes[rng.randrange(i)]
+            for _ in range(rng.randint(1, 3)):
+                value ^= 1 << rng.randrange(64)
+        else:
+            value = rng.getrandbits(64)
+        hashes[i] = value
+    return hashes
+
+
+def pairwise_clusters(hashes: dict, radius: int) -> int:
+    """Number of pairs within `radius` (the clusters are not built)"""
+    items = list(hashes.values())
+    pairs = 0
+    for i, value in enumerate(items):
+        for other in items[i + 1 :]:
+            if distance(value, other) <= radius:
+                pairs += 1
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--radius", type=int, default=6)
+    parser.add_argument(
+        "--pairwise-max", type=int, default=20000, help="larger sizes are skipped"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        hashes = make_hashes(size, random.Random(size))
+        start = time.perf_counter()
+        clusters = duplicate_clusters(hashes, args.radius)
+        result = {
+            "multi_index_s": time.perf_counter() - start,
+            "clusters": len(clusters),
+        }
+        if size <= args.pairwise_max:
+            start = time.perf_counter()
+            pairwise_clusters(hashes, args.radius)
+            result["pairwise_s"] = time.perf_counter() - start
+        results[size] = result
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Temporary server environment for the benchmarks.
+
+The accounts and tokens come from tests/server_env, the storage and the
+other files are created in a temporary folder.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(ROOT, "tests", "server_env")
+
+# Tokens of the accounts of tests/server_env
+TEST_TOKEN = "f4bcfedf-297b-4a3d-a858-31845bb86307"
+ADMIN_TOKEN = "577f00b0-c02c-45ce-b81b-acbdd7435f1b"
+
+
+def make_environment(path: str | None = None, **settings) -> str:
+    """Create the environment and its configuration file, return its folder.
+    `settings` are added to the configuration."""
+    if path is None:
+        path = tempfile.mkdtemp(prefix="photosync_bench_")
+    for folder in ("storage", "thumbnails", "temp", "trash", "web"):
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+    shutil.copy(os.path.join(TEMPLATE, "accounts.json"), path)
+    shutil.copy(os.path.join(TEMPLATE, "auth.json"), path)
+
+    config = {
+        "storage": os.path.join(path, "storage"),
+        "thumbnails_folder": os.path.join(path, "thumbnails"),
+        "temp_folder": os.path.join(path, "temp"),
+        "trash_folder": os.path.join(path, "trash"),
+        "web_folder": os.path.join(path, "web"),
+        "index": os.path.join(path, "index.json"),
+        "accounts": os.path.join(path, "accounts.json"),
+        "authorization_file": os.path.join(path, "auth.json"),
+        "history_database": os.path.join(path, "changes.db"),
+        "job_folder": os.path.join(path, "jobs"),
+        "trash_database": os.path.join(path, "trash.db"),
+        "album_database": os.path.join(path, "albums.db"),
+    }
+    config.update(settings)
+    with open(os.path.join(path, "config.conf"), "w") as f:
+        f.write("\n".join(f"{k}={v}" for k, v in config.items()))
+    return path
+
+
+def load_app(path: str):
+    """Import the server with the configuration of the environment and
+    return the Flask application"""
+    os.environ["PHOTOSYNC_CONFIG"] = os.path.join(path, "config.conf")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import server.main
+
+    return server.main.app
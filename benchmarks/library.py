@@ -0,0 +1,121 @@
+"""Synthetic photo libraries for the benchmarks.
+
+The files are generated from a seed, so two libraries created with the same
+parameters are identical:
+
+    python benchmarks/library.py /tmp/library --images 1000 --videos 20
+
+Images are JPEG files with the EXIF dates (DateTime, DateTimeOriginal and
+DateTimeDigitized). Videos are short MP4 files written with OpenCV, which
+can't add a creation date, so their date is the one of the file.
+"""
+
+import argparse
+import datetime
+import os
+import random
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Dates of the files are spread over this period
+FIRST_DATE = datetime.datetime(2015, 1, 1)
+LAST_DATE = datetime.datetime(2023, 1, 1)
+
+EXIF_IFD = 0x8769
+DATE_TIME = 306
+DATE_TIME_ORIGINAL = 36867
+DATE_TIME_DIGITIZED = 36868
+
+
+def random_date(rng: random.Random) -> datetime.datetime:
+    span = (LAST_DATE - FIRST_DATE).total_seconds()
+    return FIRST_DATE + datetime.timedelta(seconds=int(rng.random() * span))
+
+
+def random_picture(rng: random.Random, width: int, height: int) -> np.ndarray:
+    """A gradient with some noise, so that the files compress like photos"""
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    color = np.array([rng.random() for _ in range(3)], dtype=np.float32) * 255
+    base = (x + y)[:, :, None] / 2 * color
+    noise = np.random.default_rng(rng.getrandbits(32)).normal(0, 12, (height, width, 3))
+    return np.clip(base + noise, 0, 255).astype(np.uint8)
+
+
+def make_image(path: str, rng: random.Random, width: int, height: int):
+    date = random_date(rng).strftime("%Y:%m:%d %H:%M:%S")
+    exif = Image.Exif()
+    exif[DATE_TIME] = date
+    exif.get_ifd(EXIF_IFD).update({DATE_TIME_ORIGINAL: date, DATE_TIME_DIGITIZED: date})
+    image = Image.fromarray(random_picture(rng, width, height))
+    image.save(path, "JPEG", quality=90, exif=exif)
+
+
+def make_video(path: str, rng: random.Random, width: int, height: int, frames: int):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 25, (width, height))
+    picture = random_picture(rng, width, height)
+    for i in range(frames):
+        writer.write(np.roll(picture, i * 4, axis=1))
+    writer.release()
+
+
+def make_library(
+    folder: str,
+    images: int = 500,
+    videos: int = 10,
+    width: int = 1600,
+    height: int = 1200,
+    video_width: int = 640,
+    video_height: int = 360,
+    video_frames: int = 50,
+    per_folder: int = 200,
+    seed: int = 0,
+) -> list:
+    """Create the files in `folder`, return their paths relative to it.
+    The files are split into sub folders of `per_folder` files."""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(images + videos):
+        sub_folder = f"{i // per_folder:04d}"
+        os.makedirs(os.path.join(folder, sub_folder), exist_ok=True)
+        if i < images:
+            path = os.path.join(sub_folder, f"IMG_{i:06d}.jpg")
+            make_image(os.path.join(folder, path), rng, width, height)
+        else:
+            path = os.path.join(sub_folder, f"VID_{i:06d}.mp4")
+            make_video(
+                os.path.join(folder, path),
+                rng,
+                video_width,
+                video_height,
+                video_frames,
+            )
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("folder")
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--videos", type=int, default=10)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = make_library(
+        args.folder,
+        images=args.images,
+        videos=args.videos,
+        width=args.width,
+        height=args.height,
+        seed=args.seed,
+    )
+    print(f"Created {len(paths)} files in {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Load test of a running PhotoSync server.
+
+Measures the requests per second and the latency percentiles of some routes,
+optionally starting the server once for each serving mode:
+
+    python benchmarks/load_test.py --config config.conf --modes development,waitress \\
+        --token <token> --path /api/files/file-list --path /api/fileio/download/<id>
+
+The results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def wait_for_port(host: str, port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"The server did not start on {host}:{port}")
+
+
+def run_load(url: str, token: str, concurrency: int, duration: float) -> dict:
+    """Send requests to url from `concurrency` threads for `duration` seconds"""
+    deadline = time.time() + duration
+
+    def worker():
+        latencies = []
+        errors = 0
+        size = 0
+        with requests.Session() as session:
+            while time.time() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = session.get(url, headers={"Token": token})
+                    size += len(response.content)
+                    if response.status_code >= 400:
+                        errors += 1
+                except requests.RequestException:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+        return latencies, errors, size
+
+    begin = time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: worker(), range(concurrency)))
+    elapsed = time.time() - begin
+
+    latencies = [l for r in results for l in r[0]]
+    return {
+        "requests": len(latencies),
+        "errors": sum(r[1] for r in results),
+        "bytes": sum(r[2] for r in results),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+    }
+
+
+def start_server(config: str, mode: str) -> subprocess.Popen:
+    """Start the server with a copy of the configuration using the given mode"""
+    with open(config, "r") as f:
+        content = f.read()
+    fd, path = tempfile.mkstemp(suffix=".conf")
+    with os.fdopen(fd, "w") as f:
+        f.write(content + f"\nserver_mode={mode}\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(
+        [sys.executable, "-m", "server.main", "--config", path],
+        cwd=root,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="http://localhost:8080")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--path", action="append", required=True)
+    parser.add_argument("--concurrency", "-n", type=int, default=32)
+    parser.add_argument("--duration", "-d", type=float, default=10)
+    parser.add_argument(
+        "--config", help="Start the server with this configuration for each mode"
+    )
+    parser.add_argument("--modes", default="development,waitress")
+    args = parser.parse_args()
+
+    host = args.host.split("://")[-1].split(":")[0]
+    port = int(args.host.rsplit(":", 1)[-1]) if args.host.count(":") > 1 else 80
+
+    results = {}
+    for mode in args.modes.split(",") if args.config else ["running"]:
+        server = start_server(args.config, mode) if args.config else None
+        try:
+            wait_for_port(host, port)
+            results[mode] = {
+                path: run_load(
+                    args.host + path, args.token, args.concurrency, args.duration
+                )
+                for path in args.path
+            }
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
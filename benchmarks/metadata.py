@@ -0,0 +1,85 @@
+"""Speed of the metadata extraction compared to PIL and mutagen.
+
+Reads the metadata of every file of a synthetic library with
+server.metadata.read_metadata, then with the previous method (PIL's
+_getexif for the images, mutagen for the videos if it is installed):
+
+    python benchmarks/metadata.py --images 500 --videos 20
+
+The files are read from the page cache, the first pass is not timed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from environment import ROOT
+from library import make_library
+
+sys.path.insert(0, ROOT)
+
+from server.metadata import read_metadata  # noqa: E402
+
+
+def pil_metadata(path: str):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return image._getexif(), image.size
+
+
+def mutagen_metadata(path: str):
+    import mutagen
+
+    return mutagen.File(path)
+
+
+def timed(func, paths: list, repeat: int) -> float:
+    """Best time per file (µs) of `repeat` passes"""
+    for path in paths:
+        func(path)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / max(len(paths), 1) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--videos", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        files = make_library(folder, images=args.images, videos=args.videos)
+        paths = [os.path.join(folder, f) for f in files]
+        results = {}
+        for kind, extension, previous in (
+            ("image", ".jpg", pil_metadata),
+            ("video", ".mp4", mutagen_metadata),
+        ):
+            selected = [p for p in paths if p.endswith(extension)]
+            if not selected:
+                continue
+            results[kind] = {
+                "files": len(selected),
+                "read_metadata_us": timed(read_metadata, selected, args.repeat),
+            }
+            try:
+                results[kind]["previous_us"] = timed(previous, selected, args.repeat)
+            except ImportError as e:
+                results[kind]["previous_us"] = None
+                print(f"Previous method not available for {kind}s : {e}")
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Duration of the storage scan of a reload on a large tree.
+
+Compares server.scanner (os.scandir, folders listed in parallel, one diff
+with the index) with the previous method (os.walk, then os.path.exists for
+each entry of the index):
+
+    python benchmarks/scan.py --files 1000000 --workers 1 4 8
+
+The files are empty, the tree is created once in --path and reused. With
+--cold the page cache is dropped before each run (root only), as after a
+restart of the server: the parallel scan only helps when the metadata is
+read from the disk.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from environment import ROOT
+
+sys.path.insert(0, ROOT)
+
+from server.scanner import diff_index, scan_tree
+
+
+def make_tree(path: str, count: int, per_folder: int) -> list:
+    """Create `count` empty files, `per_folder` files in each folder (100
+    folders per parent), return their relative paths"""
+    paths = []
+    for i in range(count):
+        folder = i // per_folder
+        rel = os.path.join(f"{folder // 100:04}", f"{folder % 100:02}", f"{i}.jpg")
+        paths.append(rel)
+    marker = os.path.join(path, f".{count}-{per_folder}")
+    if os.path.exists(marker):
+        return paths
+    for rel in paths:
+        full = os.path.join(path, rel)
+        try:
+            open(full, "wb").close()
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(full))
+            open(full, "wb").close()
+    open(marker, "wb").close()
+    return paths
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+
+def previous_method(path: str, index: dict, known_files: set) -> tuple:
+    added = []
+    for root, dirs, files in os.walk(path):
+        root = root.replace(path, "", 1)
+        if root.startswith(os.sep):
+            root = root[1:]
+        for file in files:
+            rel = os.path.join(root, file)
+            if rel not in known_files:
+                added.append(rel)
+    removed = [
+        f_id
+        for f_id, info in index.items()
+        if not os.path.exists(os.path.join(path, info["path"]))
+    ]
+    return added, removed
+
+
+def current_method(path: str, index: dict, workers: int) -> tuple:
+    return diff_index(index, scan_tree(path, workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", default="/tmp/photosync_bench_scan")
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--per-folder", type=int, default=500)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cold", action="store_true", help="drop the page cache")
+    args = parser.parse_args()
+
+    os.makedirs(args.path, exist_ok=True)
+    start = time.perf_counter()
+    paths = make_tree(args.path, args.files, args.per_folder)
+    print(f"Tree ready in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    # Every file is indexed but the last 1%, and 1% of the entries are gone
+    files = scan_tree(args.path, max(args.workers))
+    index = {}
+    for i, rel in enumerate(paths[: len(paths) * 99 // 100]):
+        size, mtime = files[rel]
+        index[str(i)] = {"path": rel, "size": size, "mtime": mtime}
+    for i in range(len(paths) // 100):
+        index[f"gone{i}"] = {"path": f"gone/{i}.jpg", "size": 0, "mtime": 0}
+    known_files = {info["path"] for info in index.values()}
+
+    methods = {"previous": lambda: previous_method(args.path, index, known_files)}
+    for workers in args.workers:
+        methods[f"scandir.{workers}"] = lambda workers=workers: current_method(
+            args.path, index, workers
+        )
+
+    results = {}
+    for name, method in methods.items():
+        times = []
+        for _ in range(args.repeat):
+            if args.cold:
+                drop_caches()
+            start = time.perf_counter()
+            method()
+            times.append(time.perf_counter() - start)
+        results[name] = {"s": min(times)}
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
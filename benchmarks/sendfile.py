@@ -0,0 +1,66 @@
+"""CPU cost of the downloads for each sendfile_mode.
+
+Downloads a large file through the Flask test client and reports the CPU
+time used per GB served:
+
+    python benchmarks/sendfile.py --size 1024
+
+In the x-sendfile / x-accel-redirect modes the data is sent by the proxy,
+so the cost measured is only the one of building the response.
+"""
+
+import argparse
+import json
+import os
+import time
+
+from environment import TEST_TOKEN, load_app, make_environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=512, help="File size in MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    path = make_environment()
+    os.makedirs(os.path.join(path, "storage", "test"))
+    with open(os.path.join(path, "storage", "test", "large.bin"), "wb") as f:
+        for _ in range(args.size):
+            f.write(os.urandom(1024 * 1024))
+
+    app = load_app(path)
+    from server.configuration import ConfigFile
+    from server.file_manager import FileManager
+
+    fm = FileManager()
+    fm.populate_index()
+    f_id = next(iter(fm.index))
+    fm.index[f_id]["owner"] = "test"
+
+    client = app.test_client()
+    results = {}
+    for mode in ("python", "x-sendfile", "x-accel-redirect"):
+        ConfigFile().sendfile_mode = mode
+        cpu = 0
+        sent = 0
+        for _ in range(args.repeat):
+            start = time.process_time()
+            response = client.get(
+                f"/api/fileio/download/{f_id}", headers={"Token": TEST_TOKEN}
+            )
+            for chunk in response.response:
+                sent += len(chunk)
+            response.close()
+            cpu += time.process_time() - start
+        gigabytes = args.size * args.repeat / 1024
+        results[mode] = {
+            "cpu_s_per_gb": cpu / gigabytes,
+            "bytes_through_python": sent,
+        }
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
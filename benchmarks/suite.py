@@ -0,0 +1,519 @@
+"""Benchmark suite of the server.
+
+Generates a synthetic library (see library.py), then times the indexing, the
+index file, the listing routes (and the decoding of their formats by a
+client), the thumbnails and the authentication with the Flask test client:
+
+    python benchmarks/suite.py --images 2000 --videos 20 --output results.json
+    python benchmarks/suite.py --images 2000 --videos 20 --save-baseline
+    python benchmarks/suite.py --images 2000 --videos 20 --baseline baseline.json
+    python benchmarks/suite.py --images 200 --history-rows 1000000
+
+--history-rows fills the history of the changes with that many rows after
+the other cases, then times the paging of the changes of a user and the
+compaction of half of the history.
+
+The results are written as JSON. When a baseline is given, the median time of
+each case is compared to it and the exit code is 1 if a case is slower than
+the tolerance allows. The server runs in the process of the suite, the peak
+RSS of the process after each case is compared the same way (with
+--memory-tolerance). Baselines are only meaningful on the same machine with
+the same parameters.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import time
+
+from environment import ADMIN_TOKEN, TEST_TOKEN, load_app, make_environment
+from library import make_library
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+
+def peak_rss_kb() -> int:
+    """Peak resident memory of the process (the server runs in it), in kB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # Bytes on macOS
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """Run func `repeat` times, `setup` is run before each run and not timed.
+    func can return a dict of values added to the result (of the last run)."""
+    times = []
+    extra = {}
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        extra = func() or {}
+        times.append(time.perf_counter() - start)
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "max_ms": max(times) * 1000,
+        "runs": repeat,
+        **extra,
+    }
+
+
+class Suite:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def run(self, name: str, func, repeat: int | None = None, setup=None):
+        before = peak_rss_kb()
+        result = measure(func, repeat or self.args.repeat, setup)
+        # The peak only grows: the growth is the memory needed by this case
+        # above everything that ran before
+        result["peak_rss_kb"] = peak_rss_kb()
+        result["rss_growth_kb"] = result["peak_rss_kb"] - before
+        self.results[name] = result
+        print(
+            f"{name:<40} {result['median_ms']:>10.2f} ms"
+            f" {result['peak_rss_kb'] / 1024:>8.1f} MB peak",
+            file=sys.stderr,
+        )
+
+    def get(self, url: str, token: str = TEST_TOKEN, headers: dict | None = None):
+        """Request url and read the whole body, return the size and the time
+        to the first chunk"""
+        headers = {"Token": token, **(headers or {})}
+
+        def request():
+            start = time.perf_counter()
+            response = self.client.get(url, headers=headers)
+            size = 0
+            first_chunk = None
+            for chunk in response.response:
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - start
+                size += len(chunk)
+            response.close()
+            assert response.status_code == 200, (url, response.status_code)
+            return {"bytes": size, "ttfb_ms": (first_chunk or 0) * 1000}
+
+        return request
+
+    def body(self, url: str, headers: dict | None = None) -> bytes:
+        response = self.client.get(
+            url, headers={"Token": TEST_TOKEN, **(headers or {})}
+        )
+        assert response.status_code == 200, (url, response.status_code)
+        return response.get_data()
+
+    def prepare(self):
+        args = self.args
+        self.path = make_environment(args.environment)
+        self.storage = os.path.join(self.path, "storage")
+        print("Generating the library ...", file=sys.stderr)
+        self.files = make_library(
+            self.storage,
+            images=args.images,
+            videos=args.videos,
+            width=args.width,
+            height=args.height,
+            seed=args.seed,
+        )
+        self.app = load_app(self.path)
+        self.client = self.app.test_client()
+
+    def populate(self):
+        from server.file_manager import FileManager
+
+        fm = FileManager()
+
+        def reset():
+            fm.index = {}
+            fm.known_files = set()
+            fm.ordered_files = []
+
+        self.run("index.populate", fm.populate_index, repeat=1, setup=reset)
+        for info in fm.index.values():
+            info["owner"] = "test"
+        fm.update_order()
+
+        size = lambda: {"bytes": os.path.getsize(fm.store.path)}
+        self.run("index.save", lambda: fm.save_index() or size())
+        self.run("index.load", fm.load_index)
+
+    def listings(self):
+        from server.file_manager import COLUMNAR_MIMETYPE, FileManager
+
+        fm = FileManager()
+        first = fm.ordered_files[0]
+        middle = fm.metadata(fm.ordered_files[len(fm.ordered_files) // 2])["date"]
+        count = self.args.count
+
+        self.run("list.file_list", self.get("/api/files/file-list"))
+        self.run(
+            "list.file_list.ndjson",
+            self.get(
+                "/api/files/file-list", headers={"Accept": "application/x-ndjson"}
+            ),
+        )
+        self.run(
+            "list.file_list.columnar",
+            self.get("/api/files/file-list", headers={"Accept": COLUMNAR_MIMETYPE}),
+        )
+
+        # Client side: from the body to a list of {key: value} per file
+        def decode_json(body: bytes) -> list:
+            return json.loads(body)["files"]
+
+        def decode_ndjson(body: bytes) -> list:
+            lines = body.splitlines()
+            return [json.loads(line) for line in lines[1:] if line]
+
+        def decode_columnar(body: bytes) -> list:
+            data = json.loads(body)
+            keys = data["keys"]
+            tables = [data["tables"].get(k) for k in keys]
+            return [
+                {k: t[v] if t is not None else v for k, t, v in zip(keys, tables, row)}
+                for row in data["files"]
+            ]
+
+        for name, accept, decode in (
+            ("json", "application/json", decode_json),
+            ("ndjson", "application/x-ndjson", decode_ndjson),
+            ("columnar", COLUMNAR_MIMETYPE, decode_columnar),
+        ):
+            body = self.body("/api/files/file-list", {"Accept": accept})
+            assert len(decode(body)) == len(fm.get_shared_files("test")), name
+            self.run(
+                f"list.file_list.{name}.decode",
+                lambda: {"files": len(decode(body)), "bytes": len(body)},
+            )
+
+        self.run("list.get_all", self.get("/api/files/get-all", token=ADMIN_TOKEN))
+        self.run("list.get_by", self.get("/api/files/get-by/format/jpeg"))
+        self.run("list.from_id", self.get(f"/api/files/file-list/id/{first}/{count}"))
+        self.run(
+            "list.before", self.get(f"/api/files/file-list/before/{middle}/{count}")
+        )
+        self.run(
+            "list.between",
+            self.get(f"/api/files/file-list/between/0/{middle}/{count}"),
+        )
+
+        def page():
+            response = self.client.post(
+                "/api/files/page",
+                headers={"Token": TEST_TOKEN},
+                json={"page": 1, "page_size": count},
+            )
+            assert response.status_code == 200
+            return {"bytes": len(response.data)}
+
+        self.run("list.page", page)
+
+    def changes(self):
+        from server.file_manager import FileManager
+        from server.index_changes import ChangeDB
+
+        fm = FileManager()
+        db = ChangeDB()
+        infos = list(fm.index.values())
+
+        def add():
+            with db.batch():
+                for info in infos:
+                    db.add_change(info, "test")
+
+        self.run("changes.add", add, repeat=1)
+
+        def query():
+            changes = db.get_user_changes("test", 0, self.args.count)
+            return {"changes": len(changes)}
+
+        self.run("changes.query", query)
+        self.run("changes.route", self.get(f"/api/files/changes/0/{self.args.count}"))
+
+    def history(self):
+        from server.configuration import ConfigFile
+        from server.index_changes import ChangeDB
+
+        rows = self.args.history_rows
+        count = self.args.count
+        db = ChangeDB()
+        config = ConfigFile()
+        first = db.get_cursor()
+        users = ["test", "adminact", "user2", "user3"]
+        files = [str(10_000_000 + i) for i in range(max(len(self.files), 1000))]
+
+        def insert():
+            for start in range(0, rows, 10000):
+                with db.batch():
+                    for i in range(start, min(start + 10000, rows)):
+                        rights = ["public"] if i % 10 == 0 else [users[i % 3 + 1]]
+                        info = {
+                            "id": files[i % len(files)],
+                            "owner": users[i % 4],
+                            "rights": rights,
+                        }
+                        db.add_change(info)
+            return {"rows": rows}
+
+        self.run("history.insert", insert, repeat=1)
+        self.results["history.insert"]["rows_per_s"] = rows / max(
+            self.results["history.insert"]["median_ms"] / 1000, 1e-9
+        )
+        last = db.get_cursor()
+        middle = (first + last) // 2
+
+        def paging(cursor: int, pages: int):
+            def read():
+                position = cursor
+                read = 0
+                for _ in range(pages):
+                    changes = db.get_user_changes("test", position, count)
+                    if not changes:
+                        break
+                    position = changes[-1][0]
+                    read += len(changes)
+                return {"changes": read}
+
+            return read
+
+        self.run("history.query.first", paging(first, 1))
+        self.run("history.query.middle", paging(middle, 1))
+        self.run("history.query.last", paging(last - 10 * count, 1))
+        self.run("history.query.100_pages", paging(middle, 100))
+        self.run("history.route", self.get(f"/api/files/changes/{middle}/{count}"))
+
+        # Half of the history is removed
+        config.config["history_max_changes"] = (last - first) // 2
+        try:
+            self.run(
+                "history.compact",
+                lambda: {"compacted": db.compact() - first},
+                repeat=1,
+            )
+        finally:
+            del config.config["history_max_changes"]
+        self.run("history.query.after_compact", paging(last - 10 * count, 1))
+
+    def thumbnails(self):
+        from server.configuration import ConfigFile
+        from server.file_manager import FileManager
+
+        fm = FileManager()
+        folder = ConfigFile().thumbnails_folder
+        for kind in ("image", "video"):
+            ids = [f_id for f_id, info in fm.index.items() if info.get("type") == kind][
+                : self.args.thumbnails
+            ]
+            if not ids:
+                continue
+
+            def thumbnails():
+                for f_id in ids:
+                    self.get(f"/api/timg/get/{f_id}/0")()
+                return {"files": len(ids)}
+
+            def clear():
+                shutil.rmtree(folder, ignore_errors=True)
+                os.makedirs(folder)
+
+            self.run(f"thumbnails.{kind}.cold", thumbnails, setup=clear)
+            self.run(f"thumbnails.{kind}.warm", thumbnails)
+
+    def authentication(self):
+        from server.accounts import Accounts
+
+        accounts = Accounts()
+        calls = self.args.auth_calls
+
+        def check():
+            for _ in range(calls):
+                accounts._check_token(TEST_TOKEN)
+            return {"calls": calls}
+
+        self.run("auth.check_token", check)
+        self.run("auth.route", self.get("/api/accounts/test"))
+
+    def report(self) -> dict:
+        args = self.args
+        return {
+            "parameters": {
+                "images": args.images,
+                "videos": args.videos,
+                "width": args.width,
+                "height": args.height,
+                "seed": args.seed,
+                "count": args.count,
+                "thumbnails": args.thumbnails,
+                "auth_calls": args.auth_calls,
+                "history_rows": args.history_rows,
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+            },
+            "date": int(time.time()),
+            "peak_rss_kb": peak_rss_kb(),
+            "results": self.results,
+        }
+
+
+def compare(
+    report: dict,
+    baseline: dict,
+    tolerance: float,
+    noise: float,
+    memory_tolerance: float,
+    memory_noise: int,
+) -> list:
+    """Print the comparison, return the names of the cases slower by more than
+    `tolerance` (relative) and `noise` (milliseconds), or whose peak RSS is
+    higher by more than `memory_tolerance` (relative) and `memory_noise` (kB)"""
+    if baseline.get("parameters") != report["parameters"]:
+        print("WARNING: the baseline was made with other parameters", file=sys.stderr)
+
+    def more_memory(peak: int | None, reference: int | None) -> bool:
+        if peak is None or reference is None:
+            return False  # Baseline made before the memory was measured
+        return peak > reference * (1 + memory_tolerance) and (
+            peak - reference > memory_noise
+        )
+
+    regressions = []
+    for name, result in report["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            print(f"{name:<40} (new)", file=sys.stderr)
+            continue
+        ratio = result["median_ms"] / max(reference["median_ms"], 1e-6)
+        slower = (
+            ratio > 1 + tolerance
+            and result["median_ms"] - reference["median_ms"] > noise
+        )
+        bigger = more_memory(result.get("peak_rss_kb"), reference.get("peak_rss_kb"))
+        if slower or bigger:
+            regressions.append(name)
+        memory = ""
+        if "peak_rss_kb" in reference:
+            memory = (
+                f"  {reference['peak_rss_kb'] / 1024:.1f} -> "
+                f"{result['peak_rss_kb'] / 1024:.1f} MB"
+            )
+        print(
+            f"{name:<40} {reference['median_ms']:>10.2f} -> "
+            f"{result['median_ms']:>10.2f} ms  x{ratio:.2f}"
+            + memory
+            + ("  REGRESSION" if slower else "")
+            + ("  MEMORY REGRESSION" if bigger else ""),
+            file=sys.stderr,
+        )
+    if more_memory(report.get("peak_rss_kb"), baseline.get("peak_rss_kb")):
+        print(
+            f"Peak RSS {baseline['peak_rss_kb'] / 1024:.1f} -> "
+            f"{report['peak_rss_kb'] / 1024:.1f} MB  MEMORY REGRESSION",
+            file=sys.stderr,
+        )
+        regressions.append("peak_rss")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--videos", type=int, default=10)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--count", type=int, default=100, help="Files per page")
+    parser.add_argument(
+        "--thumbnails", type=int, default=20, help="Thumbnails of each type"
+    )
+    parser.add_argument("--auth-calls", type=int, default=10000)
+    parser.add_argument(
+        "--history-rows",
+        type=int,
+        default=0,
+        help="Changes added to the history to time it at scale (0: skipped)",
+    )
+    parser.add_argument(
+        "--environment", help="Folder of the environment (default: temporary)"
+    )
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare the results to this file")
+    parser.add_argument(
+        "--save-baseline",
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        help="Save the results as the baseline",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed slowdown (0.2 = 20%%)"
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=1,
+        help="Slowdowns under this duration (ms) are ignored",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed peak RSS increase (0.2 = 20%%)",
+    )
+    parser.add_argument(
+        "--memory-noise",
+        type=int,
+        default=4096,
+        help="Peak RSS increases under this size (kB) are ignored",
+    )
+    args = parser.parse_args()
+
+    suite = Suite(args)
+    suite.prepare()
+    suite.populate()
+    suite.listings()
+    suite.changes()
+    suite.thumbnails()
+    suite.authentication()
+    if args.history_rows:
+        suite.history()
+    report = suite.report()
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(
+            report,
+            baseline,
+            args.tolerance,
+            args.noise,
+            args.memory_tolerance,
+            args.memory_noise,
+        ):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
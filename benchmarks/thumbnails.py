@@ -0,0 +1,116 @@
+"""Latency and peak memory of the thumbnail generation.
+
+Compares server.thumbnails.create_thumbnail with the previous method (full
+decode, crop at full resolution, then Image.thumbnail) on large images:
+
+    python benchmarks/thumbnails.py --width 6000 --height 4000 --size 128
+
+Each measure runs in a new process, the peak RSS (VmHWM, Linux only) is
+compared to the memory used before the generation.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from environment import ROOT, make_environment
+
+sys.path.insert(0, ROOT)
+
+
+def previous_thumbnail(source: str, destination: str, size: int):
+    from PIL import Image
+
+    with Image.open(source) as im:
+        width, height = im.size
+        side = min(width, height)
+        left = (width - side) / 2
+        top = (height - side) / 2
+        im = im.crop((left, top, left + side, top + side))
+        im.thumbnail((size, size), Image.LANCZOS)
+        im.save(destination)
+
+
+def memory_kb(field: str) -> int:
+    """VmRSS (current) or VmHWM (peak) of the process"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def reset_peak_memory():
+    """Reset VmHWM, so that the peak of the imports is not counted"""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def measure(method: str, config: str, source: str, size: int, repeat: int, queue):
+    from server.configuration import ConfigFile
+    from server.thumbnails import create_thumbnail
+
+    ConfigFile(config)
+    func = create_thumbnail if method == "current" else previous_thumbnail
+    destination = source + f".{method}.png"
+
+    reset_peak_memory()
+    before = memory_kb("VmRSS")
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(source, destination, size)
+        times.append(time.perf_counter() - start)
+    peak = memory_kb("VmHWM")
+    queue.put({"ms": min(times) * 1000, "peak_memory_mb": (peak - before) / 1024})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    import numpy as np
+    from PIL import Image
+
+    path = make_environment()
+    config = os.path.join(path, "config.conf")
+    folder = tempfile.mkdtemp(dir=path)
+    noise = np.random.default_rng(0).integers(
+        0, 255, (args.height, args.width, 3), dtype=np.uint8
+    )
+    image = Image.fromarray(noise)
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    sources = {
+        "jpeg": os.path.join(folder, "large.jpg"),
+        "png": os.path.join(folder, "large.png"),
+    }
+    image.save(sources["jpeg"], quality=90, exif=exif)
+    image.save(sources["png"], compress_level=1)
+    del image, noise
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name, source in sources.items():
+        for method in ("previous", "current"):
+            queue = context.Queue()
+            process = context.Process(
+                target=measure,
+                args=(method, config, source, args.size, args.repeat, queue),
+            )
+            process.start()
+            results[f"{name}.{method}"] = queue.get()
+            process.join()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
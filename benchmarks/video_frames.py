@@ -0,0 +1,84 @@
+"""Cost of the video poster frames: color while indexing, then thumbnail.
+
+Compares the VideoFrames service with the previous method (two seeks by
+frame number, the frame written as a full size PNG then read again):
+
+    python benchmarks/video_frames.py --width 1920 --height 1080 --frames 750
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from environment import ROOT, make_environment
+from library import make_video
+
+sys.path.insert(0, ROOT)
+
+
+def previous_method(path: str, thumbnail_path: str, size: int):
+    import cv2
+
+    from server.thumbnails import create_thumbnail
+
+    # Color
+    cap = cv2.VideoCapture(path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) // 3)
+    _, frame = cap.read()
+    cap.release()
+    cv2.resize(frame, (1, 1), interpolation=cv2.INTER_AREA)
+
+    # Thumbnail
+    cap = cv2.VideoCapture(path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) // 3)
+    _, frame = cap.read()
+    cv2.imwrite(thumbnail_path, frame)
+    cap.release()
+    create_thumbnail(thumbnail_path, thumbnail_path, size)
+
+
+def current_method(path: str, thumbnail_path: str, size: int):
+    from server.thumbnails import create_video_thumbnail, get_file_color
+    from server.video_frames import VideoFrames
+
+    # Not cached between the runs
+    VideoFrames().frames.clear()
+    get_file_color(path, "video")
+    create_video_thumbnail(path, thumbnail_path, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=750)
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    path = make_environment()
+    from server.configuration import ConfigFile
+
+    ConfigFile(os.path.join(path, "config.conf"))
+
+    folder = tempfile.mkdtemp(dir=path)
+    video = os.path.join(folder, "video.mp4")
+    make_video(video, random.Random(0), args.width, args.height, args.frames)
+
+    results = {}
+    for name, method in (("previous", previous_method), ("current", current_method)):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            method(video, os.path.join(folder, f"{name}.png"), args.size)
+            times.append(time.perf_counter() - start)
+        results[name] = {"ms": min(times) * 1000}
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
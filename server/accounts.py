@@ -1,4 +1,3 @@
-import json
 import os
 import re
 import time
@@ -10,6 +9,8 @@ from flask import Blueprint, request
 from flask_restful import Resource
 
 from .configuration import ConfigFile
+from .metrics import Metrics
+from .shared_state import SharedFile
 from .utils import Singleton, require_admin, require_login, get_request_token
 
 bp = Blueprint("accounts", __name__, url_prefix="/api/accounts")
@@ -81,57 +82,67 @@ class Accounts(metaclass=Singleton):
 
     }
 
+    Both files are modified with their lock held (see SharedFile), the tokens
+    are only read again when the file changed.
     """
 
     def __init__(self, config: ConfigFile):
         self.config = config
         self.path = config.accounts
         self.auth_file = config.authorization_file
+        self.accounts_store = SharedFile(self.path, shared=config.shared_state)
+        self.tokens_store = SharedFile(self.auth_file, shared=config.shared_state)
         self._cache = {}
+        self._admins = None  # Usernames of the admins, made from _cache
+        self._tokens = None
         self._update_accounts()
 
     def _get_accounts(self):
         if not os.path.exists(self.path):
             return {"<index>": INDEX_ACCOUNT}
 
-        with open(self.path, "r") as f:
-            self._cache = json.load(f)
-            return self._cache
+        self._cache = self.accounts_store.load({})
+        self._admins = None
+        return self._cache
 
     def _set_accounts(self, accounts: dict):
         if "<index>" not in accounts:
             accounts["<index>"] = INDEX_ACCOUNT
         self._cache = accounts
-        with open(self.path, "w") as f:
-            json.dump(accounts, f)
+        self._admins = None
+        self.accounts_store.save(accounts)
 
     def _update_accounts(self):
         """Update the accounts file"""
-        accounts = self._get_accounts()
+        with self.accounts_store.lock():
+            accounts = self._get_accounts()
 
-        # Check if the index account is present
-        if "<index>" not in accounts:
-            accounts["<index>"] = INDEX_ACCOUNT
+            # Check if the index account is present
+            if "<index>" not in accounts:
+                accounts["<index>"] = INDEX_ACCOUNT
+
+            # Check if every account has all the fields
+            for username in accounts:
+                for field in DEFAULT_ACCOUNT:
+                    if field not in accounts[username]:
+                        accounts[username][field] = DEFAULT_ACCOUNT[field]
 
-        # Check if every account has all the fields
-        for username in accounts:
-            for field in DEFAULT_ACCOUNT:
-                if field not in accounts[username]:
-                    accounts[username][field] = DEFAULT_ACCOUNT[field]
+            # Save the accounts
+            self._set_accounts(accounts)
 
-        # Save the accounts
-        self._set_accounts(accounts)
+    def _get_tokens(self) -> dict:
+        """Return the tokens, the file is only read if it changed"""
+        if self._tokens is None or self.tokens_store.stale():
+            self._tokens = self.tokens_store.load({})
+            Metrics().token_reads.inc()
+        return self._tokens
 
     def _add_valid_token(self, username: str, token: str = None) -> str:
         """Add a valid token to the account"""
+        with self.tokens_store.lock():
+            return self._insert_token(self._get_tokens(), username, token)
 
-        # Get the current tokens
-        if os.path.exists(self.auth_file):
-            with open(self.auth_file, "r") as f:
-                tokens = json.load(f)
-        else:
-            tokens = {}
-
+    def _insert_token(self, tokens: dict, username: str, token: str) -> str:
         # Check if the user already has a token from the same ip
         for t in (
             tokens if token is None else []
@@ -144,6 +155,7 @@ class Accounts(metaclass=Singleton):
                 tokens[t]["expiration"] = (
                     int(time.time()) + self.config.token_expiration
                 )
+                self.tokens_store.save(tokens)
                 return t
 
         if token is None:
@@ -176,8 +188,7 @@ class Accounts(metaclass=Singleton):
             del tokens[oldest]
 
         # Save the tokens
-        with open(self.auth_file, "w") as f:
-            json.dump(tokens, f)
+        self.tokens_store.save(tokens)
 
         # Send it to the user
         return token
@@ -187,13 +198,8 @@ class Accounts(metaclass=Singleton):
         if token is None:
             return False
 
-        if not os.path.exists(self.auth_file):
-            # No token file, no valid token
-            return False
-
-        # Load the tokens
-        with open(self.auth_file, "r") as f:
-            tokens = json.load(f)
+        # Load the tokens (an empty dict if there is no token file)
+        tokens = self._get_tokens()
 
         if token not in tokens:
             # Invalid token
@@ -207,14 +213,13 @@ class Accounts(metaclass=Singleton):
         """Revoke a token"""
         if not os.path.exists(self.auth_file):
             return
-        with open(self.auth_file, "r") as f:
-            tokens = json.load(f)
-        if token in tokens:
-            del tokens[token]
-        else:
-            print('Token "{}" not found'.format(token))
-        with open(self.auth_file, "w") as f:
-            json.dump(tokens, f)
+        with self.tokens_store.lock():
+            tokens = self._get_tokens()
+            if token in tokens:
+                del tokens[token]
+            else:
+                print('Token "{}" not found'.format(token))
+            self.tokens_store.save(tokens)
 
     def get_user(self) -> dict:
         """Get the user from the token"""
@@ -228,16 +233,30 @@ class Accounts(metaclass=Singleton):
         return self.get_username(username)
 
     def get_username(self, username: str) -> dict:
-        if username not in self._cache:
+        if username not in self._cache or (
+            self.config.shared_state and self.accounts_store.stale()
+        ):
             self._get_accounts()
 
         return self._cache.get(username, None)
 
+    def is_admin(self, username: str) -> bool:
+        """Check if a user is an admin, from a set made once per version of
+        the accounts file (False for an unknown user)"""
+        if self.config.shared_state and self.accounts_store.stale():
+            self._get_accounts()
+        if self._admins is None:
+            self._admins = {
+                name for name, account in self._cache.items() if account.get("admin")
+            }
+        return username in self._admins
+
     def set_account(self, username: str, account: dict):
         """Set an account"""
-        accounts = self._get_accounts()
-        accounts[username] = account
-        self._set_accounts(accounts)
+        with self.accounts_store.lock():
+            accounts = self._get_accounts()
+            accounts[username] = account
+            self._set_accounts(accounts)
 
 
 @bp.route("/login", methods=["POST"])
@@ -0,0 +1,408 @@
+import sqlite3
+import threading
+import time
+
+from flask import Blueprint, request
+
+from .accounts import Accounts
+from .configuration import ConfigFile
+from .file_manager import FileManager, check_files, list_files
+from .thumbnails import thumbnail_response
+from .utils import Singleton, date_seconds, request_lists, require_login
+
+bp = Blueprint("albums", __name__, url_prefix="/api/albums")
+
+
+class AlbumStore(metaclass=Singleton):
+    """Albums of the users, in a SQLite database (album_database).
+
+    The table `albums` has one row per album (id, name, owner, creation date,
+    cover chosen by the user or NULL, number of files) and `album_files` one
+    row per file of an album, keyed by (album, file): adding or removing a
+    file does not read the other files of the album. The date of the file
+    (seconds) is copied in the row so that the files of an album are read
+    by date from an index, a page at a time.
+
+    The hash of the file is copied too: a file moved to the trash stays in
+    its albums and comes back with it, but its rows are ignored if its id is
+    given to another file meanwhile (and replaced if this file is added).
+    """
+
+    def __init__(self):
+        self.config = ConfigFile()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.config.album_database, check_same_thread=False, timeout=30
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS albums (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, owner VARCHAR(16), created INTEGER, cover VARCHAR(12), count INTEGER DEFAULT 0)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS album_files (album INTEGER, file VARCHAR(12), date REAL, hash VARCHAR(32), added INTEGER, PRIMARY KEY (album, file)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS album_files_date ON album_files (album, date, file)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS album_files_file ON album_files (file)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS albums_owner ON albums (owner)")
+        self.db.commit()
+
+    def row(self, row: tuple) -> dict:
+        album_id, name, owner, created, cover, count = row
+        return {
+            "id": album_id,
+            "name": name,
+            "owner": owner,
+            "created": created,
+            "cover": cover,
+            "count": count,
+        }
+
+    def create(self, owner: str, name: str) -> int:
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO albums (name, owner, created) VALUES (?, ?, ?)",
+                (name, owner, int(time.time())),
+            )
+        return cursor.lastrowid
+
+    def get(self, album_id: int) -> dict | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM albums WHERE id = ?", (album_id,)
+            ).fetchone()
+        return self.row(row) if row else None
+
+    def list(self, owner: str, album_ids: list | None = None) -> list:
+        """Albums of a user (only `album_ids` if given), by name"""
+        query = "SELECT * FROM albums WHERE owner = ?"
+        params = [owner]
+        if album_ids is not None:
+            query += f" AND id IN ({', '.join('?' * len(album_ids))})"
+            params += album_ids
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY name, id", params).fetchall()
+        return [self.row(row) for row in rows]
+
+    def update(self, album_id: int, **values):
+        """Set the `name` or the `cover` of an album"""
+        with self.lock, self.db:
+            for key in ("name", "cover"):
+                if key in values:
+                    self.db.execute(
+                        f"UPDATE albums SET {key} = ? WHERE id = ?",
+                        (values[key], album_id),
+                    )
+
+    def delete(self, album_id: int):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM album_files WHERE album = ?", (album_id,))
+            self.db.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+
+    def add_files(self, album_id: int, infos: dict) -> int:
+        """Add the files {f_id: entry} to an album, return the number of files
+        that were not in it yet"""
+        added = int(time.time())
+        rows = [
+            (album_id, f_id, date_seconds(info["date"]), info.get("hash"), added)
+            for f_id, info in infos.items()
+        ]
+        with self.lock, self.db:
+            # The rows of the files that had the id before are replaced, they
+            # are already counted
+            self.db.executemany(
+                "UPDATE album_files SET date = ?, hash = ?, added = ? WHERE album = ? AND file = ? AND hash IS NOT ?",
+                [
+                    (date, f_hash, added, album, f_id, f_hash)
+                    for album, f_id, date, f_hash, added in rows
+                ],
+            )
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT OR IGNORE INTO album_files (album, file, date, hash, added) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            count = self.db.total_changes - before
+            self.db.execute(
+                "UPDATE albums SET count = count + ? WHERE id = ?", (count, album_id)
+            )
+        return count
+
+    def remove_files(self, album_id: int, f_ids: list) -> int:
+        """Remove files from an album, return the number of files removed"""
+        with self.lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                "DELETE FROM album_files WHERE album = ? AND file = ?",
+                [(album_id, f_id) for f_id in f_ids],
+            )
+            count = self.db.total_changes - before
+            self.db.execute(
+                "UPDATE albums SET count = count - ? WHERE id = ?", (count, album_id)
+            )
+            # The cover is chosen again if it was removed
+            self.db.executemany(
+                "UPDATE albums SET cover = NULL WHERE id = ? AND cover = ?",
+                [(album_id, f_id) for f_id in f_ids],
+            )
+        return count
+
+    def files(self, album_id: int, before: float, file: str, count: int) -> list:
+        """(file, date, hash) of the files of an album, from the newest, that
+        are older than (before, file)"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT file, date, hash FROM album_files WHERE album = ? AND (date < ? OR (date = ? AND file < ?)) ORDER BY date DESC, file DESC LIMIT ?",
+                (album_id, before, before, file, count),
+            ).fetchall()
+
+    def albums_of(self, f_id: str, f_hash: str | None) -> list:
+        """Ids of the albums containing a file"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT album FROM album_files WHERE file = ? AND hash IS ?",
+                (f_id, f_hash),
+            ).fetchall()
+        return [album_id for album_id, in rows]
+
+    def update_file(self, f_id: str, info: dict):
+        """The date or the hash of a file changed"""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE album_files SET date = ?, hash = ? WHERE file = ?",
+                (date_seconds(info["date"]), info.get("hash"), f_id),
+            )
+
+    def move_file(self, f_id: str, new_id: str, f_hash: str | None):
+        """A file of the trash was restored with a new id"""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE album_files SET file = ? WHERE file = ? AND hash IS ?",
+                (new_id, f_id, f_hash),
+            )
+
+    def forget_file(self, f_id: str, f_hash: str | None):
+        """A file was deleted for good"""
+        with self.lock, self.db:
+            albums = self.db.execute(
+                "SELECT album FROM album_files WHERE file = ? AND hash IS ?",
+                (f_id, f_hash),
+            ).fetchall()
+            self.db.execute(
+                "DELETE FROM album_files WHERE file = ? AND hash IS ?", (f_id, f_hash)
+            )
+            self.db.executemany(
+                "UPDATE albums SET count = count - 1 WHERE id = ?", albums
+            )
+            self.db.executemany(
+                "UPDATE albums SET cover = NULL WHERE id = ? AND cover = ?",
+                [(album_id, f_id) for album_id, in albums],
+            )
+
+
+def visible_files(album: dict, before: float, file: str, count: int) -> tuple:
+    """Page of the files of an album that its owner can see, and the
+    (before, file) cursor of the next page (None at the end)"""
+    fm = FileManager()
+    store = AlbumStore()
+    f_ids = []
+    while len(f_ids) < count:
+        rows = store.files(album["id"], before, file, count)
+        for f_id, date, f_hash in rows:
+            before, file = date, f_id
+            info = fm.index.get(f_id)
+            if (
+                info is not None
+                and info.get("hash") == f_hash
+                and fm.is_allowed(f_id, album["owner"])
+            ):
+                f_ids.append(f_id)
+                if len(f_ids) == count:
+                    return f_ids, [before, file]
+        if len(rows) < count:
+            return f_ids, None
+    return f_ids, [before, file]
+
+
+def cover_of(album: dict) -> str | None:
+    """File shown for the album: the cover chosen or the newest file"""
+    fm = FileManager()
+    cover = album["cover"]
+    if cover is not None and fm.is_allowed(cover, album["owner"]):
+        return cover
+    files, _ = visible_files(album, float("inf"), "", 1)
+    return files[0] if files else None
+
+
+def allowed_album(album_id: int) -> dict | tuple:
+    """Album of the user (or of anyone for the admins), or an error response"""
+    user = Accounts().get_user()
+    album = AlbumStore().get(album_id)
+    if album is None:
+        return {"message": "Album not found"}, 404
+    if album["owner"] != user["username"] and not user.get("admin"):
+        return {"message": "Unauthorized"}, 401
+    return album
+
+
+@bp.route("/", methods=["GET"])
+@require_login
+def get_albums():
+    """Albums of the user (by ?user= for the admins), with their cover"""
+    user = Accounts().get_user()
+    username = request.args.get("user", user["username"])
+    if username != user["username"] and not user.get("admin"):
+        return {"message": "Unauthorized"}, 401
+    albums = AlbumStore().list(username)
+    for album in albums:
+        album["cover"] = cover_of(album)
+    return {"message": "OK", "albums": albums}
+
+
+@bp.route("/", methods=["POST"])
+@require_login
+def create_album():
+    """Create the album {"name": ...}"""
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return {"message": "Invalid request"}, 400
+    name = data.get("name")
+    if not isinstance(name, str) or not name.strip():
+        return {"message": "Invalid name"}, 400
+    username = Accounts().get_user()["username"]
+    album = AlbumStore().get(AlbumStore().create(username, name.strip()))
+    return {"message": "OK", "album": album}, 201
+
+
+@bp.route("/<int:album_id>", methods=["GET"])
+@require_login
+def get_album(album_id: int):
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    album["cover"] = cover_of(album)
+    return {"message": "OK", "album": album}
+
+
+@bp.route("/<int:album_id>", methods=["PATCH"])
+@require_login
+def update_album(album_id: int):
+    """Rename the album {"name": ...} or choose its cover {"cover": <file id>}
+    (null to use its newest file)"""
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return {"message": "Invalid request"}, 400
+    values = {}
+    if "name" in data:
+        if not isinstance(data["name"], str) or not data["name"].strip():
+            return {"message": "Invalid name"}, 400
+        values["name"] = data["name"].strip()
+    if data.get("cover") is not None:
+        fm = FileManager()
+        cover = data["cover"]
+        if (
+            not isinstance(cover, str)
+            or cover not in fm.index
+            or album["id"]
+            not in AlbumStore().albums_of(cover, fm.index[cover].get("hash"))
+        ):
+            return {"message": "The cover must be a file of the album"}, 400
+        values["cover"] = cover
+    elif "cover" in data:
+        values["cover"] = None
+    AlbumStore().update(album_id, **values)
+    return {"message": "OK"}
+
+
+@bp.route("/<int:album_id>", methods=["DELETE"])
+@require_login
+def delete_album(album_id: int):
+    """Delete an album, its files are not deleted"""
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    AlbumStore().delete(album_id)
+    return {"message": "OK"}
+
+
+@bp.route("/<int:album_id>/add", methods=["POST"])
+@require_login
+def add_files(album_id: int):
+    """Add the files {"files": [...]} to the album, they must be visible to
+    its owner"""
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    values = request_lists("files", default=[])
+    if isinstance(values, tuple):
+        return values
+    files = values[0]
+    fm = FileManager()
+    error = check_files(fm, files, album["owner"])
+    if error:
+        return error
+    added = AlbumStore().add_files(album_id, {f_id: fm.index[f_id] for f_id in files})
+    return {"message": "OK", "added": added}
+
+
+@bp.route("/<int:album_id>/remove", methods=["POST"])
+@require_login
+def remove_files(album_id: int):
+    """Remove the files {"files": [...]} from the album"""
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    values = request_lists("files", default=[])
+    if isinstance(values, tuple):
+        return values
+    removed = AlbumStore().remove_files(album_id, values[0])
+    return {"message": "OK", "removed": removed}
+
+
+@bp.route("/<int:album_id>/files", methods=["GET"])
+@require_login
+def get_album_files(album_id: int):
+    """Files of the album from the newest, ?count= per page. The next page
+    starts after the "next" [before, file] cursor: ?before=<date>&file=<id>"""
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    before = request.args.get("before", float("inf"), type=float)
+    file = request.args.get("file", "")
+    count = request.args.get("count", 100, type=int)
+    if count <= 0:
+        return {"message": "Invalid count"}, 400
+    f_ids, cursor = visible_files(album, before, file, count)
+    return list_files(f_ids, next=cursor)
+
+
+@bp.route("/<int:album_id>/cover/<int:size>")
+@require_login
+def get_album_cover(album_id: int, size: int):
+    """Thumbnail of the cover of the album"""
+    album = allowed_album(album_id)
+    if isinstance(album, tuple):
+        return album
+    cover = cover_of(album)
+    if cover is None:
+        return {"message": "The album is empty"}, 404
+    return thumbnail_response(cover, size)
+
+
+@bp.route("/of/<string:f_id>")
+@require_login
+def get_file_albums(f_id: str):
+    """Albums of the user containing a file"""
+    fm = FileManager()
+    username = Accounts().get_user()["username"]
+    if not fm.is_allowed(f_id, username):
+        return {"message": "File not found"}, 404
+    store = AlbumStore()
+    album_ids = store.albums_of(f_id, fm.index[f_id].get("hash"))
+    return {"message": "OK", "albums": store.list(username, album_ids)}
@@ -0,0 +1,184 @@
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import Response, abort, request, send_file
+from werkzeug.utils import safe_join
+
+from .configuration import ConfigFile
+from .utils import Singleton
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def is_compressible(mimetype: str | None) -> bool:
+    if mimetype is None:
+        return False
+    return (
+        mimetype.startswith("text/")
+        or mimetype.endswith(("/json", "+json", "/x-ndjson", "/javascript", "+xml"))
+        or mimetype == "image/svg+xml"
+    )
+
+
+def choose_encoding() -> str | None:
+    """Return the best encoding accepted by the client"""
+    for encoding in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, level: int | None = None) -> bytes:
+    if level is None:
+        level = ConfigFile().compression_level
+    if encoding == "br":
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding: str):
+    """Compress an iterable of bytes, flushing after every chunk so that the
+    client can decode the data as it arrives"""
+    level = ConfigFile().compression_level
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=min(level, 11))
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        # wbits=31 produces a gzip container
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def compress_response(response: Response) -> Response:
+    """after_request hook compressing the API responses"""
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or not is_compressible(response.mimetype)
+        # The events must reach the client as they are sent, the proxies
+        # may buffer a compressed stream
+        or response.mimetype == "text/event-stream"
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < ConfigFile().compression_threshold:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+class StaticEntry:
+    def __init__(self, stamp: tuple, data: bytes, mimetype: str | None):
+        self.stamp = stamp
+        self.mtime = stamp[0] / 1e9
+        self.mimetype = mimetype or "application/octet-stream"
+        self.etag = hashlib.md5(data).hexdigest()
+        self.variants = {None: data}
+        # Precompress once, with the best ratio since it is only done once
+        if (
+            is_compressible(mimetype)
+            and len(data) >= ConfigFile().compression_threshold
+        ):
+            for encoding in ENCODINGS:
+                self.variants[encoding] = compress(data, encoding, level=9)
+        self.size = sum(len(variant) for variant in self.variants.values())
+
+
+class StaticCache(metaclass=Singleton):
+    """In-memory cache of the static web files and their compressed variants.
+    Entries are invalidated when the file on disk changes, the least recently
+    used ones are dropped when the cache is larger than static_cache_bytes."""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0  # Bytes of all the variants of the entries
+        self.lock = threading.Lock()
+
+    def get(self, key, path: str, render=None) -> StaticEntry | None:
+        """Entry of a file, None if it is too large to be cached"""
+        limit = ConfigFile().static_cache_bytes
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.stamp == stamp:
+                self.entries.move_to_end(key)
+                return entry
+        if render is None and stat.st_size > limit:
+            return None
+
+        with open(path, "rb") as f:
+            data = f.read()
+        if render is not None:
+            data = render(data)
+        entry = StaticEntry(stamp, data, mimetypes.guess_type(path)[0])
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            if entry.size <= limit:
+                self.entries[key] = entry
+                self.size += entry.size
+            while self.size > limit:
+                self.size -= self.entries.popitem(last=False)[1].size
+        return entry
+
+    def respond(self, folder: str, path: str, key=None, render=None) -> Response:
+        """Serve `path` (relative to `folder`) from the cache.
+        `key` must identify the output of `render` if it is given."""
+        full_path = safe_join(folder, path)
+        if full_path is None or not os.path.isfile(full_path):
+            abort(404)
+
+        entry = self.get(path if key is None else key, full_path, render)
+        if entry is None:
+            # Too large, read from the disk each time
+            return send_file(full_path, conditional=True)
+
+        # Ranges are served from the uncompressed file
+        encoding = choose_encoding() if request.range is None else None
+        if encoding not in entry.variants:
+            encoding = None
+        # send_file answers the conditional (304) and range (206) requests,
+        # without max_age the client always revalidates
+        response = send_file(
+            io.BytesIO(entry.variants[encoding]),
+            mimetype=entry.mimetype,
+            etag=entry.etag if encoding is None else f"{entry.etag}-{encoding}",
+            last_modified=entry.mtime,
+            conditional=True,
+        )
+        if encoding is not None and response.status_code == 200:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
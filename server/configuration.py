@@ -17,12 +17,22 @@ class ConfigFile(metaclass=Singleton):
         "temp_folder": "/srv/photosync/temp",
         "web_folder": "web",
         "trash_folder": "/srv/photosync/trash",
+        "trash_database": "/srv/photosync/trash.db",
+        "album_database": "/srv/photosync/albums.db",
         "index": "/srv/photosync/index.json",
         "accounts": "/srv/photosync/accounts.json",
         "authorization_file": "/srv/photosync/auth.json",
         "history_database": "/srv/photosync/changes.db",
+        "profile_folder": "/srv/photosync/profiles",
+        "job_folder": "/srv/photosync/jobs",
         "address": "0.0.0.0",
         "port": "8080",
+        "server_mode": "development",  # development (Flask) or waitress
+        "workers": 1,  # Processes (waitress), more than 1 requires shared_state
+        "shared_state": False,  # Several processes use the same files
+        "threads": 16,  # Worker threads (waitress)
+        "connection_limit": 1000,  # Open connections (waitress)
+        "channel_timeout": 120,  # Inactive connections are closed (waitress)
         "ssl": False,
         "ssl_cert": "/srv/photosync/photosync.crt",
         "ssl_key": "/srv/photosync/photosync.key",
@@ -32,9 +42,50 @@ class ConfigFile(metaclass=Singleton):
         "token_expiration": 31536000,  # 1 year
         "max_tokens": 32,  # Maximum number of tokens per user
         "download_buffer_size": 65536,  # 64kb
+        "sendfile_mode": "python",  # python, x-sendfile or x-accel-redirect
+        "sendfile_storage_prefix": "/protected/storage",  # nginx internal locations
+        "sendfile_thumbnails_prefix": "/protected/thumbnails",
         "thumbnail_size": 128,
+        "thumbnail_max_pixels": 100_000_000,  # Larger images have no thumbnail
+        "video_frame_size": 512,  # Poster frames kept in memory (smallest side)
+        "video_frame_cache_size": 64,  # Number of poster frames kept in memory
+        "video_preview_frames": 8,  # Frames of the animated previews
+        "video_preview_frame_duration": 250,  # ms
         "cache_time": 2628000,  # 1 month
         "index_offset": 10_000_000,
+        "stream_batch_size": 256,  # Files per chunk in streamed lists
+        "timeline_samples": 4,  # Ids of files sent for each period of the timeline
+        "compression_threshold": 1024,  # Smaller responses are sent as is
+        "compression_level": 6,
+        "static_cache_bytes": 33554432,  # 32 MB of static files kept in memory
+        "history_batch_size": 64,  # Changes committed together
+        "history_commit_delay": 0.05,  # Seconds before committing the changes
+        "history_retention": 31536000,  # 1 year, 0 to keep everything
+        "history_max_changes": 0,  # 0 for no limit
+        "history_compact_interval": 3600,  # 1 hour
+        "push_timeout": 30,  # Long polling duration (seconds)
+        "push_stream_lifetime": 300,  # Server-Sent Events reconnect after that
+        "push_keepalive": 15,
+        "push_max_waiters": 128,  # Waiting connections (of the threads, of push_port)
+        "push_free_threads": 4,  # Threads never used by waiting connections (waitress)
+        "push_port": 0,  # Serve the waiting connections without threads, 0 to disable
+        "push_batch_size": 500,  # Changes per event
+        "push_poll_interval": 1,  # Seconds, to get the changes of other processes
+        "profile_sample_rate": 0,  # Fraction of the requests profiled (0 to 1)
+        "profile_interval": 0.005,  # Seconds between the samples of the profiler
+        "profile_max_files": 100,  # The oldest profiles are removed
+        "watch_storage": False,  # Index the files added to the storage (inotify)
+        "watch_debounce": 2,  # Seconds without change before indexing a file
+        "watch_reconcile_interval": 3600,  # Full scan (seconds), 0 to disable
+        "scan_workers": 0,  # Threads listing the storage, 0 for one per CPU
+        "job_workers": 1,  # Background jobs running at the same time
+        "job_batch_size": 500,  # Files done between two checkpoints
+        "job_max_files": 100,  # The oldest finished jobs are removed
+        "trash_retention": 2592000,  # 30 days, files purged from the trash
+        "trash_purge_interval": 86400,  # Seconds between two purges, 0 to disable
+        "duplicate_radius": 6,  # Max different bits of the pHash of duplicates (<= 7)
+        "burst_interval": 5,  # Max seconds between two photos of a burst
+        "burst_radius": 16,  # Max different bits of the dHash in a burst
     }
     TYPES = {
         "storage": str,
@@ -42,12 +93,22 @@ class ConfigFile(metaclass=Singleton):
         "temp_folder": str,
         "web_folder": str,
         "trash_folder": str,
+        "trash_database": str,
+        "album_database": str,
         "index": str,
         "accounts": str,
         "authorization_file": str,
         "history_database": str,
+        "profile_folder": str,
+        "job_folder": str,
         "address": str,
         "port": int,
+        "server_mode": str,
+        "workers": int,
+        "shared_state": bool,
+        "threads": int,
+        "connection_limit": int,
+        "channel_timeout": int,
         "ssl": bool,
         "ssl_cert": str,
         "ssl_key": str,
@@ -56,9 +117,50 @@ class ConfigFile(metaclass=Singleton):
         "token_expiration": int,
         "max_tokens": int,
         "download_buffer_size": int,
+        "sendfile_mode": str,
+        "sendfile_storage_prefix": str,
+        "sendfile_thumbnails_prefix": str,
         "thumbnail_size": int,
+        "thumbnail_max_pixels": int,
+        "video_frame_size": int,
+        "video_frame_cache_size": int,
+        "video_preview_frames": int,
+        "video_preview_frame_duration": int,
         "cache_time": int,
         "index_offset": int,
+        "stream_batch_size": int,
+        "timeline_samples": int,
+        "compression_threshold": int,
+        "compression_level": int,
+        "static_cache_bytes": int,
+        "history_batch_size": int,
+        "history_commit_delay": float,
+        "history_retention": int,
+        "history_max_changes": int,
+        "history_compact_interval": int,
+        "push_timeout": int,
+        "push_stream_lifetime": int,
+        "push_keepalive": int,
+        "push_max_waiters": int,
+        "push_port": int,
+        "push_free_threads": int,
+        "push_batch_size": int,
+        "push_poll_interval": float,
+        "profile_sample_rate": float,
+        "profile_interval": float,
+        "profile_max_files": int,
+        "watch_storage": bool,
+        "watch_debounce": float,
+        "watch_reconcile_interval": int,
+        "scan_workers": int,
+        "job_workers": int,
+        "job_batch_size": int,
+        "job_max_files": int,
+        "trash_retention": int,
+        "trash_purge_interval": int,
+        "duplicate_radius": int,
+        "burst_interval": float,
+        "burst_radius": int,
     }
 
     def __init__(self, file_name: str):
@@ -101,9 +203,9 @@ class ConfigFile(metaclass=Singleton):
                             log.debug(f"Loaded {name}")
                         else:
                             log.warning(f"{name} is not a valid setting")
-                            self.config[
-                                name
-                            ] = value  # Can still be used for other settings
+                            self.config[name] = (
+                                value  # Can still be used for other settings
+                            )
                     case ():
                         pass
                     case _:
@@ -1,18 +1,41 @@
+import bisect
+import contextlib
+import heapq
 import hashlib
 import json
 import logging
 import os
 import shutil
+import threading
 import uuid, time
 from timeit import default_timer as timer
 
-from flask import Blueprint, request, send_file
+from flask import Blueprint, Response, request, stream_with_context
 from werkzeug.utils import secure_filename
 
 from .accounts import Accounts
 from .configuration import ConfigFile
-from .utils import Singleton, get_exif_date, require_admin, require_login
+from .utils import (
+    Singleton,
+    date_seconds,
+    get_date_filename,
+    require_admin,
+    get_request_token,
+    require_login,
+    request_lists,
+    send_stored_file,
+    stream_json,
+)
 from .index_changes import ChangeDB
+from .jobs import Job, register_job, submit_job
+from .metadata import read_metadata
+from .metrics import Metrics
+from .notifications import Notifier
+from .scanner import diff_index, scan_tree
+from .search import SearchIndex
+from .shared_state import SharedFile
+from .sharing import Shares
+from .timeline import OFFSET_RANGE, UNITS, Timeline
 
 log = logging.getLogger("file_manager")
 
@@ -32,6 +55,13 @@ SHARED_KEYS = [
     "hash",
 ]
 
+# Keys with few distinct values, sent as indexes in a string table by the
+# columnar listing format
+TABLE_KEYS = ["owner", "type", "format"]
+# Keys of an entry that don't come from its file
+USER_KEYS = ["id", "owner", "rights", "user_tags"]
+COLUMNAR_MIMETYPE = "application/vnd.photosync.columnar+json"
+
 
 def creation_date(path_to_file):
     return os.path.getctime(path_to_file) * 1000
@@ -43,9 +73,20 @@ class FileManager(metaclass=Singleton):
     def __init__(self, config: ConfigFile):
         self.config = config
         self.path = config.storage
+        self.store = SharedFile(config.index, shared=config.shared_state)
+        self.reload_lock = threading.Lock()  # One thread reloads the index
         self.known_files = set()
         self.ordered_files = []
+        self.paths = {}  # path -> f_id of the entries
+        self.timeline = Timeline()  # Follows ordered_files
+        self.shares = Shares()  # Follows the owners and the rights
+        self.search = SearchIndex()  # Follows the names, tags and metadata
         self.load_index()  # Index is a dict with the id as key
+        if self.search.stamp is None and self.store.stamp is not None:
+            # Built from the entries, saved for the next start
+            with self.store.lock():
+                if not self.store.stale():
+                    self.save_search()
 
         if not os.path.exists(self.path):
             os.makedirs(self.path)
@@ -54,19 +95,62 @@ class FileManager(metaclass=Singleton):
         if not os.path.exists(self.config.index):
             os.makedirs(os.path.dirname(self.config.index), exist_ok=True)
             self.index = {}
-            with open(self.config.index, "w") as f:
-                f.write("{}")
+            self.store.save(self.index)
             self.known_files = set()
             self.ordered_files = []
+            self.paths = {}
+            self.timeline.rebuild(self.index)
+            self.shares.rebuild(self.index)
+            self.search.rebuild(self.index)
             print("Index file created")
             return
-        with open(self.config.index, "r") as f:
-            self.index = json.load(f)
-            self.known_files = {f["path"] for f in self.index.values()}
-            self.update_order()
-            print("Loaded index with", len(self.index), "files")
+        self.index = self.store.load({})
+        self.known_files = {f["path"] for f in self.index.values()}
+        self.update_order(search=False)
+        self.load_search()
+        print("Loaded index with", len(self.index), "files")
+
+    def load_search(self):
+        """Read the search index saved for this version of the index, or
+        build it. It is saved with the index only, by the writers"""
+        stamp = self.store.stamp
+        if stamp is None or not self.search.load(self.config.index + ".search", stamp):
+            self.search.rebuild(self.index)
+
+    def save_search(self):
+        """Save the search index (or its changes) for the version of the
+        index just saved (in <index>.search), it is rebuilt at the next load
+        if this fails"""
+        try:
+            self.search.save(self.config.index + ".search", self.store.stamp)
+        except OSError as e:
+            print("Could not save the search index :", e)
+
+    def sync(self):
+        """Reload the index if another process saved it (shared_state mode).
+        The file is replaced atomically, so it is read without the lock of
+        the processes: only the writers of transaction() wait for it"""
+        if self.config.shared_state and self.store.stale():
+            with self.reload_lock:
+                if self.store.stale():
+                    self.load_index()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context to modify the index: it is locked (for the other processes
+        too in shared_state mode), up to date and saved at the end. If an
+        exception is raised or the index cannot be saved, the modifications
+        are dropped"""
+        with self.store.lock():
+            self.sync()
+            try:
+                yield self
+                self.save_index()
+            except BaseException:
+                self.load_index()
+                raise
 
-    def update_order(self):
+    def update_order(self, search: bool = True):
         try:
             self.ordered_files = sorted(
                 list(self.index.keys()),
@@ -76,10 +160,183 @@ class FileManager(metaclass=Singleton):
         except:
             self.ordered_files = list(self.index.keys())
             print("Error while sorting files")
+        self.paths = {info["path"]: f_id for f_id, info in self.index.items()}
+        self.timeline.rebuild(self.index)
+        self.shares.rebuild(self.index)
+        if search:
+            self.search.rebuild(self.index)
+
+    def add_entry(self, info: dict):
+        """Add an entry to the index, keeping the ordered list sorted. An
+        other entry of the same file is removed: a process may have indexed
+        it before the transaction adding it (e.g. the watcher and an upload)"""
+        f_id = str(info["id"])
+        other = self.paths.get(info["path"])
+        if other is not None and other != f_id and other in self.index:
+            self.remove_entry(other)
+        if f_id in self.index:
+            previous = self.index[f_id]
+            if (previous.get("date"), previous.get("hash")) != (
+                info.get("date"),
+                info.get("hash"),
+            ):
+                from .albums import AlbumStore
+
+                # The albums keep the date and the hash of their files
+                AlbumStore().update_file(f_id, info)
+            self.timeline.remove(f_id, previous)
+            if f_id in self.ordered_files:
+                self.ordered_files.remove(f_id)
+            self.forget_path(f_id, previous["path"])
+        self.index[f_id] = info
+        self.paths[info["path"]] = f_id
+        self.timeline.add(f_id, info)
+        self.shares.add(f_id, info)
+        self.search.add(f_id, info)
+        self.known_files.add(info["path"])
+        try:
+            position = bisect.bisect_left(
+                self.ordered_files,
+                -info["date"],
+                key=lambda f: -self.index[f]["date"],
+            )
+        except TypeError:
+            position = len(self.ordered_files)  # Same fallback as update_order
+        self.ordered_files.insert(position, f_id)
+
+    def forget_path(self, f_id: str, path: str):
+        if self.paths.get(path) == f_id:
+            del self.paths[path]
+
+    def remove_entry(self, f_id: str):
+        """Remove an entry from the index, the change is recorded"""
+        info = self.index[f_id]
+        ChangeDB().add_change(info)
+        self.known_files.discard(info["path"])
+        self.forget_path(f_id, info["path"])
+        del self.index[f_id]
+        self.timeline.remove(f_id, info)
+        self.shares.remove(f_id)
+        self.search.remove(f_id)
+        if f_id in self.ordered_files:
+            self.ordered_files.remove(f_id)
+
+    def remove_entries(self, f_ids: list):
+        """Remove several entries from the index, the ordered list is filtered
+        once instead of once per entry"""
+        removed = set()
+        for f_id in f_ids:
+            info = self.index.pop(f_id, None)
+            if info is None:
+                continue
+            ChangeDB().add_change(info)
+            self.known_files.discard(info["path"])
+            self.forget_path(f_id, info["path"])
+            self.timeline.remove(f_id, info)
+            self.shares.remove(f_id)
+            self.search.remove(f_id)
+            removed.add(f_id)
+        if removed:
+            self.ordered_files = [f for f in self.ordered_files if f not in removed]
+
+    def index_path(self, rel_path: str) -> dict | None:
+        """Add a file of the storage to the index if it is not known"""
+        if rel_path in self.known_files:
+            return None
+        result = self.get_file_info(rel_path)
+        if not result or result[1] is None:
+            return None
+        info = result[0]
+        self.add_entry(info)
+        ChangeDB().add_change(info)
+        return info
+
+    def update_path(self, f_id: str):
+        """Read the file of an entry again if it was modified"""
+        info = self.index[f_id]
+        stat = os.stat(self.get_file_path(info["path"]))
+        if (info.get("size"), info.get("mtime")) == (stat.st_size, stat.st_mtime_ns):
+            return
+        result = self.get_file_info(info["path"], force_update=True)
+        if not result or result[1] is None:
+            return
+        # Keep the id and what the users set
+        new_info = {**result[0], **{k: info[k] for k in USER_KEYS if k in info}}
+        self.add_entry(new_info)
+        ChangeDB().add_change(new_info)
+
+    def move_path(self, f_id: str, new_path: str):
+        """The file of an entry was renamed in the storage"""
+        info = self.index[f_id]
+        self.known_files.discard(info["path"])
+        self.forget_path(f_id, info["path"])
+        info["path"] = new_path
+        info["extension"] = self.get_extension(new_path)
+        self.known_files.add(new_path)
+        self.paths[new_path] = f_id
+        self.search.add(f_id, info)
+        ChangeDB().add_change(info)
+
+    def plan_reconcile(self) -> list:
+        """Compare the storage with the index, return the list of the
+        (action, path or id) needed to update it"""
+        on_disk = scan_tree(self.path, ConfigFile().scan_workers)
+        with self.store.lock():
+            self.sync()
+            new_files, removed, modified = diff_index(self.index, on_disk)
+            # Files that could not be indexed
+            self.known_files &= on_disk.keys()
+            new_files = [path for path in new_files if path not in self.known_files]
+        return (
+            [("remove", f_id) for f_id in removed]
+            + [("update", f_id) for f_id in modified]
+            + [("add", path) for path in new_files]
+        )
+
+    def apply_reconcile(self, actions: list) -> dict:
+        """Apply actions of plan_reconcile, return the number of files added,
+        removed and modified. The index must be locked"""
+        counts = {"added": 0, "removed": 0, "modified": 0}
+        for action, value in actions:
+            try:
+                if action == "add":
+                    if self.index_path(value) is not None:
+                        counts["added"] += 1
+                elif value not in self.index:
+                    continue  # Changed since the plan
+                elif action == "remove":
+                    if not os.path.exists(
+                        self.get_file_path(self.index[value]["path"])
+                    ):
+                        self.remove_entry(value)
+                        counts["removed"] += 1
+                else:
+                    self.update_path(value)
+                    counts["modified"] += 1
+            except OSError as e:
+                print("Could not", action, value, ":", e)
+        return counts
+
+    def reconcile(self) -> tuple:
+        """Index the new files of the storage, read the modified ones again
+        and remove the entries whose file is gone.
+        Return the number of files (added, removed, modified)"""
+        counts = self.apply_reconcile(self.plan_reconcile())
+        return counts["added"], counts["removed"], counts["modified"]
 
     def save_index(self):
-        with open(self.config.index, "w") as f:
-            json.dump(self.index, f)
+        metrics = Metrics()
+        with metrics.index_save.time():
+            self.store.save(self.index)
+            self.save_search()
+        metrics.index_size.set(os.path.getsize(self.store.path))
+        metrics.index_files.set(len(self.index))
+
+    def next_id(self) -> int:
+        return max(
+            len(self.index) + 1 + ConfigFile().index_offset,
+            max(map(int, self.index.keys()), default=0) + 1,
+        )
 
     def get_file_path(self, name: str):
         return os.path.join(self.path, name)
@@ -117,92 +374,92 @@ class FileManager(metaclass=Singleton):
         info["path"] = rel_path
         info["extension"] = self.get_extension(rel_path)
         info["date"] = creation_date(self.get_file_path(rel_path))
+        # Used to know if the file was modified
+        stat = os.stat(self.get_file_path(rel_path))
+        info["size"] = stat.st_size
+        info["mtime"] = stat.st_mtime_ns
         info["owner"] = "<index>"
-        info["id"] = max(
-            len(self.index) + 1 + ConfigFile().index_offset,
-            max(map(int, self.index.keys()), default=0) + 1,
-        )
+        info["id"] = self.next_id()
         info["metadata"] = {}
         info["user_tags"] = {}
         info["rights"] = []
 
         # Compute hash md5 for the file
         h = hashlib.md5()
+        size = 0
+        start = timer()
         with open(self.get_file_path(rel_path), "rb") as f:
             while True:
                 data = f.read(self.config.hash_buffer_size)
                 if not data:
                     break
                 h.update(data)
+                size += len(data)
+        Metrics().hash_duration.inc(timer() - start)
+        Metrics().hashed_bytes.inc(size)
 
         info["hash"] = h.hexdigest()
 
         unsupported = False
         match self.get_extension(rel_path).lower():
-            case (".jpg" | ".jpeg"):
+            case ".jpg" | ".jpeg":
                 info["type"] = "image"
                 info["format"] = "jpeg"
-            case (".png"):
+            case ".png":
                 info["type"] = "image"
                 info["format"] = "png"
-            case (".gif"):
+            case ".gif":
                 info["type"] = "image"
                 info["format"] = "gif"
-            case (".webp"):
+            case ".webp":
                 info["type"] = "image"
                 info["format"] = "webp"
-            case (".mp4"):
+            case ".heic" | ".heif":
+                info["type"] = "image"
+                info["format"] = "heic"
+            case ".mp4":
                 info["type"] = "video"
                 info["format"] = "mp4"
-            case (".webm"):
+            case ".webm":
                 info["type"] = "video"
                 info["format"] = "webm"
-            case (".avi"):
+            case ".avi":
                 info["type"] = "video"
                 info["format"] = "avi"
-            case (".mov"):
+            case ".mov":
                 info["type"] = "video"
                 info["format"] = "mov"
-            case (".m4v"):
+            case ".m4v":
                 info["type"] = "video"
                 info["format"] = "m4v"
-            case (".mkv"):
+            case ".mkv":
                 info["type"] = "video"
                 info["format"] = "mkv"
-            case (".3gp"):
+            case ".3gp":
                 info["type"] = "video"
                 info["format"] = "3gp"
-            case (".mp"):  # Google Pixel's Motion Photos
+            case ".mp":  # Google Pixel's Motion Photos
                 return {}, None
             case _:
                 print("Unsupported file type :", rel_path)
                 unsupported = True
                 info["type"] = "unknown"
                 info["format"] = os.path.splitext(rel_path)[1][1:]
-        if info["type"] == "image":
-            try:
-                d = get_exif_date(self.get_file_path(rel_path))
-                info["date"] = d if d else info["date"]
-            except:
-                raise
-                print("Error while reading exif data for :", rel_path)
-
-        elif info["type"] == "video":
-            # Get the creation date from the video metadata
-            try:
-                import mutagen
-
-                metadata = mutagen.File(self.get_file_path(rel_path))
-                if metadata:
-                    d = metadata.get("creation_time")
-                    if d:
-                        info["date"] = d[0]
-            except:
-                print("Error while reading metadata for :", rel_path)
-
-        info["color"] = thumbnails.get_file_color(
+        if info["type"] in ("image", "video"):
+            # Date, size, orientation, position... read from the headers only
+            metadata = read_metadata(self.get_file_path(rel_path))
+            date = metadata.pop("date", None)
+            if date is None and info["type"] == "image":
+                date = get_date_filename(self.get_file_path(rel_path))
+            info["date"] = date if date else info["date"]
+            info["metadata"] = metadata
+
+        info["color"], hashes = thumbnails.analyze_file(
             self.get_file_path(rel_path), info["type"]
         )
+        if hashes is not None:
+            # Perceptual hashes, to find the duplicates
+            info["hashes"] = hashes
 
         return info, info["id"]
 
@@ -211,27 +468,22 @@ class FileManager(metaclass=Singleton):
     ):
         # Use name_id to preserve ids across upgrades in the index
         use_name = path_id is not None
-        for root, dirs, files in os.walk(self.path):
-            root = root.replace(self.path, "", 1)
-            if root.startswith(os.sep):
-                root = root[1:]
-            for file in files:
-                path = os.path.join(root, file)
-                if path in self.known_files:
-                    continue
-                f_info, f_id = self.get_file_info(path, force_update)
-                if use_name:
-                    f_id = path_id.get(path, f_id)  # Change f_id if available
-                    f_info["id"] = f_id
-                if f_id is None:
-                    continue
-                self.index[f_id] = f_info
-                log.debug(f"Indexed {file}")
+        for path in sorted(scan_tree(self.path, ConfigFile().scan_workers)):
+            if path in self.known_files:
+                continue
+            f_info, f_id = self.get_file_info(path, force_update)
+            if use_name:
+                f_id = path_id.get(path, f_id)  # Change f_id if available
+                f_info["id"] = f_id
+            if f_id is None:
+                continue
+            self.index[str(f_id)] = f_info
+            log.debug(f"Indexed {path}")
 
     def get_all_infos(self):
         return self.index
 
-    def is_allowed(self, f_id: int, user: str, include_admin: bool = True):
+    def is_allowed(self, f_id: str, user: str, include_admin: bool = True):
         # Check if the file exists
         if not f_id in self.index:
             return False
@@ -240,16 +492,12 @@ class FileManager(metaclass=Singleton):
         if self.index[f_id]["owner"] == user:
             return True
 
-        # Check if the file is public
-        if "public" in self.index[f_id]["rights"]:
-            return True
-
-        # Check if the user is in the allowed list
-        if user in self.index[f_id]["rights"]:
+        # Check if the file is public or shared with the user
+        if self.shares.is_shared(f_id, user):
             return True
 
         # Check if the user is an admin
-        return Accounts().get_username(user)["admin"] and include_admin
+        return include_admin and Accounts().is_admin(user)
 
     def get_user_files(self, user: str):
         return [
@@ -257,89 +505,176 @@ class FileManager(metaclass=Singleton):
         ]
 
     def get_shared_files(self, username):
-        return [f for f in self.ordered_files if self.is_allowed(f, username, False)]
+        return list(self.iter_shared_files(username))
+
+    def iter_shared_files(self, username):
+        """Files the user can see (without the admin rights), by date"""
+        visible = self.shares.visible(username)
+        if len(visible) * 8 < len(self.ordered_files):
+            # Few files, sort them instead of reading the whole list
+            try:
+                files = sorted(
+                    visible, key=lambda f: self.index[f]["date"], reverse=True
+                )
+            except (KeyError, TypeError):
+                files = [f for f in list(self.ordered_files) if f in visible]
+        else:
+            # Iterate over a copy so that the generator survives concurrent changes
+            files = [f for f in list(self.ordered_files) if f in visible]
+        for f_id in files:
+            # The file may have been removed or modified meanwhile
+            if self.is_allowed(f_id, username, False):
+                yield f_id
+
+
+def list_files(f_ids, **header):
+    """Build a listing response for the given ids (consumed lazily), the
+    `header` values are sent with the message.
+
+    The encoding is negotiated with the Accept header or the "format" argument:
+    - application/json: {"files": [{<SHARED_KEYS>}, ...]}
+    - application/x-ndjson: the message, then one file per line
+    - application/vnd.photosync.columnar+json (or ?format=columnar):
+      {"keys": SHARED_KEYS, "files": [[<values in keys order>], ...],
+      "tables": {<key>: [<values>]}} where TABLE_KEYS are indexes in their table
+    """
+    fm = FileManager()
+    infos = (info for info in map(fm.index.get, f_ids) if info is not None)
+
+    columnar = request.args.get("format") == "columnar" or (
+        request.accept_mimetypes.best_match(["application/json", COLUMNAR_MIMETYPE])
+        == COLUMNAR_MIMETYPE
+    )
+    if not columnar:
+        return stream_json(
+            {"message": "OK", **header},
+            "files",
+            ({k: info[k] for k in SHARED_KEYS} for info in infos),
+        )
+
+    tables = {k: {} for k in TABLE_KEYS}
+
+    def row(info):
+        return [
+            tables[k].setdefault(info[k], len(tables[k])) if k in tables else info[k]
+            for k in SHARED_KEYS
+        ]
+
+    return stream_json(
+        {"message": "OK", **header, "keys": SHARED_KEYS},
+        "files",
+        map(row, infos),
+        trailer=lambda: {"tables": {k: list(v) for k, v in tables.items()}},
+        mimetype=COLUMNAR_MIMETYPE,
+    )
 
 
 @bp.route("/upgrade-index", methods=["PATCH"])
 @require_admin
 def upgrade_index():
+    """Rebuild the index in a background job"""
+    return submit_job("upgrade-index")
+
+
+@register_job("upgrade-index")
+def upgrade_index_job(job: Job) -> dict:
+    """Rebuild the whole index. The new index is built aside, in
+    <index>.upgrade which is also the checkpoint of the job, and replaces the
+    index at once at the end: the job can be cancelled until then"""
     print("Upgrading index")
 
     begin = timer()
 
     fm = FileManager()
     config = ConfigFile()
-
+    side = SharedFile(config.index + ".upgrade")
+
+    # Entries of the new index by path, the ids are given at the end
+    scanned = side.load({}) if job.checkpoint.get("scanned") else {}
+    paths = [
+        path
+        for path in sorted(scan_tree(fm.path, config.scan_workers))
+        if path not in scanned
+    ]
+    done = len(scanned)
+    job.progress(done, done + len(paths))
+    for i, path in enumerate(paths, 1):
+        result = fm.get_file_info(path, force_update=True)
+        if result and result[1] is not None:
+            scanned[path] = result[0]
+        if i % config.job_batch_size == 0:
+            side.save(scanned)
+            job.save_checkpoint(scanned=len(scanned))
+        job.progress(done + i)
+
+    with fm.transaction():
+        shutil.copy(config.index, config.index + ".bak")
+        result = _upgrade_index(fm, scanned)
+    if os.path.exists(side.path):
+        os.remove(side.path)
+    return {**result, "elapsed_time_ms": (timer() - begin) * 1000}
+
+
+def _upgrade_index(fm: FileManager, scanned: dict) -> dict:
+    """Replace the index by the `scanned` entries, keeping the ids and the
+    values of the current ones (call it in a transaction)"""
     # Stats
     entries_modified = 0
     fields_dropped = set()
     entries_dropped = 0
 
-    # Read the index
-    fm.load_index()
-    index = fm.get_all_infos().copy()
-
-    # Save the name-id matchings
-    path_id = {v["path"]: k for k, v in index.items()}
-
-    # Clear the index
-    fm.index = {}
-    shutil.copy(config.index, config.index + ".bak")
-    try:
-        with open(config.index, "w") as f:
-            json.dump({}, f)
-        fm.known_files = set()
-        fm.odered_files = []
-
-        # Repopulate the index
-        fm.populate_index(force_update=True, path_id=path_id)
-
-        # Merge the old index with the new one
-        for f_id in index:
-            if f_id in fm.index:
-                # The file is still here, we can merge the data
-                for k in index[f_id]:
-                    if k in fm.index[f_id]:
-                        t = type(fm.index[f_id][k])
-                        if fm.index[f_id][k] != index[f_id][k]:
-                            fm.index[f_id][k] = t(index[f_id][k])
-                            entries_modified += 1
-                        # Convert the type if possible
-                        try:
-                            fm.index[f_id][k] = t(fm.index[f_id][k])
-                        except:
-                            pass
-                    else:
-                        if not k in fields_dropped:
-                            print("Dropping field :", k)
-                        fields_dropped.add(k)
-
+    index = {}
+    next_id = fm.next_id()
+    for path, info in scanned.items():
+        f_id = fm.paths.get(path)
+        if f_id is None:
+            # New file
+            info["id"] = next_id
+            next_id += 1
+            index[str(info["id"])] = info
+            continue
+
+        # The file is still here, we can merge the data
+        index[f_id] = info
+        for k, value in fm.index[f_id].items():
+            if k in info:
+                t = type(info[k])
+                if info[k] != value:
+                    info[k] = t(value)
+                    entries_modified += 1
+                # Convert the type if possible
+                try:
+                    info[k] = t(info[k])
+                except:
+                    pass
             else:
-                # The file was removed, we can't merge the data
-                entries_dropped += 1
-                print("Dropping entry :", f_id)
-                pass
-
-        # Save the index
-        with open(config.index, "w") as f:
-            json.dump(fm.index, f)
-        fm.update_order()
-
-        return {
-            "message": "OK",
-            "entries_modified": entries_modified,
-            "fields_dropped": list(fields_dropped),
-            "entries_dropped": entries_dropped,
-            "elapsed_time_ms": (timer() - begin) * 1000,
-        }
-    except Exception as e:
-        import traceback
+                if not k in fields_dropped:
+                    print("Dropping field :", k)
+                fields_dropped.add(k)
+
+    for f_id, info in fm.index.items():
+        if f_id in index:
+            continue
+        if info["path"] not in scanned and os.path.exists(
+            fm.get_file_path(info["path"])
+        ):
+            # Added during the scan
+            index[f_id] = info
+        else:
+            # The file was removed, we can't merge the data
+            entries_dropped += 1
+            print("Dropping entry :", f_id)
 
-        # Restore index in case of failure
-        shutil.move(config.index + ".bak", config.index)
+    fm.index = index
+    fm.known_files = {info["path"] for info in index.values()}
+    fm.update_order()
 
-        print(traceback.format_exc())
-        return {"message": "Fatal error : \n" + traceback.format_exc()}
+    return {
+        "message": "OK",
+        "entries_modified": entries_modified,
+        "fields_dropped": list(fields_dropped),
+        "entries_dropped": entries_dropped,
+    }
 
 
 @bp.route("/get-by/<string:attribute>/<path:value>")
@@ -365,20 +700,13 @@ def get_by_attribute(attribute, value):
             return {"message": "File not found"}, 404
         if not fm.is_allowed(value, user["username"]):
             return {"message": "You are not allowed to do that"}, 403
-        return {
-            "message": "OK",
-            "files": [{k: fm.index[value][k] for k in SHARED_KEYS}],
-        }
+        return list_files([value])
 
-    return {
-        "message": "OK",
-        "files": [
-            {k: fm.index[f_id][k] for k in SHARED_KEYS}
-            for f_id in fm.index
-            if fm.index[f_id][attribute] == value
-            and fm.is_allowed(f_id, user["username"])
-        ],
-    }
+    return list_files(
+        f_id
+        for f_id, info in list(fm.index.items())
+        if info[attribute] == value and fm.is_allowed(f_id, user["username"])
+    )
 
 
 @bp.route("/get-all")
@@ -386,7 +714,13 @@ def get_by_attribute(attribute, value):
 def get_all():
     # Return all files in the index
     fm = FileManager()
-    return {"message": "OK", "files": fm.get_all_infos()}
+    index = fm.get_all_infos()
+    return stream_json(
+        {"message": "OK"},
+        "files",
+        ((f_id, index[f_id]) for f_id in list(index) if f_id in index),
+        keyed=True,
+    )
 
 
 @bp.route("/file-list")
@@ -399,13 +733,7 @@ def get_file_list():
 
     user = account.get_user()
 
-    return {
-        "message": "OK",
-        "files": [
-            {k: fm.index[f_id][k] for k in SHARED_KEYS}
-            for f_id in fm.get_shared_files(user["username"])
-        ],
-    }
+    return list_files(fm.iter_shared_files(user["username"]))
 
 
 @bp.route("/page", methods=["POST"])
@@ -430,14 +758,7 @@ def get_file_list_page():
     user_files = fm.get_shared_files(user["username"])  # Already sorted by date
 
     # Build the list of files
-    result = user_files[page * page_size : (page + 1) * page_size]
-    # Only keep the right properties of the files
-    result = [{k: fm.index[f_id][k] for k in SHARED_KEYS} for f_id in result]
-
-    return {
-        "message": "OK",
-        "files": result,
-    }
+    return list_files(user_files[page * page_size : (page + 1) * page_size])
 
 
 @bp.route("/file-list/id/<string:last_id>/<int:count>")
@@ -460,16 +781,13 @@ def get_file_list_from(last_id, count):
 
     count = min(count, len(user_files) + last_index)
 
-    return {
-        "message": "OK",
-        "files": [
-            {k: fm.index[f_id][k] for k in SHARED_KEYS}
-            for f_id in user_files[
-                last_index if last_id == "null" else last_index + 1 : last_index + count
-            ]
-            if fm.index[f_id]["owner"] == user["username"]
-        ],
-    }
+    return list_files(
+        f_id
+        for f_id in user_files[
+            last_index if last_id == "null" else last_index + 1 : last_index + count
+        ]
+        if fm.index[f_id]["owner"] == user["username"]
+    )
 
 
 @bp.route("/file-list/before/<int:timestamp>/<int:count>")
@@ -490,16 +808,11 @@ def get_file_list_after(timestamp, count):
             break
         last_index += 1
 
-    count = min(count, len(user_files) + last_index)
-
-    return {
-        "message": "OK",
-        "files": [
-            {k: fm.index[f_id][k] for k in SHARED_KEYS}
-            for f_id in user_files[last_index + 1 : last_index + count]
-            if fm.index[f_id]["owner"] == user["username"]
-        ],
-    }
+    return list_files(
+        f_id
+        for f_id in user_files[last_index : last_index + count]
+        if fm.index[f_id]["owner"] == user["username"]
+    )
 
 
 @bp.route("/file-list/between/<int:timestamp1>/<int:timestamp2>/<int:count>")
@@ -522,40 +835,235 @@ def get_file_list_between(timestamp1, timestamp2, count):
 
     count = min(count, len(user_files) + last_index)
 
+    return list_files(
+        f_id
+        for f_id in user_files[last_index + 1 : last_index + count]
+        if fm.index[f_id]["owner"] == user["username"]
+        and fm.index[f_id]["date"] < timestamp2
+    )
+
+
+@bp.route("/timeline/<string:unit>")
+@require_login
+def get_timeline(unit: str):
+    """Number of files of the user per day, month or year, with the ids of
+    the newest ones. Admins can get the timeline of another user with ?user=
+    and ?offset= is the time zone of the client in minutes"""
+    if unit not in UNITS:
+        return {"message": "Invalid unit"}, 400
+    user = Accounts().get_user()
+    username = request.args.get("user", user["username"])
+    if username != user["username"] and not user.get("admin"):
+        return {"message": "Unauthorized"}, 401
+    offset = request.args.get("offset", 0, type=int)
+    if not OFFSET_RANGE[0] <= offset <= OFFSET_RANGE[1]:
+        # Each offset is cached, only the real time zones are accepted
+        return {"message": "Invalid offset"}, 400
+    samples = request.args.get("samples", ConfigFile().timeline_samples, type=int)
+    periods = FileManager().timeline.periods(
+        username, unit, offset, max(0, min(samples, 64))
+    )
+    return {"message": "OK", "unit": unit, "periods": periods}
+
+
+@bp.route("/search")
+@require_login
+def search_files():
+    """Files visible to the user matching the words of ?q= (prefixes too,
+    "field:word" for one field among tag, name, camera, format and meta),
+    the best first. ?after= and ?before= keep the files between two dates
+    (seconds), ?offset= and ?count= give a page"""
+    fm = FileManager()
+    username = Accounts().get_user()["username"]
+    query = request.args.get("q", "")
+    after = request.args.get("after", float("-inf"), type=float)
+    before = request.args.get("before", float("inf"), type=float)
+    offset = max(0, request.args.get("offset", 0, type=int))
+    count = request.args.get("count", 100, type=int)
+    if count <= 0:
+        return {"message": "Invalid count"}, 400
+
+    scores = fm.search.search(query)
+    if scores is None:
+        if "after" not in request.args and "before" not in request.args:
+            return {"message": "Empty query"}, 400
+        scores = dict.fromkeys(fm.shares.visible(username), 0)
+    results = []
+    for f_id, score in scores.items():
+        info = fm.index.get(f_id)
+        if info is None or not fm.is_allowed(f_id, username, False):
+            continue
+        try:
+            date = date_seconds(info["date"])
+        except (KeyError, TypeError, ValueError):
+            date = None
+        if date is None:
+            if "after" in request.args or "before" in request.args:
+                continue
+            date = float("-inf")
+        elif not after <= date < before:
+            continue
+        results.append((-score, -date, f_id))
+
+    page = [f_id for _, _, f_id in heapq.nsmallest(offset + count, results)]
+    page = page[offset:]
+    next_offset = offset + count if offset + count < len(results) else None
+    return list_files(page, total=len(results), next=next_offset)
+
+
+@bp.route("/changes/cursor")
+@require_login
+def get_changes_cursor():
+    """Return the cursor to use for the next /changes request.
+    Get it before downloading the full file list to avoid missing changes."""
+    return {"message": "OK", "cursor": ChangeDB().get_cursor()}
+
+
+@bp.route("/changes/<int:last_id>/<int:count>")
+@require_login
+def get_changes(last_id, count):
+    """Return the files that changed for the user since the given cursor.
+    Files that can't be seen anymore (deleted, new owner...) are in "removed",
+    the others in "updated". If "more" is true, call again with the new cursor.
+    A 410 status means that the history was compacted past the cursor."""
+    user = Accounts().get_user()
+    return collect_changes(user["username"], last_id, count)
+
+
+@bp.route("/changes/wait/<int:last_id>/<int:count>")
+@require_login
+def wait_changes(last_id, count):
+    """Long polling version of /changes: wait up to config.push_timeout
+    seconds for a change if there is none since the cursor. The waiting
+    request holds a thread, config.push_port serves it without (push.py)"""
+    user = Accounts().get_user()
+
+    with Notifier().subscribe(user["username"]) as event:
+        if event is None:
+            return {"message": "Too many waiting clients, use /changes"}, 503
+
+        deadline = time.time() + ConfigFile().push_timeout
+        while True:
+            result, status = collect_changes(user["username"], last_id, count)
+            remaining = deadline - time.time()
+            if status != 200 or result["cursor"] != last_id or remaining <= 0:
+                return result, status
+            event.wait(remaining)
+            event.clear()
+
+
+@bp.route("/changes/events")
+def change_events():
+    """Server-Sent Events stream of the changes ("changes" events with the
+    same data as /changes). The cursor is taken from the Last-Event-ID header
+    or the "cursor" argument. Since EventSource can't send headers, the token
+    can be given as the "token" argument.
+    The stream is closed after config.push_stream_lifetime seconds. It holds
+    a thread, config.push_port serves it without (push.py)"""
+    token = get_request_token() or request.args.get("token")
+    username = Accounts()._check_token(token)
+    if not username:
+        return {"message": "Unauthorized"}, 401
+    try:
+        last_id = int(
+            request.headers.get("Last-Event-ID", request.args.get("cursor", 0))
+        )
+    except ValueError:
+        return {"message": "Invalid cursor"}, 400
+
+    config = ConfigFile()
+
+    def generate(last_id):
+        with Notifier().subscribe(username) as event:
+            if event is None:
+                yield "event: busy\ndata: {}\n\n"
+                return
+            yield f"retry: {config.push_keepalive * 1000}\n\n"
+
+            deadline = time.time() + config.push_stream_lifetime
+            while time.time() < deadline:
+                result, status = collect_changes(
+                    username, last_id, config.push_batch_size
+                )
+                if status != 200:
+                    yield f"event: expired\ndata: {json.dumps(result)}\n\n"
+                    return
+                if result["cursor"] != last_id:
+                    last_id = result["cursor"]
+                    yield f"id: {last_id}\nevent: changes\ndata: {json.dumps(result)}\n\n"
+                    if result["more"]:
+                        continue
+                if not event.wait(min(config.push_keepalive, deadline - time.time())):
+                    yield ": keepalive\n\n"
+                event.clear()
+
+    return Response(
+        stream_with_context(generate(last_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def collect_changes(username: str, last_id: int, count: int):
+    """Build the /changes response for the user"""
+    fm = FileManager()
+
+    if last_id < ChangeDB().get_compacted():
+        # The history is not available anymore
+        return {"message": "Cursor expired, a full sync is required"}, 410
+    changes = ChangeDB().get_user_changes(username, last_id, count + 1)
+
+    more = len(changes) > count
+    changes = changes[:count]
+    cursor = changes[-1][0] if changes else last_id
+
+    # Only the last state of each file matters
+    updated = []
+    removed = []
+    for f_id in dict.fromkeys(str(f_id) for _, f_id in changes):
+        if fm.is_allowed(f_id, username, False):
+            updated.append({k: fm.index[f_id][k] for k in SHARED_KEYS})
+        else:
+            removed.append(f_id)
+
     return {
         "message": "OK",
-        "files": [
-            {k: fm.index[f_id][k] for k in SHARED_KEYS}
-            for f_id in user_files[last_index + 1 : last_index + count]
-            if fm.index[f_id]["owner"] == user["username"]
-            and fm.index[f_id]["date"] < timestamp2
-        ],
-    }
+        "cursor": cursor,
+        "more": more,
+        "updated": updated,
+        "removed": removed,
+    }, 200
 
 
 @bp.route("/reload", methods=["PATCH"])
 @require_admin
 def reload_index():
-    """Reindex the whole storage"""
-    try:
-        # Time the reload
-        start = timer()
-        fm = FileManager()
-        fm.populate_index()
-
-        # Remove files that are not in the storage anymore
-        for f_id in list(fm.index):
-            if not os.path.exists(fm.get_file_path(fm.index[f_id]["path"])):
-                name = fm.index[f_id]["path"]
-                del fm.index[f_id]
-                if name in fm.known_files:
-                    fm.known_files.remove(name)
-        fm.save_index()
-        end = timer()
-    except Exception as e:
-        raise
-        return {"message": e.args}, 500
-    return {"message": "OK", "elapsed": (end - start) * 1000}, 200
+    """Reindex the whole storage in a background job"""
+    return submit_job("reindex")
+
+
+@register_job("reindex")
+def reindex_job(job: Job) -> dict:
+    """Index the new files, read the modified ones again and remove the
+    entries whose file is gone. The index is saved after each batch of
+    job_batch_size files, an interrupted job starts again from the last one"""
+    fm = FileManager()
+    batch_size = ConfigFile().job_batch_size
+    start = timer()
+
+    # The files done before an interruption are not in the plan anymore
+    actions = fm.plan_reconcile()
+    counts = job.checkpoint.get("counts", {"added": 0, "removed": 0, "modified": 0})
+    job.progress(0, len(actions))
+    for i in range(0, len(actions), batch_size):
+        with fm.transaction():
+            done = fm.apply_reconcile(actions[i : i + batch_size])
+        for key, count in done.items():
+            counts[key] += count
+        job.progress(min(i + batch_size, len(actions)))
+        job.save_checkpoint(counts=counts)
+
+    return {"message": "OK", "elapsed": (timer() - start) * 1000, **counts}
 
 
 @bp.route("/refesh-index", methods=["PATCH"])
@@ -563,10 +1071,11 @@ def reload_index():
 def refresh_index():
     """Read the index file and update the index (does not reindex the whole storage)"""
     fm = FileManager()
-    fm.load_index()
-    fm.known_files.clear()
-    for f_id in fm.index:
-        fm.known_files.add(fm.index[f_id]["path"])
+    with fm.store.lock():
+        fm.load_index()
+        fm.known_files.clear()
+        for f_id in fm.index:
+            fm.known_files.add(fm.index[f_id]["path"])
     return {"message": "OK"}, 200
 
 
@@ -584,8 +1093,10 @@ def download_file(f_id: int):
     if not fm.is_allowed(f_id, user["username"]):
         return {"message": "You are not allowed to do that"}, 403
 
-    return send_file(
+    return send_stored_file(
         fm.get_file_path(fm.index[f_id]["path"]),
+        fm.path,
+        ConfigFile().sendfile_storage_prefix,
         as_attachment=True,
         download_name=fm.index[f_id]["path"],
         last_modified=fm.index[f_id]["date"] // 1000,  # Convert to seconds
@@ -650,8 +1161,10 @@ def upload_file():
         except ValueError:
             pass  # Use the guessed date
     f_info["owner"] = username
-    fm.index[f_id] = f_info
-    fm.save_index()
+    with fm.transaction():
+        # The id is only reserved once the index is locked
+        f_id = f_info["id"] = fm.next_id()
+        fm.add_entry(f_info)
     ChangeDB().add_change(f_info)
     return {"message": "OK", "id": f_id}, 200
 
@@ -659,9 +1172,10 @@ def upload_file():
 @bp.route("/delete/<string:f_id>", methods=["DELETE"])
 @require_login
 def delete_file(f_id: int):
+    from .trash import TrashStore, remove_thumbnails
+
     fm = FileManager()
     account = Accounts()
-    trash = ConfigFile().trash_folder
 
     user = account.get_user()
 
@@ -671,27 +1185,99 @@ def delete_file(f_id: int):
     if not fm.is_allowed(f_id, user["username"]):
         return {"message": "You are not allowed to do that"}, 403
 
-    # Move the file to the trash folder (create a folder for the user)
-    if not os.path.exists(os.path.join(trash, user["username"])):
-        os.makedirs(os.path.join(trash, user["username"]))
+    with fm.transaction():
+        if f_id not in fm.index:
+            return {"message": "File not found"}, 404
 
-    trash_file = os.path.join(
-        trash, user["username"], os.path.basename(fm.index[f_id]["path"])
-    )
-    if os.path.exists(trash_file):
-        trash_file = os.path.join(
-            trash,
-            user["username"],
-            f_id + "_" + os.path.basename(fm.index[f_id]["path"]),
-        )
-    os.rename(
-        fm.get_file_path(fm.index[f_id]["path"]),
-        trash_file,
-    )
-    ChangeDB().add_change(fm.index[f_id])
-    del fm.index[f_id]
-    fm.ordered_files.remove(f_id)
-    fm.save_index()
+        # Move the file to the trash folder of the user, it can be restored
+        trash_id = TrashStore().trash(fm, f_id, user["username"])
+    remove_thumbnails([f_id])
+
+    return {"message": "OK", "trash_id": trash_id}, 200
+
+
+def check_files(fm: FileManager, files, username: str, owner_only: bool = False):
+    """Error response if a file of the list does not exist or is not allowed
+    to the user (only to its owner and the admins with owner_only), else None"""
+    if not isinstance(files, list):
+        return {"message": "Invalid file list"}, 400
+    admin = Accounts().is_admin(username)
+    for f_id in files:
+        if f_id not in fm.index:
+            return {"message": f"File not found ({f_id})"}, 404
+        if owner_only:
+            allowed = admin or fm.index[f_id]["owner"] == username
+        else:
+            allowed = fm.is_allowed(f_id, username)
+        if not allowed:
+            return {"message": f"You are not allowed to do that ({f_id})"}, 403
+    return None
+
+
+@bp.route("/delete", methods=["POST"])
+@require_login
+def delete_files():
+    """Move the files {"files": [...]} to the trash. Every file is checked
+    first, then the index is saved and the changes recorded once"""
+    from .trash import TrashStore, remove_thumbnails
+
+    fm = FileManager()
+    username = Accounts().get_user()["username"]
+    values = request_lists("files", default=[])
+    if isinstance(values, tuple):
+        return values
+    files = list(dict.fromkeys(values[0]))
+
+    error = check_files(fm, files, username)
+    if error:
+        return error
+
+    with ChangeDB().batch(), fm.transaction():
+        # The index may have been modified by another process
+        error = check_files(fm, files, username)
+        if error:
+            return error
+        trash_ids = TrashStore().trash_files(fm, files, username)
+    remove_thumbnails(files)
+
+    return {"message": "OK", "trash_ids": dict(zip(files, trash_ids))}, 200
+
+
+@bp.route("/rights", methods=["PATCH"])
+@require_login
+def set_rights():
+    """Share the files {"files": [...]} with the users of "grant" and stop
+    sharing them with the users of "revoke" ("public" for everyone). Only
+    the owner of a file and the admins can change its rights"""
+    fm = FileManager()
+    account = Accounts()
+    username = account.get_user()["username"]
+    values = request_lists("files", "grant", "revoke", default=[])
+    if isinstance(values, tuple):
+        return values
+    files, grant, revoke = values
+
+    accounts = account._get_accounts()
+    for name in grant + revoke:
+        if name != "public" and name not in accounts:
+            return {"message": f"User not found ({name})"}, 404
+
+    error = check_files(fm, files, username, owner_only=True)
+    if error:
+        return error
+
+    with ChangeDB().batch(), fm.transaction():
+        error = check_files(fm, files, username, owner_only=True)
+        if error:
+            return error
+        for f_id in files:
+            info = fm.index[f_id]
+            removed = [name for name in revoke if name in info["rights"]]
+            info["rights"] = [name for name in info["rights"] if name not in revoke]
+            info["rights"] += [name for name in grant if name not in info["rights"]]
+            fm.shares.add(f_id, info)
+            # The users who lost the file must be notified too
+            ChangeDB().add_change(info, *removed)
 
     return {"message": "OK"}, 200
 
@@ -708,27 +1294,33 @@ def set_owner():
     owner = data["owner"]
     files = data["files"]
 
-    for f_id in files:
-        # Check all the requirements (file exists, user exists, user is admin or owner of the file)
-        if f_id not in fm.index:
-            return {"message": "File not found"}, 404
-        if not fm.is_allowed(f_id, user["username"]):
-            return {"message": "You are not allowed to do that"}, 403
+    # Check all the requirements (file exists, user exists, user is admin or owner of the file)
+    error = check_files(fm, files, user["username"])
+    if error:
+        return error
 
     if owner not in account._get_accounts():
         return {"message": "User not found"}, 404
 
-    for f_id in files:
-        # Set the new owner
-        fm.index[f_id]["owner"] = owner
-
-        # Prevent the owner from being removed from the allowed list
-        if owner not in fm.index[f_id]["rights"] and user["username"] != "<index>":
-            fm.index[f_id]["rights"].append(user["username"])
-
-        ChangeDB().add_change(fm.index[f_id])
-
-    # Save the index
-    fm.save_index()
+    # The index is saved and the changes are recorded at the end
+    with ChangeDB().batch(), fm.transaction():
+        error = check_files(fm, files, user["username"])
+        if error:
+            return error
+
+        for f_id in files:
+            # Set the new owner
+            previous_owner = fm.index[f_id]["owner"]
+            fm.timeline.remove(f_id, fm.index[f_id])
+            fm.index[f_id]["owner"] = owner
+            fm.timeline.add(f_id, fm.index[f_id])
+
+            # Prevent the owner from being removed from the allowed list
+            if owner not in fm.index[f_id]["rights"] and user["username"] != "<index>":
+                fm.index[f_id]["rights"].append(user["username"])
+            fm.shares.add(f_id, fm.index[f_id])
+
+            # The previous owner must be notified that the file is not theirs anymore
+            ChangeDB().add_change(fm.index[f_id], previous_owner)
 
     return {"message": "OK"}, 200
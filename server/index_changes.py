@@ -1,5 +1,8 @@
 from .utils import Singleton
 from .configuration import ConfigFile
+import atexit
+import contextlib
+import threading
 import time
 import sqlite3
 
@@ -20,12 +23,33 @@ class ChangeDB(metaclass=Singleton):
     - user: the user affected by the change
 
     The tables are created if they don't exist.
+
+    The database is in WAL mode: every thread reads with its own connection
+    while a single connection (protected by a lock) writes. Changes are
+    buffered and committed in groups, either when config.history_batch_size
+    changes are pending or config.history_commit_delay seconds after the
+    first one. Reads commit the pending changes first.
+
+    Changes older than config.history_retention seconds, or beyond the last
+    config.history_max_changes ones, are removed by compact().
+
+    Functions in `listeners` are called after each commit with the list of
+    (change id, set of affected users) that were committed.
     """
 
     def __init__(self) -> None:
-        self.db = sqlite3.connect(
-            ConfigFile().history_database, check_same_thread=False
-        )
+        self.config = ConfigFile()
+        self.path = self.config.history_database
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.pending = []
+        self.timer = None
+        self.batch_depth = 0
+        self.last_compaction = 0
+        self.listeners = []
+
+        self.db = self._connect()
+        self.db.execute("PRAGMA journal_mode=WAL")
         self.db.execute(
             "CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY AUTOINCREMENT, user VARCHAR(16), date INTEGER)"
         )
@@ -35,36 +59,165 @@ class ChangeDB(metaclass=Singleton):
         self.db.execute(
             "CREATE TABLE IF NOT EXISTS users (id INTEGER, user VARCHAR(16))"
         )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key VARCHAR(16) PRIMARY KEY, value INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS changes_user ON changes (user, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS changes_date ON changes (date)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_id ON files (id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS users_user ON users (user, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS users_id ON users (id)")
         self.db.commit()
 
-    def add_change(self, file_infos: dict) -> None:
-        self._add_change(file_infos["id"], file_infos["owner"], file_infos["rights"])
+        self.compact()
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _reader(self) -> sqlite3.Connection:
+        """Return the connection of the current thread, after committing the
+        pending changes so that they are visible"""
+        self.flush()
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = self._connect()
+        return db
+
+    def add_change(self, file_infos: dict, *users: str) -> None:
+        """Record a change of the file, `users` are affected too (e.g. a previous owner)"""
+        self._add_change(
+            file_infos["id"],
+            file_infos["owner"],
+            list(file_infos["rights"]) + list(users),
+        )
 
     def _add_change(self, file_id: str, user: str, users: list) -> None:
         """
-        Add a change to the database.
+        Add a change to the database (committed with the next group).
         """
-        cursor = self.db.cursor()
-        date = int(time.time())
-        cursor.execute("INSERT INTO changes (user, date) VALUES (?, ?)", (user, date))
-        change_id = cursor.lastrowid
-        cursor.execute(
-            "INSERT INTO files (id, file) VALUES (?, ?)", (change_id, file_id)
-        )
-        for user in users:
-            cursor.execute(
-                "INSERT INTO users (id, user) VALUES (?, ?)", (change_id, user)
-            )
-        self.db.commit()
+        with self.lock:
+            self.pending.append((user, int(time.time()), file_id, users))
+            if self.batch_depth:
+                return
+            if len(self.pending) >= self.config.history_batch_size:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(
+                    self.config.history_commit_delay, self.flush
+                )
+                self.timer.daemon = True
+                self.timer.start()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Commit all the changes added in this context at once"""
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.flush()
+
+    def flush(self) -> None:
+        """
+        Commit the pending changes in a single transaction.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, []
+
+            cursor = self.db.cursor()
+            committed = []
+            for user, date, file_id, users in pending:
+                cursor.execute(
+                    "INSERT INTO changes (user, date) VALUES (?, ?)", (user, date)
+                )
+                change_id = cursor.lastrowid
+                cursor.execute(
+                    "INSERT INTO files (id, file) VALUES (?, ?)", (change_id, file_id)
+                )
+                cursor.executemany(
+                    "INSERT INTO users (id, user) VALUES (?, ?)",
+                    [(change_id, u) for u in users],
+                )
+                committed.append((change_id, {user, *users}))
+            self.db.commit()
+
+            for listener in self.listeners:
+                try:
+                    listener(committed)
+                except Exception as e:
+                    print("Error in change listener :", e)
+
+            if (
+                time.time() - self.last_compaction
+                > self.config.history_compact_interval
+            ):
+                self.compact()
+
+    def compact(self) -> int:
+        """
+        Remove the changes that are too old or too many, return the id of the
+        last removed change (clients with an older cursor must do a full sync).
+        """
+        with self.lock:
+            self.last_compaction = time.time()
+            cursor = self.db.cursor()
+            last_removed = 0
+            if self.config.history_retention > 0:
+                cursor.execute(
+                    "SELECT MAX(id) FROM changes WHERE date < ?",
+                    (int(time.time()) - self.config.history_retention,),
+                )
+                last_removed = cursor.fetchone()[0] or 0
+            if self.config.history_max_changes > 0:
+                cursor.execute("SELECT MAX(id) FROM changes")
+                last_id = cursor.fetchone()[0] or 0
+                last_removed = max(
+                    last_removed, last_id - self.config.history_max_changes
+                )
+
+            if last_removed > self.get_compacted(cursor):
+                cursor.execute("DELETE FROM files WHERE id <= ?", (last_removed,))
+                cursor.execute("DELETE FROM users WHERE id <= ?", (last_removed,))
+                cursor.execute("DELETE FROM changes WHERE id <= ?", (last_removed,))
+                cursor.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted', ?)",
+                    (last_removed,),
+                )
+                self.db.commit()
+            return self.get_compacted(cursor)
+
+    def get_compacted(self, cursor: sqlite3.Cursor | None = None) -> int:
+        """
+        Return the id of the last change removed by compact() (0 if none).
+        """
+        if cursor is None:
+            cursor = self._reader().cursor()
+        cursor.execute("SELECT value FROM meta WHERE key = 'compacted'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
 
     def get_changes(self, user: str, since: int) -> list:
         """
         Return all the (unique) affected files id.
         """
-        cursor = self.db.cursor()
+        cursor = self._reader().cursor()
         cursor.execute(
-            "SELECT DISTINCT file FROM files WHERE id IN (SELECT id FROM users WHERE user = ? AND date > ?)",
-            (user, since),
+            "SELECT DISTINCT files.file FROM files JOIN changes ON changes.id = files.id "
+            "WHERE changes.date > ? AND (changes.user = ? OR changes.id IN "
+            "(SELECT id FROM users WHERE user = ?))",
+            (since, user, user),
         )
         return [row[0] for row in cursor.fetchall()]
 
@@ -72,17 +225,62 @@ class ChangeDB(metaclass=Singleton):
         """
         Return all the changes that happened after the given id.
         """
-        cursor = self.db.cursor()
+        cursor = self._reader().cursor()
         cursor.execute(
             "SELECT DISTINCT file FROM files WHERE id IN (SELECT id FROM changes WHERE id > ? AND user = ?)",
             (last_id, user),
         )
         return cursor.fetchall()
 
+    def get_user_changes(self, user: str, last_id: int, count: int) -> list:
+        """
+        Return the (change id, file id) of the changes that happened after the
+        given id and affect the user (as the owner, an allowed user or because
+        the file is public), ordered by change id.
+        """
+        cursor = self._reader().cursor()
+        # Each branch reads at most `count` ids from its index, the first
+        # `count` ids of the union are among them
+        cursor.execute(
+            "SELECT changes.id, files.file FROM changes JOIN files ON files.id = changes.id "
+            "WHERE changes.id IN ("
+            "SELECT id FROM (SELECT id FROM changes WHERE user = ? AND id > ? ORDER BY id LIMIT ?) "
+            "UNION SELECT id FROM (SELECT id FROM users WHERE user = ? AND id > ? ORDER BY id LIMIT ?) "
+            "UNION SELECT id FROM (SELECT id FROM users WHERE user = 'public' AND id > ? ORDER BY id LIMIT ?)) "
+            "ORDER BY changes.id LIMIT ?",
+            (user, last_id, count, user, last_id, count, last_id, count, count),
+        )
+        return cursor.fetchall()
+
+    def get_changes_after(self, last_id: int) -> list:
+        """
+        Return the (change id, set of affected users) of the changes that
+        happened after the given id, ordered by change id.
+        """
+        cursor = self._reader().cursor()
+        cursor.execute(
+            "SELECT changes.id, changes.user, users.user FROM changes "
+            "LEFT JOIN users ON users.id = changes.id WHERE changes.id > ? "
+            "ORDER BY changes.id",
+            (last_id,),
+        )
+        changes = {}
+        for change_id, owner, user in cursor.fetchall():
+            changes.setdefault(change_id, {owner}).add(user or owner)
+        return list(changes.items())
+
+    def get_cursor(self) -> int:
+        """
+        Return the id of the last change (0 if there is none).
+        """
+        cursor = self._reader().cursor()
+        cursor.execute("SELECT MAX(id) FROM changes")
+        return cursor.fetchone()[0] or 0
+
     def get_last_id(self, user: str) -> int:
         """
         Return the id of the last change for the given user.
         """
-        cursor = self.db.cursor()
+        cursor = self._reader().cursor()
         cursor.execute("SELECT MAX(id) FROM changes WHERE user = ?", (user,))
         return cursor.fetchone()[0]
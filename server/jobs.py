@@ -0,0 +1,291 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+
+from flask import Blueprint, request
+
+from .accounts import Accounts
+from .configuration import ConfigFile
+from .utils import Singleton, require_admin
+
+bp = Blueprint("jobs", __name__, url_prefix="/api/admin/jobs")
+
+# Job type -> function(job) returning the result (a dict)
+JOB_TYPES = {}
+
+ACTIVE = ("queued", "running")
+
+
+def register_job(name: str):
+    """Decorator registering the function running the jobs of type `name`"""
+
+    def decorator(func):
+        JOB_TYPES[name] = func
+        return func
+
+    return decorator
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """State of a job, stored in job_folder so that every process can read it
+    and that interrupted jobs are resumed at the next start.
+
+    The function of the job reports its progress with `progress` and saves
+    what it needs to resume in `checkpoint`, both check if the job was
+    cancelled.
+    """
+
+    def __init__(self, state: dict):
+        self.state = state
+        self.cancelled = threading.Event()
+        self.last_save = 0
+
+    @classmethod
+    def new(cls, job_type: str, params: dict, owner: str):
+        return cls(
+            {
+                "id": uuid.uuid4().hex,
+                "type": job_type,
+                "params": params,
+                "owner": owner,
+                "status": "queued",
+                "done": 0,
+                "total": None,
+                "checkpoint": {},
+                "result": None,
+                "error": None,
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+            }
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def id(self) -> str:
+        return self.state["id"]
+
+    @property
+    def params(self) -> dict:
+        return self.state["params"]
+
+    @property
+    def checkpoint(self) -> dict:
+        return self.state["checkpoint"]
+
+    def path(self, extension: str = "json") -> str:
+        return os.path.join(ConfigFile().job_folder, f"{self.id}.{extension}")
+
+    def save(self):
+        os.makedirs(ConfigFile().job_folder, exist_ok=True)
+        temp_path = self.path("tmp")
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path())
+        self.last_save = time.monotonic()
+
+    def cancel(self):
+        """Ask the job to stop, the process running it may be another one"""
+        self.cancelled.set()
+        open(self.path("cancel"), "w").close()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set() or os.path.exists(self.path("cancel")):
+            raise JobCancelled()
+
+    def progress(self, done: int, total: int | None = None):
+        self.state["done"] = done
+        if total is not None:
+            self.state["total"] = total
+        # The state is not written for every step
+        if time.monotonic() - self.last_save > 1:
+            self.save()
+        self.check_cancelled()
+
+    def save_checkpoint(self, **data):
+        self.state["checkpoint"].update(data)
+        self.save()
+        self.check_cancelled()
+
+
+class JobManager(metaclass=Singleton):
+    """Run the jobs in a pool of job_workers threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}  # Jobs of this process
+        self.futures = {}
+        self.executor = None
+        self.pid = None
+
+    def get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        # The threads are not copied in the forked workers
+        if self.pid != os.getpid():
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                ConfigFile().job_workers, thread_name_prefix="job"
+            )
+            self.pid = os.getpid()
+        return self.executor
+
+    def submit(self, job_type: str, params: dict, owner: str) -> Job:
+        """Queue a job, an active job of the same type with the same
+        parameters is returned instead of starting another one"""
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"Unknown job type : {job_type}")
+        with self.lock:
+            for job in self.list():
+                if (
+                    job.state["status"] in ACTIVE
+                    and job.state["type"] == job_type
+                    and job.params == params
+                ):
+                    return job
+            job = Job.new(job_type, params, owner)
+            job.save()
+            self.start(job)
+        remove_old_jobs()
+        return job
+
+    def start(self, job: Job):
+        self.jobs[job.id] = job
+        self.futures[job.id] = self.get_executor().submit(self.run, job)
+
+    def run(self, job: Job):
+        state = job.state
+        state["status"] = "running"
+        state["started"] = time.time()
+        try:
+            job.save()
+            job.check_cancelled()
+            state["result"] = JOB_TYPES[state["type"]](job)
+            state["status"] = "done"
+        except JobCancelled:
+            state["status"] = "cancelled"
+        except Exception as e:
+            print("Job", job.id, "failed :")
+            print(traceback.format_exc())
+            state["status"] = "failed"
+            state["error"] = repr(e)
+        state["finished"] = time.time()
+        job.save()
+        print(f"Job {state['type']} {job.id} {state['status']}")
+        with self.lock:
+            self.jobs.pop(job.id, None)
+            self.futures.pop(job.id, None)
+
+    def get(self, job_id: str) -> Job | None:
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        path = os.path.join(ConfigFile().job_folder, os.path.basename(job_id) + ".json")
+        try:
+            return Job.load(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def list(self) -> list:
+        """Jobs from the newest to the oldest"""
+        folder = ConfigFile().job_folder
+        if not os.path.isdir(folder):
+            return []
+        jobs = []
+        for entry in os.scandir(folder):
+            if entry.name.endswith(".json"):
+                job = self.get(entry.name[:-5])
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job.state["created"], reverse=True)
+
+    def cancel(self, job: Job):
+        future = self.futures.get(job.id)
+        if future is not None and future.cancel():
+            # It was still queued in this process
+            with self.lock:
+                self.jobs.pop(job.id, None)
+                self.futures.pop(job.id, None)
+            job.state["status"] = "cancelled"
+            job.state["finished"] = time.time()
+            job.save()
+            return
+        job.cancel()
+
+    def resume(self):
+        """Start again the jobs interrupted by the last stop of the server"""
+        with self.lock:
+            for job in self.list():
+                if job.state["status"] in ACTIVE and job.id not in self.jobs:
+                    print("Resuming job", job.state["type"], job.id)
+                    job.state["status"] = "queued"
+                    self.start(job)
+
+
+def remove_old_jobs():
+    finished = [job for job in JobManager().list() if job.state["status"] not in ACTIVE]
+    for job in finished[ConfigFile().job_max_files :]:
+        for extension in ("json", "cancel"):
+            try:
+                os.remove(job.path(extension))
+            except FileNotFoundError:
+                pass
+
+
+def submit_job(job_type: str, params: dict | None = None):
+    """Submit a job from a request, return the response"""
+    job = JobManager().submit(
+        job_type, params or {}, Accounts().get_user().get("username")
+    )
+    return {"message": "OK", "job": job.state}, 202
+
+
+@bp.route("/")
+@require_admin
+def get_jobs():
+    return {
+        "message": "OK",
+        "types": sorted(JOB_TYPES),
+        "jobs": [job.state for job in JobManager().list()],
+    }
+
+
+@bp.route("/<string:job_type>", methods=["POST"])
+@require_admin
+def post_job(job_type: str):
+    if job_type not in JOB_TYPES:
+        return {"message": "Unknown job type"}, 404
+    params = request.get_json(silent=True) or {}
+    if not isinstance(params, dict):
+        return {"message": "The parameters must be an object"}, 400
+    return submit_job(job_type, params)
+
+
+@bp.route("/<string:job_id>", methods=["GET"])
+@require_admin
+def get_job(job_id: str):
+    job = JobManager().get(job_id)
+    if job is None:
+        return {"message": "Job not found"}, 404
+    return {"message": "OK", "job": job.state}
+
+
+@bp.route("/<string:job_id>", methods=["DELETE"])
+@require_admin
+def cancel_job(job_id: str):
+    manager = JobManager()
+    job = manager.get(job_id)
+    if job is None:
+        return {"message": "Job not found"}, 404
+    if job.state["status"] not in ACTIVE:
+        return {"message": "The job is finished"}, 409
+    manager.cancel(job)
+    return {"message": "OK", "job": job.state}, 202
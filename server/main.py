@@ -2,12 +2,27 @@
 import logging
 import os
 
-from flask import Flask, redirect, send_from_directory, request
+from flask import Flask, redirect, request
 from flask_cors import CORS
 
 from .configuration import ConfigFile
 
-from . import accounts, file_manager, thumbnails
+from . import (
+    accounts,
+    albums,
+    compression,
+    file_manager,
+    index_changes,
+    jobs,
+    metrics,
+    perceptual,
+    profiling,
+    push,
+    thumbnails,
+    trash,
+    watcher,
+)
+from .utils import Singleton
 
 app = None
 
@@ -73,6 +88,14 @@ def main(config_file: str | None = None, run: bool = True):
                 restore(file)
             Singleton._instances[file_manager.FileManager] = None
             Singleton._instances[accounts.Accounts] = None
+            # The trash folder was restored, its database is emptied
+            Singleton._instances.pop(trash.TrashStore, None)
+            # The albums too, their files are the ones of the template
+            Singleton._instances.pop(albums.AlbumStore, None)
+            for database in (config.trash_database, config.album_database):
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(database + suffix):
+                        os.remove(database + suffix)
 
             fm = file_manager.FileManager(config)
             account_manager = accounts.Accounts(config)
@@ -82,11 +105,30 @@ def main(config_file: str | None = None, run: bool = True):
         fm = file_manager.FileManager(config)
         account_manager = accounts.Accounts(config)
 
+    if not (run and config.server_mode == "waitress" and config.workers > 1):
+        start_background_tasks(config)
+
     app = Flask(__name__)
 
     # Allow cross origin requests
     CORS(app, resources={r"*": {"origins": "*"}}, max_age=config.cache_time)
 
+    # Measure the time spent in each route
+    app.before_request(metrics.start_timer)
+    app.after_request(metrics.record_request)
+
+    # Compress the responses when the client supports it
+    app.after_request(compression.compress_response)
+
+    if config.shared_state:
+        # Get the modifications made by the other processes
+        app.before_request(lambda: file_manager.FileManager().sync())
+
+    # Profile the requests asked by the admins, and some random ones
+    app.before_request(profiling.start_profiler)
+    app.after_request(profiling.stop_profiler)
+    app.teardown_request(profiling.teardown_profiler)
+
     if config.ssl:
         context = (config.ssl_cert, config.ssl_key)
     else:
@@ -98,6 +140,12 @@ def main(config_file: str | None = None, run: bool = True):
     app.register_blueprint(file_manager.bp)
     app.register_blueprint(file_manager.fileio)
     app.register_blueprint(thumbnails.bp)
+    app.register_blueprint(metrics.bp)
+    app.register_blueprint(profiling.bp)
+    app.register_blueprint(jobs.bp)
+    app.register_blueprint(perceptual.bp)
+    app.register_blueprint(trash.bp)
+    app.register_blueprint(albums.bp)
     app.add_url_rule("/", "index", index_html)
 
     if os.getenv("PHOTOSYNC_TESTING", default=False):
@@ -107,11 +155,107 @@ def main(config_file: str | None = None, run: bool = True):
 
     if run:
         print("SSL:", config.ssl)
-        app.run(config.address, config.port, ssl_context=context, threaded=True)
+        serve(config, context)
     else:
         config.ssl = False
 
 
+def serve(config: ConfigFile, context: tuple | None):
+    match config.server_mode:
+        case "waitress":
+            # Waitress does the network I/O in an asynchronous loop: the worker
+            # threads only run the views. Files returned with send_file are
+            # written by the loop (wsgi.file_wrapper) and request bodies are
+            # buffered before the view is called, so slow clients don't hold
+            # a thread.
+            import waitress
+
+            if context is not None:
+                print("WARNING: waitress does not support SSL, use a reverse proxy")
+            options = dict(
+                threads=config.threads,
+                connection_limit=config.connection_limit,
+                channel_timeout=config.channel_timeout,
+                url_scheme="https" if config.ssl else "http",
+                ident="PhotoSync",
+            )
+            if config.workers > 1:
+                serve_workers(config, options)
+            else:
+                waitress.serve(app, host=config.address, port=config.port, **options)
+        case "development":
+            app.run(config.address, config.port, ssl_context=context, threaded=True)
+        case _:
+            raise ValueError(f"Unknown server_mode : {config.server_mode}")
+
+
+def serve_workers(config: ConfigFile, options: dict):
+    """Run config.workers waitress processes accepting on the same socket"""
+    import signal
+    import socket
+
+    import waitress
+
+    if not config.shared_state:
+        raise ValueError("Several workers can only be used with shared_state=true")
+
+    sock = socket.create_server((config.address, config.port), backlog=1024)
+    children = []
+    for _ in range(config.workers):
+        pid = os.fork()
+        if pid == 0:
+            # Database connections can't be shared with the parent
+            Singleton._instances.pop(index_changes.ChangeDB, None)
+            Singleton._instances.pop(trash.TrashStore, None)
+            Singleton._instances.pop(albums.AlbumStore, None)
+            # atexit does not run in the children (os._exit): stop waitress
+            # on SIGTERM, it lets the running requests finish, then commit
+            # the changes still waiting for the group commit
+            signal.signal(signal.SIGTERM, stop_worker)
+            signal.signal(signal.SIGINT, stop_worker)
+            try:
+                waitress.serve(app, sockets=[sock], **options)
+            finally:
+                db = Singleton._instances.get(index_changes.ChangeDB)
+                if db is not None:
+                    db.flush()
+                os._exit(0)
+        children.append(pid)
+    print(f"Started {len(children)} workers")
+
+    # The threads are not copied by fork: they run once, in this process
+    start_background_tasks(config)
+
+    def stop(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def start_background_tasks(config: ConfigFile):
+    """Start the threads of the server, in a single process"""
+    # Start again the jobs interrupted by the last stop
+    jobs.JobManager().resume()
+    trash.start_purge_timer()
+
+    if config.watch_storage:
+        # Index the files added, moved or removed directly in the storage
+        watcher.start_watcher(file_manager.FileManager())
+
+    if config.push_port:
+        # The connections waiting for changes don't hold the threads of waitress
+        push.start_push_server(config)
+
+
+def stop_worker(signum, frame):
+    # Stops the loop of waitress, which then waits for its threads
+    raise SystemExit(0)
+
+
 def index_html():
     return redirect("/index.html")
 
@@ -119,10 +263,6 @@ def index_html():
 def static_web(path):
     if path == "js/api.js":
         # Return the api.js file with the correct address
-        # Read the file
-        with open(os.path.join(ConfigFile().web_folder, path), "r") as f:
-            content = f.read()
-
         # Replace the address with the Origin
         if request.headers.get("Host", False):
             api_host = "{}://{}".format(
@@ -131,16 +271,25 @@ def static_web(path):
         else:
             api_host = "{protocol}://{host}:{port}".format(
                 protocol="https" if ConfigFile().ssl else "http",
-                host=ConfigFile().address
-                if ConfigFile().address != "0.0.0.0"
-                else "localhost",
+                host=(
+                    ConfigFile().address
+                    if ConfigFile().address != "0.0.0.0"
+                    else "localhost"
+                ),
                 port=ConfigFile().port,
             )
 
-        content = content.replace("${API_HOST}", api_host)
-        return content, 200, {"Content-Type": "text/javascript"}
-
-    return send_from_directory(ConfigFile().web_folder, path)
+        # The rendered file is cached for each address
+        return compression.StaticCache().respond(
+            ConfigFile().web_folder,
+            path,
+            key=(path, api_host),
+            render=lambda content: content.replace(
+                b"${API_HOST}", api_host.encode("utf-8")
+            ),
+        )
+
+    return compression.StaticCache().respond(ConfigFile().web_folder, path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,472 @@
+"""Metadata of the images and videos, read from their headers.
+
+Only the structures holding the metadata are read (JPEG segments up to the
+image data, PNG / WebP chunks, MP4 / MOV boxes), the pixels are never
+decoded. read_metadata returns a dict with the keys found among:
+
+- date: unix timestamp (EXIF dates are in local time, MP4 dates in UTC)
+- width, height: in pixels, as stored (before the orientation is applied)
+- orientation: EXIF orientation (1 to 8)
+- rotation: rotation of a video in degrees
+- gps: [latitude, longitude] or [latitude, longitude, altitude]
+- duration: of a video, in seconds
+- make, model: of the camera
+"""
+
+import datetime
+import os
+import re
+import struct
+
+# Maximum number of bytes read from the headers of a file
+MAX_HEADER_SIZE = 1 << 20
+
+# Seconds between 1904-01-01 (MP4 epoch) and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+
+# EXIF tags
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_ORIENTATION = 0x0112
+TAG_DATE_TIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_DATE_TIME_DIGITIZED = 0x9004
+TAG_PIXEL_WIDTH = 0xA002
+TAG_PIXEL_HEIGHT = 0xA003
+
+# Size of the TIFF types: byte, ascii, short, long, rational, sbyte,
+# undefined, sshort, slong, srational
+TIFF_TYPES = {
+    1: ("B", 1),
+    2: ("s", 1),
+    3: ("H", 2),
+    4: ("L", 4),
+    5: ("L", 8),
+    6: ("b", 1),
+    7: ("s", 1),
+    8: ("h", 2),
+    9: ("l", 4),
+    10: ("l", 8),
+}
+
+# JPEG markers of the frames, holding the size of the image
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE}
+
+MP4_EXTENSIONS = {".mp4", ".m4v", ".mov", ".3gp"}
+
+
+class MetadataError(Exception):
+    pass
+
+
+def exif_date(value: str) -> int | None:
+    """Convert an EXIF date (%Y:%m:%d %H:%M:%S) to a timestamp"""
+    try:
+        return int(
+            datetime.datetime.strptime(
+                value.replace("\x00", "").strip(), "%Y:%m:%d %H:%M:%S"
+            ).timestamp()
+        )
+    except ValueError:
+        return None
+
+
+def parse_tiff(data: bytes) -> dict:
+    """Parse the TIFF structure of EXIF data, return the metadata found"""
+    if data[:2] == b"II":
+        order = "<"
+    elif data[:2] == b"MM":
+        order = ">"
+    else:
+        raise MetadataError("Invalid TIFF header")
+
+    def read_ifd(offset: int) -> dict:
+        """Return {tag: value} of an IFD, values are tuples or strings"""
+        if offset + 2 > len(data):
+            return {}
+        (count,) = struct.unpack_from(order + "H", data, offset)
+        entries = {}
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            if entry + 12 > len(data):
+                break
+            tag, kind, n = struct.unpack_from(order + "HHL", data, entry)
+            if kind not in TIFF_TYPES:
+                continue
+            fmt, size = TIFF_TYPES[kind]
+            value_offset = entry + 8
+            if size * n > 4:
+                (value_offset,) = struct.unpack_from(order + "L", data, value_offset)
+            if value_offset + size * n > len(data):
+                continue
+            if fmt == "s":
+                value = data[value_offset : value_offset + n]
+                entries[tag] = value.split(b"\x00", 1)[0].decode("latin-1")
+            elif kind in (5, 10):
+                values = struct.unpack_from(f"{order}{2 * n}{fmt}", data, value_offset)
+                entries[tag] = tuple(
+                    a / b if b else 0.0 for a, b in zip(values[::2], values[1::2])
+                )
+            else:
+                entries[tag] = struct.unpack_from(
+                    f"{order}{n}{fmt}", data, value_offset
+                )
+        return entries
+
+    (first,) = struct.unpack_from(order + "L", data, 4)
+    ifd0 = read_ifd(first)
+    exif = read_ifd(ifd0[TAG_EXIF_IFD][0]) if TAG_EXIF_IFD in ifd0 else {}
+    gps = read_ifd(ifd0[TAG_GPS_IFD][0]) if TAG_GPS_IFD in ifd0 else {}
+
+    metadata = {}
+    # Same priority as get_exif_date
+    for value in (
+        exif.get(TAG_DATE_TIME_ORIGINAL),
+        exif.get(TAG_DATE_TIME_DIGITIZED),
+        ifd0.get(TAG_DATE_TIME),
+    ):
+        date = exif_date(value) if isinstance(value, str) else None
+        if date is not None:
+            metadata["date"] = date
+            break
+
+    if TAG_ORIENTATION in ifd0:
+        metadata["orientation"] = ifd0[TAG_ORIENTATION][0]
+    for tag, key in ((TAG_MAKE, "make"), (TAG_MODEL, "model")):
+        if isinstance(ifd0.get(tag), str) and ifd0[tag].strip():
+            metadata[key] = ifd0[tag].strip()
+    if TAG_PIXEL_WIDTH in exif and TAG_PIXEL_HEIGHT in exif:
+        metadata["width"] = exif[TAG_PIXEL_WIDTH][0]
+        metadata["height"] = exif[TAG_PIXEL_HEIGHT][0]
+
+    position = gps_position(gps)
+    if position is not None:
+        metadata["gps"] = position
+    return metadata
+
+
+def gps_position(gps: dict) -> list | None:
+    """[latitude, longitude(, altitude)] from the GPS IFD"""
+
+    def degrees(value, ref, negative):
+        if not isinstance(value, tuple) or len(value) != 3:
+            return None
+        d = value[0] + value[1] / 60 + value[2] / 3600
+        return -d if ref == negative else d
+
+    latitude = degrees(gps.get(2), gps.get(1), "S")
+    longitude = degrees(gps.get(4), gps.get(3), "W")
+    if latitude is None or longitude is None:
+        return None
+    position = [round(latitude, 7), round(longitude, 7)]
+    if isinstance(gps.get(6), tuple):
+        below = gps.get(5) == (1,) or gps.get(5) == "\x01"
+        position.append(round(-gps[6][0] if below else gps[6][0], 2))
+    return position
+
+
+def read_jpeg(f) -> dict:
+    metadata = {}
+    if f.read(2) != b"\xff\xd8":
+        raise MetadataError("Not a JPEG file")
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            break
+        marker = header[1]
+        if marker == 0xFF:
+            # Padding
+            f.seek(-3, os.SEEK_CUR)
+            continue
+        (length,) = struct.unpack(">H", header[2:])
+        if marker == 0xE1 and "date" not in metadata:
+            segment = f.read(length - 2)
+            if segment.startswith(b"Exif\x00\x00"):
+                exif = parse_tiff(segment[6:])
+                # The size of the frame is the real one
+                exif.pop("width", None)
+                exif.pop("height", None)
+                metadata.update(exif)
+            continue
+        if marker in JPEG_SOF:
+            height, width = struct.unpack(">xHH", f.read(5))
+            metadata["width"] = width
+            metadata["height"] = height
+            break
+        if marker == 0xDA:  # Start of scan, the image data follows
+            break
+        f.seek(length - 2, os.SEEK_CUR)
+    return metadata
+
+
+def read_png(f) -> dict:
+    metadata = {}
+    if f.read(8) != b"\x89PNG\r\n\x1a\n":
+        raise MetadataError("Not a PNG file")
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, kind = struct.unpack(">L4s", header)
+        if kind == b"IHDR":
+            metadata["width"], metadata["height"] = struct.unpack(">LL", f.read(8))
+            f.seek(length - 8 + 4, os.SEEK_CUR)
+        elif kind == b"eXIf":
+            exif = parse_tiff(f.read(length))
+            exif.pop("width", None)
+            exif.pop("height", None)
+            metadata.update(exif)
+            f.seek(4, os.SEEK_CUR)
+        elif kind in (b"IDAT", b"IEND"):
+            # eXIf must be before the image data
+            break
+        else:
+            f.seek(length + 4, os.SEEK_CUR)
+    return metadata
+
+
+def read_webp(f) -> dict:
+    metadata = {}
+    header = f.read(12)
+    if header[:4] != b"RIFF" or header[8:] != b"WEBP":
+        raise MetadataError("Not a WebP file")
+    while f.tell() < MAX_HEADER_SIZE:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        kind, length = struct.unpack("<4sL", chunk)
+        data = f.read(min(length, 30)) if kind != b"EXIF" else f.read(length)
+        if kind == b"VP8X":
+            metadata["width"] = int.from_bytes(data[4:7], "little") + 1
+            metadata["height"] = int.from_bytes(data[7:10], "little") + 1
+        elif kind == b"VP8 " and "width" not in metadata:
+            width, height = struct.unpack_from("<HH", data, 6)
+            metadata["width"] = width & 0x3FFF
+            metadata["height"] = height & 0x3FFF
+        elif kind == b"VP8L" and "width" not in metadata:
+            (bits,) = struct.unpack_from("<L", data, 1)
+            metadata["width"] = (bits & 0x3FFF) + 1
+            metadata["height"] = ((bits >> 14) & 0x3FFF) + 1
+        elif kind == b"EXIF":
+            if data.startswith(b"Exif\x00\x00"):
+                data = data[6:]
+            exif = parse_tiff(data)
+            exif.pop("width", None)
+            exif.pop("height", None)
+            metadata.update(exif)
+        # Chunks are padded to an even size
+        skip = length + (length & 1) - len(data)
+        f.seek(skip, os.SEEK_CUR)
+    return metadata
+
+
+def read_gif(f) -> dict:
+    header = f.read(10)
+    if header[:3] != b"GIF":
+        raise MetadataError("Not a GIF file")
+    width, height = struct.unpack_from("<HH", header, 6)
+    return {"width": width, "height": height}
+
+
+def iter_boxes(f, end: int):
+    """Yield (type, start of the content, end) of the ISO BMFF boxes until
+    `end`"""
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        header = f.read(8)
+        size, kind = struct.unpack(">L4s", header)
+        content = start + 8
+        if size == 1:  # 64 bits size
+            (size,) = struct.unpack(">Q", f.read(8))
+            content += 8
+        elif size == 0:  # Until the end of the file
+            size = end - start
+        if size < content - start:
+            break
+        box_end = min(start + size, end)
+        yield kind, content, box_end
+        f.seek(box_end)
+
+
+def read_mp4(f) -> dict:
+    metadata = {}
+    end = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    for kind, content, box_end in iter_boxes(f, end):
+        # moov is usually before or after mdat, which is skipped
+        if kind == b"moov":
+            read_moov(f, content, box_end, metadata)
+            break
+    return metadata
+
+
+def read_moov(f, start: int, end: int, metadata: dict):
+    if end - start > MAX_HEADER_SIZE * 16:
+        raise MetadataError("moov box too large")
+    f.seek(start)
+    for kind, content, box_end in iter_boxes(f, end):
+        if kind == b"mvhd":
+            data = f.read(min(box_end - content, 32))
+            if data[0] == 1:
+                created, _, timescale, duration = struct.unpack_from(">QQLQ", data, 4)
+            else:
+                created, _, timescale, duration = struct.unpack_from(">LLLL", data, 4)
+            if created > MP4_EPOCH_OFFSET:
+                metadata["date"] = created - MP4_EPOCH_OFFSET
+            if timescale:
+                metadata["duration"] = round(duration / timescale, 3)
+        elif kind == b"trak" and "width" not in metadata:
+            f.seek(content)
+            for sub, sub_content, sub_end in iter_boxes(f, box_end):
+                if sub == b"tkhd":
+                    read_tkhd(f.read(min(sub_end - sub_content, 104)), metadata)
+                    break
+        elif kind == b"udta":
+            f.seek(content)
+            for sub, sub_content, sub_end in iter_boxes(f, box_end):
+                if sub == b"\xa9xyz":
+                    position = parse_iso6709(f.read(min(sub_end - sub_content, 64)))
+                    if position is not None:
+                        metadata["gps"] = position
+                    break
+
+
+def read_tkhd(data: bytes, metadata: dict):
+    """Size and rotation of a track, audio tracks have a size of 0"""
+    offset = 4 + (32 if data[0] == 1 else 20) + 16
+    if len(data) < offset + 44:
+        return
+    matrix = struct.unpack_from(">9l", data, offset)
+    width, height = struct.unpack_from(">LL", data, offset + 36)
+    if width == 0 or height == 0:
+        return
+    metadata["width"] = width >> 16
+    metadata["height"] = height >> 16
+    a, b = matrix[0], matrix[1]
+    rotation = {(0, 1): 90, (-1, 0): 180, (0, -1): 270}.get(
+        (a and a // abs(a), b and b // abs(b)), 0
+    )
+    if rotation:
+        metadata["rotation"] = rotation
+
+
+def parse_iso6709(data: bytes) -> list | None:
+    """Position of the ©xyz box, like "+48.8584+002.2945+035.000/" """
+    # Content: size (2 bytes), language (2 bytes), then the text
+    text = data[4:].decode("latin-1", "ignore")
+    match = re.match(
+        r"([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)?", text
+    )
+    if match is None:
+        return None
+    position = [float(match.group(1)), float(match.group(2))]
+    if match.group(3):
+        position.append(float(match.group(3)))
+    return position
+
+
+def find_box(f, start: int, end: int, path: list) -> tuple | None:
+    """(start of the content, end) of the box at `path` (list of types)"""
+    for name in path:
+        f.seek(start)
+        for kind, content, box_end in iter_boxes(f, end):
+            if kind == name:
+                start, end = content, box_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def read_track_keyframes(f, start: int, end: int) -> tuple:
+    """(is a video track, keyframes) of a trak box"""
+    mdia = find_box(f, start, end, [b"mdia"])
+    if mdia is None:
+        return False, None
+    hdlr = find_box(f, *mdia, [b"hdlr"])
+    if hdlr is None or f.read(12)[8:] != b"vide":
+        return False, None
+
+    find_box(f, *mdia, [b"mdhd"])
+    data = f.read(32)
+    (timescale,) = struct.unpack_from(">L", data, 20 if data[0] == 1 else 12)
+    stbl = find_box(f, *mdia, [b"minf", b"stbl"])
+    if stbl is None or not timescale:
+        return True, None
+
+    stss = find_box(f, *stbl, [b"stss"])
+    if stss is None:
+        # All the frames are keyframes
+        return True, None
+    (count,) = struct.unpack(">4xL", f.read(8))
+    count = min(count, (stss[1] - stss[0] - 8) // 4)
+    sync_samples = struct.unpack(f">{count}L", f.read(count * 4))
+
+    stts = find_box(f, *stbl, [b"stts"])
+    if stts is None:
+        return True, None
+    (entries,) = struct.unpack(">4xL", f.read(8))
+    entries = min(entries, (stts[1] - stts[0] - 8) // 8)
+    durations = struct.unpack(f">{entries * 2}L", f.read(entries * 8))
+
+    # Time of each sync sample (numbered from 1), both lists are ordered
+    keyframes = []
+    sample = 1
+    time = 0
+    samples = iter(sync_samples)
+    target = next(samples, None)
+    for i in range(entries):
+        run, delta = durations[2 * i], durations[2 * i + 1]
+        while target is not None and target < sample + run:
+            seconds = (time + (target - sample) * delta) / timescale
+            keyframes.append((seconds, target - 1))
+            target = next(samples, None)
+        sample += run
+        time += run * delta
+    return True, keyframes
+
+
+def video_keyframes(path: str) -> list | None:
+    """(time in seconds, frame index) of the keyframes of the video track of
+    a MP4 / MOV file, None if they are unknown or if every frame is one"""
+    if os.path.splitext(path)[1].lower() not in MP4_EXTENSIONS:
+        return None
+    try:
+        with open(path, "rb") as f:
+            moov = find_box(f, 0, f.seek(0, os.SEEK_END), [b"moov"])
+            if moov is None:
+                return None
+            f.seek(moov[0])
+            for kind, content, box_end in iter_boxes(f, moov[1]):
+                if kind == b"trak":
+                    is_video, keyframes = read_track_keyframes(f, content, box_end)
+                    if is_video:
+                        return keyframes or None
+    except (struct.error, IndexError, OSError):
+        pass
+    return None
+
+
+READERS = {
+    ".jpg": read_jpeg,
+    ".jpeg": read_jpeg,
+    ".png": read_png,
+    ".webp": read_webp,
+    ".gif": read_gif,
+    **{extension: read_mp4 for extension in MP4_EXTENSIONS},
+}
+
+
+def read_metadata(path: str) -> dict:
+    """Metadata of the file, an empty dict if the format is not supported or
+    if the file is invalid"""
+    reader = READERS.get(os.path.splitext(path)[1].lower())
+    if reader is None:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            return reader(f)
+    except (MetadataError, struct.error, IndexError, OSError):
+        return {}
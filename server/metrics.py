@@ -0,0 +1,189 @@
+import bisect
+import contextlib
+import threading
+import time
+
+from flask import Blueprint, Response, g, request
+
+from .utils import Singleton, require_admin
+
+bp = Blueprint("metrics", __name__, url_prefix="/api/admin")
+
+# Upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    """Base class of the metrics, the values are stored for each tuple of
+    label values"""
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key: tuple, value) -> list:
+        return [f"{self.name}{format_labels(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        # Only the bucket of the value is incremented, they are summed when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket, +Inf, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render_value(self, key, value):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), value[:-1]):
+            total += count
+            labels = format_labels(self.labels, key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {total}")
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {value[-1]}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class Metrics(metaclass=Singleton):
+    """Metrics of this process, each worker process has its own"""
+
+    def __init__(self):
+        self.requests = Counter(
+            "photosync_requests_total",
+            "Requests handled",
+            ("route", "method", "status"),
+        )
+        self.request_duration = Histogram(
+            "photosync_request_duration_seconds",
+            "Time spent in the views, streamed bodies are not included",
+            ("route", "method"),
+        )
+        self.thumbnail_hits = Counter(
+            "photosync_thumbnail_cache_hits_total", "Thumbnails already generated"
+        )
+        self.thumbnail_misses = Counter(
+            "photosync_thumbnail_cache_misses_total", "Thumbnails to generate"
+        )
+        self.thumbnail_generation = Histogram(
+            "photosync_thumbnail_generation_seconds",
+            "Time to generate a thumbnail",
+            ("type",),
+        )
+        self.index_save = Histogram(
+            "photosync_index_save_seconds", "Time to save the index"
+        )
+        self.index_size = Gauge(
+            "photosync_index_size_bytes", "Size of the index file after the last save"
+        )
+        self.index_files = Gauge("photosync_index_files", "Files in the index")
+        self.token_reads = Counter(
+            "photosync_token_file_reads_total", "Reads of the authorization file"
+        )
+        self.hashed_bytes = Counter(
+            "photosync_hashed_bytes_total", "Bytes of the files hashed"
+        )
+        self.hash_duration = Counter(
+            "photosync_hash_seconds_total", "Time spent hashing the files"
+        )
+        self.all = [
+            self.requests,
+            self.request_duration,
+            self.thumbnail_hits,
+            self.thumbnail_misses,
+            self.thumbnail_generation,
+            self.index_save,
+            self.index_size,
+            self.index_files,
+            self.token_reads,
+            self.hashed_bytes,
+            self.hash_duration,
+        ]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.all:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def start_timer():
+    """before_request hook"""
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(response):
+    """after_request hook, requests are grouped by route to bound the labels"""
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "<unknown>"
+        metrics = Metrics()
+        metrics.request_duration.observe(
+            time.perf_counter() - start, route, request.method
+        )
+        metrics.requests.inc(1, route, request.method, response.status_code)
+    return response
+
+
+@bp.route("/metrics")
+@require_admin
+def get_metrics():
+    return Response(Metrics().render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,102 @@
+import contextlib
+import threading
+import time
+
+from .configuration import ConfigFile
+from .index_changes import ChangeDB
+from .utils import Singleton
+
+
+class Notifier(metaclass=Singleton):
+    """Wake up the connections waiting for the changes of a user.
+
+    A waiting connection only holds an Event: when a change affecting its
+    user is committed, the event is set and the connection reads the changes
+    from the ChangeDB with its own cursor. There is no queue per connection,
+    so the memory used by a connection does not depend on the changes.
+
+    A connection waiting in a Flask route holds a thread of the server: with
+    waitress, config.push_free_threads threads are always left to the other
+    requests (see max_waiters). The ones of the push server (config.push_port,
+    see push.py) only hold a coroutine, with an event set in its loop.
+
+    In shared_state mode, the changes committed by the other processes are
+    found by a single thread polling the ChangeDB.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}  # username -> set of events
+        self.count = 0
+        ChangeDB().listeners.append(self.publish)
+
+        if ConfigFile().shared_state:
+            poller = threading.Thread(target=self.poll, daemon=True)
+            poller.start()
+
+    def poll(self):
+        """Publish the changes made by the other processes"""
+        cursor = ChangeDB().get_cursor()
+        while True:
+            time.sleep(ConfigFile().push_poll_interval)
+            try:
+                changes = ChangeDB().get_changes_after(cursor)
+            except Exception as e:
+                print("Error while polling the changes :", e)
+                continue
+            if changes:
+                cursor = changes[-1][0]
+                # Local changes are published twice, waiters check their cursor
+                self.publish(changes)
+
+    def publish(self, changes: list):
+        """ChangeDB listener, `changes` is a list of (change id, users)"""
+        users = set()
+        for _, affected in changes:
+            users.update(affected)
+
+        with self.lock:
+            if "public" in users:
+                # Everyone can see public files
+                events = [e for waiters in self.waiters.values() for e in waiters]
+            else:
+                events = [e for u in users for e in self.waiters.get(u, ())]
+        for event in events:
+            event.set()
+
+    def max_waiters(self) -> int:
+        """config.push_max_waiters, lowered to keep config.push_free_threads
+        threads of waitress for the requests that don't wait"""
+        config = ConfigFile()
+        if config.server_mode != "waitress":
+            # Flask starts a thread per request
+            return config.push_max_waiters
+        return max(
+            0, min(config.push_max_waiters, config.threads - config.push_free_threads)
+        )
+
+    @contextlib.contextmanager
+    def subscribe(self, username: str, event=None):
+        """Yield an event set when a change affects the user, or None if too
+        many threads are already waiting. `event` (any object with a set()
+        method) is used instead of a threading.Event, its caller limits the
+        connections"""
+        thread = event is None
+        with self.lock:
+            if thread and self.count >= self.max_waiters():
+                event = None
+            else:
+                if thread:
+                    event = threading.Event()
+                    self.count += 1
+                self.waiters.setdefault(username, set()).add(event)
+        try:
+            yield event
+        finally:
+            if event is not None:
+                with self.lock:
+                    self.waiters[username].discard(event)
+                    if not self.waiters[username]:
+                        del self.waiters[username]
+                    if thread:
+                        self.count -= 1
@@ -0,0 +1,252 @@
+import numpy as np
+from flask import Blueprint, request
+from PIL import Image
+
+from .accounts import Accounts
+from .configuration import ConfigFile
+from .file_manager import FileManager
+from .jobs import Job, register_job
+from .utils import date_seconds, require_login
+
+bp = Blueprint("duplicates", __name__, url_prefix="/api/files")
+
+HASHES = ("ahash", "dhash", "phash")
+# Parts of the hashes in the MultiIndex
+CHUNKS = 4
+# Up to 1 bit flipped in each part: larger radiuses look up so many variants
+# of the parts that comparing every pair is faster
+MAX_RADIUS = 2 * CHUNKS - 1
+
+
+def dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix, dct(x) = M @ x"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_32 = dct_matrix(32)
+
+
+def pack_bits(bits: np.ndarray) -> str:
+    """64 booleans as 16 hexadecimal digits"""
+    return np.packbits(bits.flatten()).tobytes().hex()
+
+
+def image_hashes(im: Image.Image) -> dict:
+    """aHash, dHash and pHash (64 bits, in hexadecimal) of an image.
+
+    The image only needs to be a few times larger than 32x32 pixels, the
+    thumbnails or the images decoded with draft are enough.
+    """
+    gray = im.convert("L")
+    small = np.asarray(gray.resize((8, 8), Image.Resampling.BOX), dtype=np.float32)
+    gradient = np.asarray(gray.resize((9, 8), Image.Resampling.BOX), dtype=np.float32)
+    pixels = np.asarray(gray.resize((32, 32), Image.Resampling.BOX), dtype=np.float64)
+    # Lowest frequencies of the DCT, without the average (DC term)
+    frequencies = (DCT_32 @ pixels @ DCT_32.T)[:8, :8]
+    median = np.median(frequencies.flatten()[1:])
+    return {
+        "ahash": pack_bits(small > small.mean()),
+        "dhash": pack_bits(gradient[:, 1:] > gradient[:, :-1]),
+        "phash": pack_bits(frequencies > median),
+    }
+
+
+def distance(a: int, b: int) -> int:
+    """Hamming distance"""
+    return (a ^ b).bit_count()
+
+
+class MultiIndex:
+    """Multi-index hashing of 64 bits hashes for the Hamming distance.
+
+    The hashes are split in `chunks` parts, each part is a key of its own
+    table. Two hashes within `radius` have at least one part within
+    radius // chunks (pigeonhole principle): a search only looks up the
+    parts of the query with up to that many bits flipped, and compares the
+    few hashes found. A BK-tree visits most of its nodes with 64 bits
+    hashes, they are too evenly spread.
+    """
+
+    def __init__(self, radius: int, chunks: int = CHUNKS):
+        self.radius = radius
+        self.bits = 64 // chunks
+        self.mask = (1 << self.bits) - 1
+        self.shifts = [i * self.bits for i in range(chunks)]
+        # Lists are faster than dicts for 16 bits keys
+        self.tables = [[None] * (1 << self.bits) for _ in range(chunks)]
+        # Every part with up to radius // chunks bits flipped
+        self.flips = {0}
+        for _ in range(radius // chunks):
+            self.flips |= {f | 1 << bit for f in self.flips for bit in range(self.bits)}
+
+    def add(self, value: int, item):
+        for shift, table in zip(self.shifts, self.tables):
+            key = (value >> shift) & self.mask
+            if table[key] is None:
+                table[key] = []
+            table[key].append((value, item))
+
+    def search(self, value: int) -> list:
+        """Items whose hash is within the radius, as (distance, item)"""
+        results = []
+        seen = set()
+        for shift, table in zip(self.shifts, self.tables):
+            key = (value >> shift) & self.mask
+            for flip in self.flips:
+                bucket = table[key ^ flip]
+                if bucket is None:
+                    continue
+                for other, item in bucket:
+                    if item not in seen:
+                        seen.add(item)
+                        d = (value ^ other).bit_count()
+                        if d <= self.radius:
+                            results.append((d, item))
+        return results
+
+
+def duplicate_clusters(hashes: dict, radius: int) -> list:
+    """Group the items of {item: hash (int)} whose hashes are within
+    `radius` (transitively), return the groups of several items"""
+    # Union-find
+    parents = {item: item for item in hashes}
+
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    # Each pair is found once: the items are compared to the previous ones
+    index = MultiIndex(radius)
+    for item, value in hashes.items():
+        for _, other in index.search(value):
+            root, other_root = find(item), find(other)
+            if root != other_root:
+                parents[other_root] = root
+        index.add(value, item)
+
+    groups = {}
+    for item in hashes:
+        groups.setdefault(find(item), []).append(item)
+    clusters = [group for group in groups.values() if len(group) > 1]
+    return sorted(clusters, key=len, reverse=True)
+
+
+def burst_groups(files: list, interval: float, radius: int) -> list:
+    """Group the consecutive (date, item, hash) taken less than `interval`
+    seconds apart with hashes within `radius`"""
+    groups = []
+    current = []
+    for date, item, value in sorted(files, key=lambda f: f[0]):
+        if (
+            current
+            and date - current[-1][0] <= interval
+            and distance(value, current[-1][2]) <= radius
+        ):
+            current.append((date, item, value))
+            continue
+        if len(current) > 1:
+            groups.append([f[1] for f in current])
+        current = [(date, item, value)]
+    if len(current) > 1:
+        groups.append([f[1] for f in current])
+    return groups
+
+
+def radius_arg(default: int, limit: int = 64) -> int | tuple:
+    """The ?radius= of the request (`default`, at most `limit`, if there is
+    none), or an error response if it is above `limit`"""
+    radius = request.args.get("radius", min(default, limit), type=int)
+    if not 0 <= radius <= limit:
+        return {"message": f"Invalid radius (0 to {limit})"}, 400
+    return radius
+
+
+def user_hashes(kind: str) -> dict | tuple:
+    """{f_id: hash} of the files of the user (of ?user= for the admins), or
+    an error response"""
+    if kind not in HASHES:
+        return {"message": "Invalid hash"}, 400
+    user = Accounts().get_user()
+    username = request.args.get("user", user["username"])
+    if username != user["username"] and not user.get("admin"):
+        return {"message": "Unauthorized"}, 401
+    fm = FileManager()
+    hashes = {}
+    for f_id in fm.get_user_files(username):
+        value = fm.index[f_id].get("hashes", {}).get(kind)
+        if value is not None:
+            hashes[f_id] = int(value, 16)
+    return hashes
+
+
+@bp.route("/duplicates")
+@require_login
+def get_duplicates():
+    """Groups of visually identical files (resized, recompressed...)"""
+    config = ConfigFile()
+    radius = radius_arg(config.duplicate_radius, MAX_RADIUS)
+    if isinstance(radius, tuple):
+        return radius
+    hashes = user_hashes(request.args.get("hash", "phash"))
+    if isinstance(hashes, tuple):
+        return hashes
+    return {"message": "OK", "clusters": duplicate_clusters(hashes, radius)}
+
+
+@bp.route("/bursts")
+@require_login
+def get_bursts():
+    """Groups of similar photos taken in a few seconds"""
+    config = ConfigFile()
+    interval = request.args.get("interval", config.burst_interval, type=float)
+    radius = radius_arg(config.burst_radius)
+    if isinstance(radius, tuple):
+        return radius
+    hashes = user_hashes(request.args.get("hash", "dhash"))
+    if isinstance(hashes, tuple):
+        return hashes
+    fm = FileManager()
+    files = [
+        (date_seconds(fm.index[f_id]["date"]), f_id, value)
+        for f_id, value in hashes.items()
+        if fm.index[f_id]["type"] == "image"
+    ]
+    return {"message": "OK", "bursts": burst_groups(files, interval, radius)}
+
+
+@register_job("perceptual-hashes")
+def perceptual_hashes_job(job: Job) -> dict:
+    """Compute the perceptual hashes of the files indexed without them"""
+    from .thumbnails import analyze_file
+
+    fm = FileManager()
+    batch_size = ConfigFile().job_batch_size
+    f_ids = [
+        f_id
+        for f_id, info in fm.index.items()
+        if "hashes" not in info and info["type"] in ("image", "video")
+    ]
+    computed = job.checkpoint.get("computed", 0)
+    job.progress(0, len(f_ids))
+    for start in range(0, len(f_ids), batch_size):
+        results = {}
+        for f_id in f_ids[start : start + batch_size]:
+            path = fm.get_path_id(f_id)
+            if path is not None:
+                _, hashes = analyze_file(path, fm.index[f_id]["type"])
+                if hashes is not None:
+                    results[f_id] = hashes
+        with fm.transaction():
+            for f_id, hashes in results.items():
+                if f_id in fm.index:
+                    fm.index[f_id]["hashes"] = hashes
+                    computed += 1
+        job.progress(min(start + batch_size, len(f_ids)))
+        job.save_checkpoint(computed=computed)
+    return {"message": "OK", "computed": computed}
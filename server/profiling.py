@@ -0,0 +1,175 @@
+import collections
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+from flask import Blueprint, g, request, send_file
+
+from .configuration import ConfigFile
+from .utils import is_admin_request, require_admin
+
+bp = Blueprint("profiling", __name__, url_prefix="/api/admin/profiles")
+
+# Header used by the admins to profile a request, "sample" or "cprofile"
+PROFILE_HEADER = "X-Profile"
+
+
+class SamplingProfiler:
+    """Sample the stack of one thread from another thread.
+
+    The result is in the collapsed stack format ("root;caller;function count"
+    per line) used by flamegraph.pl, speedscope and most flame graph tools.
+    Only the sampling thread does work, the profiled thread is not slowed
+    down apart from the GIL switches.
+    """
+
+    extension = "folded"
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.sampler.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                location = f"{os.path.basename(code.co_filename)}:{frame.f_lineno}"
+                stack.append(f"{code.co_name} ({location})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class DeterministicProfiler:
+    """cProfile of the thread, saved in the pstats format (snakeviz, gprof2dot,
+    speedscope)"""
+
+    extension = "pstats"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def save(self, path: str):
+        self.profile.dump_stats(path)
+
+
+def start_profiler():
+    """before_request hook: profile the request if an admin asked for it or
+    if it is randomly selected (profile_sample_rate)"""
+    config = ConfigFile()
+    mode = request.headers.get(PROFILE_HEADER)
+    if mode is not None:
+        if not is_admin_request():
+            return
+    elif (
+        config.profile_sample_rate > 0 and random.random() < config.profile_sample_rate
+    ):
+        mode = "sample"
+    else:
+        return
+
+    if mode == "cprofile":
+        profiler = DeterministicProfiler()
+    else:
+        profiler = SamplingProfiler(config.profile_interval)
+    g.profiler = profiler
+    g.profile_start = time.perf_counter()
+    profiler.start()
+
+
+def stop_profiler(response):
+    """after_request hook: store the profile, its name is sent in the
+    X-Profile-Id header"""
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.stop()
+
+    config = ConfigFile()
+    os.makedirs(config.profile_folder, exist_ok=True)
+    elapsed_ms = int((time.perf_counter() - g.profile_start) * 1000)
+    endpoint = (request.endpoint or "unknown").replace(".", "-")
+    name = "{}_{}_{}ms_{}.{}".format(
+        int(time.time()), endpoint, elapsed_ms, uuid.uuid4().hex[:8], profiler.extension
+    )
+    profiler.save(os.path.join(config.profile_folder, name))
+    remove_old_profiles()
+
+    response.headers["X-Profile-Id"] = name
+    return response
+
+
+def teardown_profiler(exception=None):
+    """Stop the profiler if the request failed before after_request"""
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+def list_profiles() -> list:
+    """Profiles from the newest to the oldest"""
+    folder = ConfigFile().profile_folder
+    if not os.path.isdir(folder):
+        return []
+    return sorted(
+        (e for e in os.scandir(folder) if e.is_file()),
+        key=lambda e: e.stat().st_mtime,
+        reverse=True,
+    )
+
+
+def remove_old_profiles():
+    for entry in list_profiles()[ConfigFile().profile_max_files :]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+@bp.route("/")
+@require_admin
+def get_profiles():
+    return {
+        "message": "OK",
+        "profiles": [
+            {"name": e.name, "size": e.stat().st_size, "date": e.stat().st_mtime}
+            for e in list_profiles()
+        ],
+    }
+
+
+@bp.route("/<string:name>")
+@require_admin
+def get_profile(name: str):
+    path = os.path.join(ConfigFile().profile_folder, os.path.basename(name))
+    if not os.path.isfile(path):
+        return {"message": "Profile not found"}, 404
+    mimetype = "text/plain" if name.endswith(".folded") else "application/octet-stream"
+    return send_file(path, mimetype=mimetype, as_attachment=True)
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from .accounts import Accounts
+from .configuration import ConfigFile
+from .file_manager import FileManager, collect_changes
+from .notifications import Notifier
+
+WAIT_PATH = "/api/files/changes/wait/"
+EVENTS_PATH = "/api/files/changes/events"
+
+# Headers of a request, more is refused
+MAX_HEADERS = 64
+
+REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    410: "Gone",
+    503: "Service Unavailable",
+}
+
+
+class LoopEvent:
+    """Event of a connection of the loop, set by Notifier.publish from any
+    thread"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.event.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple | None:
+    """(method, path, query arguments, headers) of a request, None if the
+    connection is closed first. Raise ValueError if it is malformed"""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise ValueError("Too many headers")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    url = urlsplit(target)
+    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+    return method, url.path, query, headers
+
+
+class PushServer:
+    """Serve /changes/wait and /changes/events on config.push_port, in an
+    asyncio loop: a waiting connection is a coroutine and holds no thread,
+    the threads of the executor only read the changes.
+
+    The routes behave like the ones of the Flask app, one request per
+    connection. There can be config.push_max_waiters waiting connections.
+    """
+
+    def __init__(self, address: str, port: int):
+        self.config = ConfigFile()
+        self.address = address
+        self.port = port
+        self.count = 0  # Waiting connections
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+
+    def start(self):
+        """Serve in a new thread, return when the port is open"""
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),))
+        thread.daemon = True
+        thread.start()
+        self.started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, self.address, self.port)
+        # The port chosen by the system for 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def run_sync(self, func, *args):
+        """Run a blocking function in a thread of the executor"""
+        return await self.loop.run_in_executor(None, func, *args)
+
+    def collect(self, username: str, last_id: int, count: int) -> tuple:
+        if self.config.shared_state:
+            # Get the modifications made by the other processes
+            FileManager().sync()
+        return collect_changes(username, last_id, count)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(
+                read_request(reader), self.config.channel_timeout
+            )
+            if request is not None:
+                await self.route(writer, *request)
+        except (ValueError, asyncio.TimeoutError):
+            self.respond(writer, 400, {"message": "Invalid request"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method: str, path: str, query: dict, headers: dict):
+        if method == "OPTIONS":
+            # CORS preflight, the token is sent in a header
+            return self.respond(writer, 204, None)
+        if method != "GET":
+            return self.respond(writer, 405, {"message": "Method not allowed"})
+        if path.startswith(WAIT_PATH):
+            last_id, _, count = path[len(WAIT_PATH) :].partition("/")
+            if not (last_id.isdigit() and count.isdigit()):
+                return self.respond(writer, 404, {"message": "Not found"})
+        elif path != EVENTS_PATH:
+            return self.respond(writer, 404, {"message": "Not found"})
+
+        token = headers.get("token") or query.get("token")
+        username = await self.run_sync(Accounts()._check_token, token)
+        if not username:
+            return self.respond(writer, 401, {"message": "Unauthorized"})
+        if path == EVENTS_PATH:
+            try:
+                last_id = int(headers.get("last-event-id", query.get("cursor", 0)))
+            except ValueError:
+                return self.respond(writer, 400, {"message": "Invalid cursor"})
+            return await self.change_events(writer, username, last_id)
+        return await self.wait_changes(writer, username, int(last_id), int(count))
+
+    def respond(self, writer, status: int, data: dict | None):
+        body = b"" if data is None else json.dumps(data).encode()
+        headers = [
+            f"HTTP/1.1 {status} {REASONS[status]}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Access-Control-Allow-Origin: *",
+            "Access-Control-Allow-Headers: *",
+            "Access-Control-Allow-Methods: GET, OPTIONS",
+            "Connection: close",
+        ]
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.config.push_max_waiters
+
+    async def wait_changes(self, writer, username: str, last_id: int, count: int):
+        """Like file_manager.wait_changes"""
+        if self.full:
+            return self.respond(
+                writer, 503, {"message": "Too many waiting clients, use /changes"}
+            )
+        self.count += 1
+        try:
+            with Notifier().subscribe(username, LoopEvent(self.loop)) as event:
+                deadline = time.time() + self.config.push_timeout
+                while True:
+                    result, status = await self.run_sync(
+                        self.collect, username, last_id, count
+                    )
+                    remaining = deadline - time.time()
+                    if status != 200 or result["cursor"] != last_id or remaining <= 0:
+                        self.respond(writer, status, result)
+                        return await writer.drain()
+                    await event.wait(remaining)
+                    event.clear()
+        finally:
+            self.count -= 1
+
+    async def change_events(self, writer, username: str, last_id: int):
+        """Like file_manager.change_events"""
+        headers = [
+            "HTTP/1.1 200 OK",
+            "Content-Type: text/event-stream",
+            "Cache-Control: no-cache",
+            "X-Accel-Buffering: no",
+            "Access-Control-Allow-Origin: *",
+            "Connection: close",
+        ]
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+        if self.full:
+            writer.write(b"event: busy\ndata: {}\n\n")
+            return await writer.drain()
+        config = self.config
+        self.count += 1
+        try:
+            with Notifier().subscribe(username, LoopEvent(self.loop)) as event:
+                writer.write(f"retry: {config.push_keepalive * 1000}\n\n".encode())
+                await writer.drain()
+
+                deadline = time.time() + config.push_stream_lifetime
+                while time.time() < deadline:
+                    result, status = await self.run_sync(
+                        self.collect, username, last_id, config.push_batch_size
+                    )
+                    if status != 200:
+                        writer.write(
+                            f"event: expired\ndata: {json.dumps(result)}\n\n".encode()
+                        )
+                        return await writer.drain()
+                    if result["cursor"] != last_id:
+                        last_id = result["cursor"]
+                        writer.write(
+                            f"id: {last_id}\nevent: changes\ndata: {json.dumps(result)}\n\n".encode()
+                        )
+                        await writer.drain()
+                        if result["more"]:
+                            continue
+                    timeout = min(config.push_keepalive, deadline - time.time())
+                    if not await event.wait(timeout):
+                        writer.write(b": keepalive\n\n")
+                        await writer.drain()
+                    event.clear()
+        finally:
+            self.count -= 1
+
+
+def start_push_server(config: ConfigFile) -> PushServer:
+    """Serve the waiting connections on config.push_port"""
+    server = PushServer(config.address, config.push_port)
+    server.start()
+    print("Waiting connections served on port", server.port)
+    return server
@@ -0,0 +1,83 @@
+import concurrent.futures
+import os
+
+
+def scan_folder(path: str, rel_path: str) -> tuple:
+    """List a folder, return ({relative path: (size, mtime)}, [sub folders])"""
+    files = {}
+    folders = []
+    prefix = rel_path + os.sep if rel_path else ""
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = prefix + entry.name
+                try:
+                    # The type comes from the listing, the symbolic links to
+                    # folders are not followed (like os.walk)
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append((entry.path, rel))
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[rel] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # Removed during the scan
+                    continue
+    except OSError as e:
+        print("Could not scan", path, ":", e)
+    return files, folders
+
+
+def scan_tree(root: str, workers: int = 1) -> dict:
+    """Files under `root` with their size and modification time.
+
+    Each folder is listed with os.scandir, the sub folders are listed in
+    parallel by `workers` threads (the system calls release the GIL), 0 for
+    one thread per CPU (up to 8).
+    """
+    if workers == 0:
+        workers = min(8, os.cpu_count() or 1)
+    if workers <= 1:
+        files = {}
+        folders = [(root, "")]
+        while folders:
+            found, sub_folders = scan_folder(*folders.pop())
+            files.update(found)
+            folders.extend(sub_folders)
+        return files
+
+    files = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        running = {executor.submit(scan_folder, root, "")}
+        while running:
+            done, running = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                found, sub_folders = future.result()
+                files.update(found)
+                running.update(
+                    executor.submit(scan_folder, *folder) for folder in sub_folders
+                )
+    return files
+
+
+def diff_index(index: dict, files: dict) -> tuple:
+    """Compare the result of scan_tree with the index, return the paths of
+    the new files, the ids of the entries removed and of the entries modified.
+
+    An entry is modified when the size or the modification time of its file
+    changed, entries indexed without them are considered unchanged.
+    """
+    removed = []
+    modified = []
+    indexed = set()
+    for f_id, info in index.items():
+        path = info["path"]
+        indexed.add(path)
+        stat = files.get(path)
+        if stat is None:
+            removed.append(f_id)
+        elif "mtime" in info and (info.get("size"), info["mtime"]) != stat:
+            modified.append(f_id)
+    added = sorted(path for path in files if path not in indexed)
+    return added, removed, modified
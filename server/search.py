@@ -0,0 +1,270 @@
+import bisect
+import itertools
+import json
+import math
+import os
+import re
+import sys
+import threading
+
+from .shared_state import SharedFile
+
+# Fields of the files, with their bit in the postings and their weight
+FIELDS = {
+    "tag": (1, 3.0),  # user_tags, keys and values
+    "name": (2, 2.0),  # Folders and name of the file
+    "camera": (4, 2.0),  # Make and model
+    "format": (8, 1.0),  # Format, type and extension
+    "meta": (16, 1.0),  # Other text metadata
+}
+ALL_FIELDS = sum(bit for bit, _ in FIELDS.values())
+
+# A prefix matches less than the whole word
+PREFIX_WEIGHT = 0.5
+
+# Version of the saved indexes, to change with FIELDS, tokens() or the format
+VERSION = 2
+
+# Share of the files changed after which the whole index is saved again
+MAX_DELTA = 0.1
+
+
+def tokens(text) -> list:
+    """Lowercase words and numbers of a text (underscores separate them)"""
+    return re.findall(r"[^\W_]+", str(text).lower())
+
+
+def file_terms(info: dict) -> dict:
+    """{term: bits of the fields where it is} of an entry of the index"""
+    terms = {}
+
+    def add(field: str, text):
+        bit = FIELDS[field][0]
+        for term in tokens(text):
+            terms[term] = terms.get(term, 0) | bit
+
+    tags = info.get("user_tags") or {}
+    for key in tags:
+        add("tag", key)
+        if isinstance(tags, dict) and isinstance(tags[key], str):
+            add("tag", tags[key])
+    add("name", os.path.splitext(info.get("path", ""))[0])
+    for key in ("format", "type", "extension"):
+        add("format", info.get(key, ""))
+    for key, value in (info.get("metadata") or {}).items():
+        if isinstance(value, str):
+            add("camera" if key in ("make", "model") else "meta", value)
+    return terms
+
+
+def interned_terms(info: dict) -> dict:
+    """file_terms with the same string object for a term in every file"""
+    return {sys.intern(term): bits for term, bits in file_terms(info).items()}
+
+
+def read_saved(path: str) -> dict | None:
+    """Content of a file written by SearchIndex.save(), None if it is missing
+    or of another version"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if data.get("version") == VERSION else None
+
+
+def parse_query(query: str) -> list:
+    """[(bits of the fields, word)] of a query, "field:word" searches one
+    field only"""
+    words = []
+    for part in query.split():
+        field, _, text = part.rpartition(":")
+        bits = FIELDS[field.lower()][0] if field.lower() in FIELDS else ALL_FIELDS
+        if field and field.lower() not in FIELDS:
+            text = part  # Not a field, e.g. a time
+        words.extend((bits, word) for word in tokens(text))
+    return words
+
+
+class SearchIndex:
+    """Inverted index of the words of the files: tags, names, formats and
+    camera of the entries of the index.
+
+    It is kept up to date by the FileManager like the timeline. Each word
+    has the files where it appears, with the bits of the fields it is in
+    (see FIELDS), and the words are also kept sorted to find the ones
+    starting with a prefix by bisection.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}  # term -> {f_id: bits of the fields}
+        self.terms = []  # Sorted terms, for the prefixes
+        self.files = {}  # f_id -> (term, ...)
+        self.stamp = None  # Version of the index of the files saved or loaded
+        self.base = None  # Version of the last full save, None if not saved
+        self.changes = {}  # f_id -> {term: bits} (None if removed) since then
+
+    def rebuild(self, index: dict):
+        with self.lock:
+            self.postings = {}
+            self.files = {}
+            for f_id, info in index.items():
+                terms = interned_terms(info)
+                self.files[f_id] = tuple(terms)
+                for term, bits in terms.items():
+                    self.postings.setdefault(term, {})[f_id] = bits
+            self.terms = sorted(self.postings)
+            self.stamp = self.base = None
+            self.changes = {}
+
+    def load(self, path: str, stamp) -> bool:
+        """Read the index saved by save() for the version `stamp` of the
+        index of the files, False if there is none"""
+        data = read_saved(path)
+        if data is None:
+            return False
+        changes = {}
+        if data["stamp"] != list(stamp):
+            delta = read_saved(path + ".delta")
+            if delta is None or delta["base"] != data["stamp"]:
+                return False
+            if delta["stamp"] != list(stamp):
+                return False
+            changes = delta["files"]
+        postings = {}
+        files = {}
+        for term, (gaps, bits) in data["postings"].items():
+            f_ids = map(str, itertools.accumulate(gaps))
+            if isinstance(bits, int):
+                bits = itertools.repeat(bits)
+            postings[term] = term_files = dict(zip(f_ids, bits))
+            for f_id in term_files:
+                files.setdefault(f_id, []).append(term)
+        with self.lock:
+            self.postings = postings
+            self.files = {f_id: tuple(terms) for f_id, terms in files.items()}
+            self.terms = sorted(self.postings)
+            for f_id, terms in changes.items():
+                self._remove(f_id)
+                if terms is not None:
+                    self._add(f_id, terms)
+            self.stamp = tuple(stamp)
+            self.base = tuple(data["stamp"])
+            self.changes = changes
+        return True
+
+    def save(self, path: str, stamp):
+        """Save the index made from the version `stamp` of the index of the
+        files, for the next load(). The files changed since the last full
+        save are written alone (in <path>.delta) while they are less than
+        MAX_DELTA of the files.
+
+        In a full save, the ids of a term are sorted and stored as the gaps
+        between them, with the bits of each file (or once if they are the
+        same for all)"""
+        with self.lock:
+            if self.base is not None and len(self.changes) <= MAX_DELTA * len(
+                self.files
+            ):
+                data = {
+                    "version": VERSION,
+                    "base": self.base,
+                    "stamp": stamp,
+                    "files": self.changes,
+                }
+                SharedFile(path + ".delta").save(data)
+                self.stamp = tuple(stamp)
+                return
+            postings = {}
+            for term, term_files in self.postings.items():
+                if len(term_files) == 1:
+                    # Most of the words of the names
+                    ((f_id, bits),) = term_files.items()
+                    postings[term] = [[int(f_id)], bits]
+                    continue
+                f_ids, bits = zip(*sorted((int(f), b) for f, b in term_files.items()))
+                gaps = [f_ids[0]] + [b - a for a, b in zip(f_ids, f_ids[1:])]
+                if bits.count(bits[0]) == len(bits):
+                    bits = bits[0]
+                postings[term] = [gaps, bits]
+            data = {"version": VERSION, "stamp": stamp, "postings": postings}
+            SharedFile(path).save(data)
+            self.stamp = self.base = tuple(stamp)
+            self.changes = {}
+
+    def add(self, f_id: str, info: dict):
+        """Add a file, or update it after a change"""
+        with self.lock:
+            self._remove(f_id)
+            terms = interned_terms(info)
+            self._add(f_id, terms)
+            self.changes[f_id] = terms
+
+    def _add(self, f_id: str, terms: dict):
+        self.files[f_id] = tuple(terms)
+        for term, bits in terms.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                bisect.insort(self.terms, term)
+            self.postings[term][f_id] = bits
+
+    def _remove(self, f_id: str):
+        for term in self.files.pop(f_id, ()):
+            files = self.postings[term]
+            files.pop(f_id, None)
+            if not files:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def remove(self, f_id: str):
+        with self.lock:
+            self._remove(f_id)
+            self.changes[f_id] = None
+
+    def prefixed(self, prefix: str) -> list:
+        """Terms starting with `prefix`"""
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\U0010ffff", start)
+        return self.terms[start:end]
+
+    def search(self, query: str) -> dict | None:
+        """{f_id: score} of the files matching every word of the query (as a
+        word or as a prefix), None for an empty query.
+
+        A word scores the weight of the best field where it is found, times
+        its rarity (inverse document frequency of the files of all the terms
+        it starts), halved when it is only a prefix of the term.
+        """
+        words = parse_query(query)
+        if not words:
+            return None
+        with self.lock:
+            count = len(self.files)
+            scores = None
+            for bits, word in words:
+                matches = {}
+                terms = self.prefixed(word)
+                # Rarity of the word, with the files of all its terms
+                found = sum(len(self.postings[term]) for term in terms)
+                rarity = math.log(1 + count / max(found, 1))
+                for term in terms:
+                    files = self.postings[term]
+                    weight = rarity if term == word else rarity * PREFIX_WEIGHT
+                    for f_id, file_bits in files.items():
+                        if scores is not None and f_id not in scores:
+                            continue
+                        found = file_bits & bits
+                        if not found:
+                            continue
+                        score = weight * max(
+                            w for bit, w in FIELDS.values() if found & bit
+                        )
+                        if score > matches.get(f_id, 0):
+                            matches[f_id] = score
+                if scores is not None:
+                    matches = {f: s + scores[f] for f, s in matches.items()}
+                scores = matches
+                if not scores:
+                    break
+            return scores
@@ -0,0 +1,89 @@
+import contextlib
+import json
+import os
+import stat
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows, only one process can be used
+    fcntl = None
+
+
+def file_stamp(path: str):
+    """Identify the version of a file, None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class SharedFile:
+    """A JSON file that can be used by several threads and processes.
+
+    Writes are atomic (the file is replaced), so readers never need a lock.
+    Writers use lock(), which is exclusive across the threads and, if
+    `shared` is True, across the processes (flock on <path>.lock).
+    stale() tells if someone else replaced the file since the last load or
+    save, the stamp being (inode, mtime, size).
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared and fcntl is not None
+        self.stamp = None
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    @contextlib.contextmanager
+    def lock(self):
+        with self.thread_lock:
+            if self.depth == 0 and self.shared:
+                self.fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+                if self.depth == 0 and self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+                    os.close(self.fd)
+                    self.fd = None
+
+    def stale(self) -> bool:
+        return file_stamp(self.path) != self.stamp
+
+    def load(self, default=None):
+        """Read the file, return `default` if it does not exist"""
+        try:
+            f = open(self.path, "r")
+        except FileNotFoundError:
+            self.stamp = None
+            return default
+        with f:
+            # Stamp of the version that is read, even if it is replaced meanwhile
+            st = os.fstat(f.fileno())
+            data = json.load(f)
+        self.stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        return data
+
+    def save(self, data):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "w") as f:
+                # dumps uses the C encoder, dump the Python one
+                f.write(json.dumps(data))
+            # Keep the permissions of the previous file
+            mode = os.stat(self.path).st_mode if os.path.exists(self.path) else 0o644
+            os.chmod(temp, stat.S_IMODE(mode))
+            os.replace(temp, self.path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self.stamp = file_stamp(self.path)
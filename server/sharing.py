@@ -0,0 +1,67 @@
+import threading
+
+PUBLIC = "public"
+
+
+class Shares:
+    """Who can see each file of the index.
+
+    It is kept up to date by the FileManager like the timeline: the files are
+    stored by owner and by user they are shared with ("public" for every
+    user), and the rights of each file are a set. Checking if a user can see
+    a file does not read its list of rights, and the files shared with a
+    user are found without going through the whole index.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owned = {}  # owner -> {f_id, ...}
+        self.granted = {}  # user or "public" -> {f_id, ...}
+        self.rights = {}  # f_id -> {user or "public", ...}
+        self.owners = {}  # f_id -> owner
+
+    def rebuild(self, index: dict):
+        with self.lock:
+            self.owned = {}
+            self.granted = {}
+            self.rights = {}
+            self.owners = {}
+            for f_id, info in index.items():
+                self._add(f_id, info)
+
+    def _add(self, f_id: str, info: dict):
+        rights = self.rights[f_id] = set(info.get("rights", ()))
+        owner = self.owners[f_id] = info.get("owner")
+        self.owned.setdefault(owner, set()).add(f_id)
+        for name in rights:
+            self.granted.setdefault(name, set()).add(f_id)
+
+    def add(self, f_id: str, info: dict):
+        """Add a file, or update it after a change of its owner or rights"""
+        with self.lock:
+            self._remove(f_id)
+            self._add(f_id, info)
+
+    def _remove(self, f_id: str):
+        for name in self.rights.pop(f_id, ()):
+            self.granted[name].discard(f_id)
+        if f_id in self.owners:
+            self.owned[self.owners.pop(f_id)].discard(f_id)
+
+    def remove(self, f_id: str):
+        with self.lock:
+            self._remove(f_id)
+
+    def is_shared(self, f_id: str, user: str) -> bool:
+        """The file is public or shared with the user"""
+        rights = self.rights.get(f_id, ())
+        return PUBLIC in rights or user in rights
+
+    def visible(self, user: str) -> set:
+        """Files owned by the user, shared with them or public"""
+        with self.lock:
+            return (
+                self.owned.get(user, set())
+                | self.granted.get(user, set())
+                | self.granted.get(PUBLIC, set())
+            )
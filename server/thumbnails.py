@@ -2,14 +2,24 @@ import os
 import zipfile
 from time import time
 
-import cv2
 from flask import Blueprint, request, send_file
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+
+try:
+    import pillow_heif
+except ImportError:  # HEIC / HEIF images are not supported
+    pillow_heif = None
+else:
+    pillow_heif.register_heif_opener()
 
 from .accounts import Accounts
 from .configuration import ConfigFile
 from .file_manager import FileManager
-from .utils import require_login
+from .jobs import Job, register_job
+from .metrics import Metrics
+from .perceptual import image_hashes
+from .utils import require_login, send_stored_file
+from .video_frames import VideoFrames
 
 bp = Blueprint("thumbnails", __name__, url_prefix="/api/timg")
 
@@ -19,14 +29,9 @@ bp = Blueprint("thumbnails", __name__, url_prefix="/api/timg")
 def get_thumbnail(f_id: str, size: int):
     user = Accounts().get_user()
     fm = FileManager()
-    conf = ConfigFile()
-
-    if size == 0:
-        size = conf.thumbnail_size
 
     # Check if the file exists
-    file_path = fm.get_path_id(f_id)
-    if file_path is None:
+    if fm.get_path_id(f_id) is None:
         return {"message": "File not found"}, 404
 
     # Check if the user has access to the file
@@ -34,28 +39,56 @@ def get_thumbnail(f_id: str, size: int):
         if not fm.metadata(f_id).get("owner") == user.get("username"):
             return {"message": "Unauthorized"}, 401
 
+    return thumbnail_response(f_id, size)
+
+
+def thumbnail_response(f_id: str, size: int):
+    """Send the thumbnail of a file, it is created if needed"""
+    fm = FileManager()
+    conf = ConfigFile()
+
+    if size == 0:
+        size = conf.thumbnail_size
+    file_path = fm.get_path_id(f_id)
+    if file_path is None:
+        return {"message": "File not found"}, 404
+
     # Check if the thumbnail exists
     thumbnail_path = os.path.join(conf.thumbnails_folder, f"{f_id}_{size}x{size}.png")
-    if not os.path.exists(thumbnail_path):
+    metrics = Metrics()
+    if os.path.exists(thumbnail_path):
+        metrics.thumbnail_hits.inc()
+    else:
+        metrics.thumbnail_misses.inc()
         # Create the thumbnail folder if it doesn't exist
         if not os.path.exists(conf.thumbnails_folder):
             os.mkdir(conf.thumbnails_folder)
 
         # Create the thumbnail
         if fm.metadata(f_id).get("type") == "image":
-            create_thumbnail(file_path, thumbnail_path, size)
+            try:
+                with metrics.thumbnail_generation.time("image"):
+                    create_thumbnail(file_path, thumbnail_path, size)
+            except (ThumbnailError, UnidentifiedImageError) as e:
+                return {"message": f"Thumbnail not available ({e})"}, 400
             print("Created thumbnail for", file_path)
 
         elif fm.metadata(f_id).get("type") == "video":
-            create_video_thumbnail(file_path, thumbnail_path, size)
+            try:
+                with metrics.thumbnail_generation.time("video"):
+                    create_video_thumbnail(file_path, thumbnail_path, size)
+            except ThumbnailError as e:
+                return {"message": f"Thumbnail not available ({e})"}, 400
             print("Created thumbnail for video", file_path)
         else:
             return {"message": "Thumbnail not available"}, 400
 
     # Cache the thumbnail for 1 day
     return (
-        send_file(
+        send_stored_file(
             thumbnail_path,
+            conf.thumbnails_folder,
+            conf.sendfile_thumbnails_prefix,
             mimetype="image/png",
             as_attachment=False,
             download_name=f_id + ".png",
@@ -65,6 +98,60 @@ def get_thumbnail(f_id: str, size: int):
     )
 
 
+@bp.route("/preview/<string:f_id>/<int:size>")
+@require_login
+def get_video_preview(f_id: str, size: int):
+    """Short animated preview of a video"""
+    user = Accounts().get_user()
+    fm = FileManager()
+    conf = ConfigFile()
+
+    if size == 0:
+        size = conf.thumbnail_size
+
+    file_path = fm.get_path_id(f_id)
+    if file_path is None:
+        return {"message": "File not found"}, 404
+
+    if not user.get("admin"):
+        if not fm.metadata(f_id).get("owner") == user.get("username"):
+            return {"message": "Unauthorized"}, 401
+
+    if fm.metadata(f_id).get("type") != "video":
+        return {"message": "Preview only available for videos"}, 400
+
+    extension, mimetype = preview_format()
+    preview_path = os.path.join(
+        conf.thumbnails_folder, f"{f_id}_{size}x{size}_preview.{extension}"
+    )
+    metrics = Metrics()
+    if os.path.exists(preview_path):
+        metrics.thumbnail_hits.inc()
+    else:
+        metrics.thumbnail_misses.inc()
+        if not os.path.exists(conf.thumbnails_folder):
+            os.mkdir(conf.thumbnails_folder)
+        try:
+            with metrics.thumbnail_generation.time("preview"):
+                create_video_preview(file_path, preview_path, size)
+        except ThumbnailError as e:
+            return {"message": f"Preview not available ({e})"}, 400
+        print("Created preview for video", file_path)
+
+    return (
+        send_stored_file(
+            preview_path,
+            conf.thumbnails_folder,
+            conf.sendfile_thumbnails_prefix,
+            mimetype=mimetype,
+            as_attachment=False,
+            download_name=f"{f_id}.{extension}",
+        ),
+        200,
+        {"Cache-Control": f"max-age={conf.cache_time}"},
+    )
+
+
 @bp.route("/get-multiple/<int:size>", methods=["POST"])
 @require_login
 def get_multiple_thumbnails(size: int):
@@ -90,6 +177,7 @@ def get_multiple_thumbnails(size: int):
         os.mkdir(conf.thumbnails_folder)
 
     # Create the required thumbnails
+    metrics = Metrics()
     for f_id in request.json:
         # Check if the file exists
         file_path = fm.get_path_id(f_id)
@@ -100,13 +188,24 @@ def get_multiple_thumbnails(size: int):
         thumbnail_path = os.path.join(
             conf.thumbnails_folder, f"{f_id}_{size}x{size}.png"
         )
-        if not os.path.exists(thumbnail_path):
+        if os.path.exists(thumbnail_path):
+            metrics.thumbnail_hits.inc()
+        else:
+            metrics.thumbnail_misses.inc()
             # Create the thumbnail
             if fm.metadata(f_id).get("type") == "image":
-                create_thumbnail(file_path, thumbnail_path, size)
+                try:
+                    with metrics.thumbnail_generation.time("image"):
+                        create_thumbnail(file_path, thumbnail_path, size)
+                except (ThumbnailError, UnidentifiedImageError) as e:
+                    return {"message": f"Could not create thumbnail ({f_id}, {e})"}, 400
                 print("Created thumbnail for", file_path)
             elif fm.metadata(f_id).get("type") == "video":
-                create_video_thumbnail(file_path, thumbnail_path, size)
+                try:
+                    with metrics.thumbnail_generation.time("video"):
+                        create_video_thumbnail(file_path, thumbnail_path, size)
+                except ThumbnailError as e:
+                    return {"message": f"Could not create thumbnail ({f_id}, {e})"}, 400
                 print("Created thumbnail for video", file_path)
             else:
                 return {"message": f"Could not create thumbnail ({f_id})"}, 404
@@ -134,75 +233,168 @@ def get_multiple_thumbnails(size: int):
     )
 
 
+class ThumbnailError(Exception):
+    pass
+
+
+class ImageTooLarge(ThumbnailError):
+    pass
+
+
+# Transpositions applying the EXIF orientation
+ORIENTATIONS = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def make_thumbnail(im: Image.Image, size: int) -> Image.Image:
+    """Scale the image so that its smallest side is `size` (images are never
+    enlarged), then crop its center to a square"""
+    if im.mode not in ("RGB", "RGBA", "L", "LA"):
+        # Palette, CMYK, 16 bits... images are resized in RGB(A)
+        transparent = im.mode in ("PA", "RGBa") or "transparency" in im.info
+        im = im.convert("RGBA" if transparent else "RGB")
+
+    scale = size / min(im.size)
+    if scale < 1:
+        new_size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+        # reducing_gap first reduces the image with a fast box filter
+        im = im.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    side = min(im.size)
+    left = (im.width - side) // 2
+    top = (im.height - side) // 2
+    return im.crop((left, top, left + side, top + side))
+
+
 def create_thumbnail(source: str, destination: str, size: int | None = None):
     if size is None:
         size = ConfigFile().thumbnail_size
     with Image.open(source) as im:
-        # Crop the image to a square (centered)
-        width, height = im.size
-
-        if width > height:
-            left = (width - height) / 2
-            top = 0
-            right = (width + height) / 2
-            bottom = height
-        else:
-            left = 0
-            top = (height - width) / 2
-            right = width
-            bottom = (height + width) / 2
+        orientation = im.getexif().get(0x0112)
 
-        im = im.crop((left, top, right, bottom))
+        # JPEG images are decoded at 1/2, 1/4 or 1/8 of their size if that
+        # is still larger than the thumbnail, other formats are not affected
+        im.draft("RGB", (size, size))
 
-        # Resize the image to the thumbnail size
-        im.thumbnail((size, size), Image.ADAPTIVE)
+        # Other images are decoded at full size: limit the memory used
+        if im.width * im.height > ConfigFile().thumbnail_max_pixels:
+            raise ImageTooLarge(f"{im.width}x{im.height} pixels")
 
-        im.save(destination)
+        thumbnail = make_thumbnail(im, size)
 
+    if orientation in ORIENTATIONS:
+        # Done on the thumbnail, this is cheaper and the crop is centered
+        thumbnail = thumbnail.transpose(ORIENTATIONS[orientation])
+    thumbnail.save(destination)
 
-def create_video_thumbnail(video_path: str, thumbnail_path: str, size: int):
-    # Open the video
-    cap = cv2.VideoCapture(video_path)
 
-    # Get the total number of frames
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+def create_video_thumbnail(video_path: str, thumbnail_path: str, size: int):
+    # The poster frame is already decoded if the color was computed recently
+    poster = VideoFrames().poster(video_path, size)
+    if poster is None:
+        raise ThumbnailError("Could not read the video")
+    make_thumbnail(poster, size).save(thumbnail_path)
 
-    # Get the frame at 1/3rd of the video
-    cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames // 3)
-    _, frame = cap.read()
 
-    # Save the frame as a thumbnail
-    cv2.imwrite(thumbnail_path, frame)
+def preview_format() -> tuple:
+    """(extension, mimetype) of the animated previews"""
+    Image.init()
+    if "WEBP" in Image.SAVE_ALL:
+        return "webp", "image/webp"
+    return "gif", "image/gif"
 
-    cap.release()
 
-    # Resize the thumbnail
-    create_thumbnail(thumbnail_path, thumbnail_path, size)
+def create_video_preview(video_path: str, preview_path: str, size: int):
+    """Animated preview made of video_preview_frames square frames"""
+    conf = ConfigFile()
+    frames = VideoFrames().preview(video_path, size, conf.video_preview_frames)
+    if not frames:
+        raise ThumbnailError("Could not read the video")
+    frames = [make_thumbnail(frame, size) for frame in frames]
+    frames[0].save(
+        preview_path,
+        save_all=True,
+        append_images=frames[1:],
+        duration=conf.video_preview_frame_duration,
+        loop=0,
+    )
 
 
-# Get the main color of the image as #RRGGBB
-def get_file_color(path, type):
+def analyze_file(path: str, type: str) -> tuple:
+    """Main color (#RRGGBB) and perceptual hashes of an image or a video,
+    computed from the same reduced image"""
     if type == "image":
-        img = Image.open(path)
-        img = img.resize((1, 1))
-        color = img.getpixel((0, 0))
-        if isinstance(color, int):
-            color = (color, color, color)
-        if len(color) == 4:
-            color = color[3:]
-        return "#" + "".join([f"{c:02x}" for c in color])
+        try:
+            with Image.open(path) as img:
+                orientation = img.getexif().get(0x0112)
+                # Neither needs the full resolution
+                img.draft("RGB", (128, 128))
+                if img.mode not in ("RGB", "RGBA", "L", "LA"):
+                    img = img.convert("RGB")
+                img.thumbnail((128, 128), Image.Resampling.BOX)
+                # Smaller images are not resized, read them before closing
+                img.load()
+        except (OSError, ValueError) as e:
+            print("Could not read the image", path, ":", e)
+            return "#000000", None
+        if orientation in ORIENTATIONS:
+            img = img.transpose(ORIENTATIONS[orientation])
     elif type == "video":
-        cap = cv2.VideoCapture(path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames // 3)
-        _, frame = cap.read()
-        frame.resize((1, 1))
-        color = frame[0][0]
-        if color is None:
-            return "#000000"
-        if color < 256:
-            color = color + color * 256 + color * 256 * 256  # Convert grayscale to RGB
-        cap.release()
-        return f"#{color:06x}"
+        # Kept in memory for the thumbnail
+        img = VideoFrames().poster(path)
+        if img is None:
+            return "#000000", None
     else:
-        return "#000000"
+        return "#000000", None
+
+    color = img.resize((1, 1), Image.Resampling.BOX).convert("RGB").getpixel((0, 0))
+    return "#" + "".join([f"{c:02x}" for c in color]), image_hashes(img)
+
+
+# Get the main color of the image as #RRGGBB
+def get_file_color(path, type):
+    return analyze_file(path, type)[0]
+
+
+@register_job("thumbnails")
+def thumbnails_job(job: Job) -> dict:
+    """Create the missing thumbnails of `size` (thumbnail_size by default),
+    the files are done in the order of their id"""
+    fm = FileManager()
+    conf = ConfigFile()
+    size = int(job.params.get("size") or conf.thumbnail_size)
+    os.makedirs(conf.thumbnails_folder, exist_ok=True)
+
+    last_id = job.checkpoint.get("last_id", -1)
+    f_ids = sorted(int(f_id) for f_id in fm.index if int(f_id) > last_id)
+    counts = job.checkpoint.get("counts", {"created": 0, "failed": 0})
+    job.progress(0, len(f_ids))
+    for i, f_id in enumerate(f_ids, 1):
+        info = fm.metadata(str(f_id))
+        file_path = fm.get_path_id(str(f_id))
+        thumbnail_path = os.path.join(
+            conf.thumbnails_folder, f"{f_id}_{size}x{size}.png"
+        )
+        if file_path is not None and not os.path.exists(thumbnail_path):
+            try:
+                if info.get("type") == "image":
+                    create_thumbnail(file_path, thumbnail_path, size)
+                    counts["created"] += 1
+                elif info.get("type") == "video":
+                    create_video_thumbnail(file_path, thumbnail_path, size)
+                    counts["created"] += 1
+            except (ThumbnailError, UnidentifiedImageError, OSError) as e:
+                print("Could not create the thumbnail of", file_path, ":", e)
+                counts["failed"] += 1
+        if i % conf.job_batch_size == 0:
+            job.save_checkpoint(last_id=f_id, counts=counts)
+        job.progress(i)
+
+    return {"message": "OK", **counts}
@@ -0,0 +1,147 @@
+import bisect
+import datetime
+import threading
+
+from .utils import date_seconds
+
+UNITS = ("day", "month", "year")
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Time zone offsets kept up to date besides UTC
+MAX_OFFSETS = 4
+# Time zones in minutes, from UTC-12:00 to UTC+14:00
+OFFSET_RANGE = (-720, 840)
+
+
+def period_name(day: int, unit: str) -> str:
+    """Name of the period containing `day` (days since 1970-01-01)"""
+    date = datetime.date.fromordinal(day + EPOCH_ORDINAL)
+    if unit == "day":
+        return date.isoformat()
+    if unit == "month":
+        return f"{date.year:04}-{date.month:02}"
+    return f"{date.year:04}"
+
+
+def day_number(date: float, offset: int) -> int:
+    """Day of a date of the index, `offset` is the time zone in minutes"""
+    return int((date_seconds(date) + offset * 60) // 86400)
+
+
+class Timeline:
+    """Number of files of each user per day, month or year.
+
+    It is kept up to date by the FileManager with the date ordered list: the
+    files of each user are stored by day, sorted from the newest to the
+    oldest. Only the days are read to count the files of the periods, and
+    the results are cached until the files of the user change.
+
+    The days depend on the time zone of the client: besides UTC, the days
+    of the last MAX_OFFSETS offsets requested are kept up to date.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.days = {0: {}}  # offset -> owner -> {day: [(-date, f_id), ...]}
+        self.versions = {}  # owner -> number of modifications
+        self.cache = {}  # (owner, unit, offset, samples) -> (version, periods)
+
+    def rebuild(self, index: dict):
+        with self.lock:
+            self.days = {0: {}}
+            self.cache = {}
+            for f_id, info in index.items():
+                self._add(f_id, info)
+
+    def _add(self, f_id: str, info: dict):
+        try:
+            owner, item = info["owner"], (-info["date"], f_id)
+            for offset, owners in self.days.items():
+                day = owners.setdefault(owner, {}).setdefault(
+                    day_number(info["date"], offset), []
+                )
+                bisect.insort(day, item)
+        except (KeyError, TypeError, ValueError):
+            return  # No date
+        self.versions[owner] = self.versions.get(owner, 0) + 1
+
+    def add(self, f_id: str, info: dict):
+        with self.lock:
+            self._add(f_id, info)
+
+    def remove(self, f_id: str, info: dict):
+        with self.lock:
+            try:
+                owner, item = info["owner"], (-info["date"], f_id)
+                for offset, owners in self.days.items():
+                    user_days = owners.get(owner, {})
+                    day = day_number(info["date"], offset)
+                    files = user_days.get(day, [])
+                    position = bisect.bisect_left(files, item)
+                    if position < len(files) and files[position] == item:
+                        del files[position]
+                        if not files:
+                            del user_days[day]
+            except (KeyError, TypeError, ValueError):
+                return
+            self.versions[owner] = self.versions.get(owner, 0) + 1
+
+    def days_for(self, offset: int) -> dict:
+        """Days of every user with a time zone offset, made from the UTC days
+        the first time"""
+        if offset in self.days:
+            return self.days[offset]
+        if len(self.days) > MAX_OFFSETS:
+            # Remove the oldest offset requested, UTC is kept
+            del self.days[next(o for o in self.days if o != 0)]
+        owners = {}
+        for owner, days in self.days[0].items():
+            user_days = owners[owner] = {}
+            for files in days.values():
+                for item in files:
+                    day = day_number(-item[0], offset)
+                    user_days.setdefault(day, []).append(item)
+            for files in user_days.values():
+                files.sort()
+        self.days[offset] = owners
+        return owners
+
+    def periods(self, owner: str, unit: str, offset: int = 0, samples: int = 4):
+        """Periods with files, from the newest to the oldest.
+
+        `offset` is the time zone of the user in minutes. Each period has its
+        number of files, the dates of its newest and oldest files and the
+        ids of its `samples` newest files.
+        """
+        cache_key = (owner, unit, offset, samples)
+        with self.lock:
+            version = self.versions.get(owner, 0)
+            cached = self.cache.get(cache_key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            periods = []
+            current = None
+            user_days = self.days_for(offset).get(owner, {})
+            for day in sorted(user_days, reverse=True):
+                files = user_days[day]
+                name = period_name(day, unit)
+                if current is None or current["period"] != name:
+                    newest = -files[0][0]
+                    current = {
+                        "period": name,
+                        "count": 0,
+                        "newest": newest,
+                        # For /file-list/before/<before>/<count>
+                        "before": int(newest) + 1,
+                        "samples": [],
+                    }
+                    periods.append(current)
+                current["count"] += len(files)
+                current["oldest"] = -files[-1][0]
+                missing = samples - len(current["samples"])
+                if missing > 0:
+                    current["samples"].extend(f_id for _, f_id in files[:missing])
+            self.cache[cache_key] = (version, periods)
+            return periods
@@ -0,0 +1,391 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from flask import Blueprint, request
+
+from .accounts import Accounts
+from .albums import AlbumStore
+from .configuration import ConfigFile
+from .file_manager import FileManager
+from .index_changes import ChangeDB
+from .jobs import Job, JobManager, register_job, submit_job
+from .scanner import scan_tree
+from .utils import Singleton, request_lists, require_login
+
+bp = Blueprint("trash", __name__, url_prefix="/api/trash")
+
+
+class TrashStore(metaclass=Singleton):
+    """Files moved to the trash, in a SQLite database (trash_database).
+
+    The table `trash` has one row per deleted file:
+    - id: id of the item in the trash
+    - file: id of the file in the index when it was deleted
+    - user: user who deleted it (the trash folder is trash_folder/<user>/)
+    - path: path of the file in the trash folder
+    - deleted: date of the deletion (seconds)
+    - entry: the entry of the index (JSON), restored as it was
+
+    The hash, the metadata and the color are kept in the entry, a restored
+    file is not read again.
+    """
+
+    def __init__(self):
+        self.config = ConfigFile()
+        self.trash_folder = self.config.trash_folder
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.config.trash_database, check_same_thread=False, timeout=30
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS trash (id INTEGER PRIMARY KEY AUTOINCREMENT, file VARCHAR(12), user VARCHAR(16), path TEXT, deleted INTEGER, entry TEXT)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS trash_user ON trash (user, deleted)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS trash_deleted ON trash (deleted)")
+        self.db.commit()
+
+    def trash_path(self, user: str, name: str) -> str:
+        """Free path for a file in the trash folder of the user"""
+        folder = os.path.join(self.trash_folder, user)
+        os.makedirs(folder, exist_ok=True)
+        base, extension = os.path.splitext(name)
+        path = os.path.join(folder, name)
+        i = 1
+        while os.path.exists(path):
+            path = os.path.join(folder, f"{base}_{i}{extension}")
+            i += 1
+        return path
+
+    def trash(self, fm: FileManager, f_id: str, user: str) -> int:
+        """Move a file of the index to the trash, the index must be locked.
+        Return the id of the item in the trash"""
+        return self.trash_files(fm, [f_id], user)[0]
+
+    def trash_files(self, fm: FileManager, f_ids: list, user: str) -> list:
+        """Move files of the index to the trash, the index must be locked.
+        The entries are removed and recorded at once, return the ids of the
+        items in the trash. Call remove_thumbnails once the index is unlocked:
+        the ids can be given to new files"""
+        rows = []
+        deleted = int(time.time())
+        try:
+            for f_id in f_ids:
+                info = fm.index[f_id]
+                path = self.trash_path(user, os.path.basename(info["path"]))
+                os.rename(fm.get_file_path(info["path"]), path)
+                relpath = os.path.relpath(path, self.trash_folder)
+                rows.append((f_id, user, relpath, deleted, json.dumps(info)))
+                # The modification time is the deletion date for the files
+                # not recorded here (see purge_trash_job)
+                os.utime(path)
+        except OSError:
+            # Put back the files already moved, the index is not modified
+            for f_id, _, relpath, _, _ in rows:
+                os.rename(
+                    os.path.join(self.trash_folder, relpath),
+                    fm.get_file_path(fm.index[f_id]["path"]),
+                )
+            raise
+        fm.remove_entries(f_ids)
+
+        trash_ids = []
+        with self.lock, self.db:
+            for row in rows:
+                cursor = self.db.execute(
+                    "INSERT INTO trash (file, user, path, deleted, entry) VALUES (?, ?, ?, ?, ?)",
+                    row,
+                )
+                trash_ids.append(cursor.lastrowid)
+        return trash_ids
+
+    def row(self, row: tuple) -> dict:
+        trash_id, f_id, user, path, deleted, entry = row
+        return {
+            "id": trash_id,
+            "file": f_id,
+            "user": user,
+            "path": path,
+            "deleted": deleted,
+            "entry": json.loads(entry),
+        }
+
+    def get(self, trash_id: int) -> dict | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM trash WHERE id = ?", (trash_id,)
+            ).fetchone()
+        return self.row(row) if row else None
+
+    def list(self, user: str | None, offset: int = 0, count: int = -1) -> list:
+        """Items of a user (of every user if None), the latest deleted first"""
+        query = "SELECT * FROM trash"
+        params = ()
+        if user is not None:
+            query += " WHERE user = ?"
+            params = (user,)
+        query += " ORDER BY deleted DESC, id DESC LIMIT ? OFFSET ?"
+        with self.lock:
+            rows = self.db.execute(query, params + (count, offset)).fetchall()
+        return [self.row(row) for row in rows]
+
+    def expired(self, before: float, count: int, user: str | None = None) -> list:
+        """Items deleted before `before` (of a user, of every user if None),
+        the oldest first"""
+        query = "SELECT * FROM trash WHERE deleted < ?"
+        params = (before,)
+        if user is not None:
+            query += " AND user = ?"
+            params += (user,)
+        query += " ORDER BY deleted LIMIT ?"
+        with self.lock:
+            rows = self.db.execute(query, params + (count,)).fetchall()
+        return [self.row(row) for row in rows]
+
+    def forget(self, trash_ids: list):
+        with self.lock, self.db:
+            self.db.executemany(
+                "DELETE FROM trash WHERE id = ?", [(i,) for i in trash_ids]
+            )
+
+    def restore(self, fm: FileManager, item: dict) -> str:
+        """Move a file back to its place (or next to it if the path is used)
+        and add its entry to the index again, the index must be locked.
+        Return the id of the file. The item is forgotten by the caller, once
+        the index is saved"""
+        info = item["entry"]
+        source = os.path.join(self.trash_folder, item["path"])
+        base, extension = os.path.splitext(info["path"])
+        i = 1
+        while info["path"] in fm.known_files or os.path.exists(
+            fm.get_file_path(info["path"])
+        ):
+            info["path"] = f"{base}_{i}{extension}"
+            i += 1
+        destination = fm.get_file_path(info["path"])
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.rename(source, destination)
+        try:
+            if "mtime" in info:
+                # Not modified since it was indexed
+                os.utime(destination, ns=(time.time_ns(), info["mtime"]))
+            info["extension"] = fm.get_extension(info["path"])
+
+            if str(info["id"]) in fm.index:
+                # The id was reused
+                info["id"] = fm.next_id()
+                AlbumStore().move_file(item["file"], str(info["id"]), info.get("hash"))
+            fm.add_entry(info)
+            ChangeDB().add_change(info)
+        except BaseException:
+            os.rename(destination, source)
+            raise
+        return str(info["id"])
+
+    def purge(self, item: dict) -> int:
+        """Delete a file of the trash and its thumbnails, return its size"""
+        size = 0
+        try:
+            path = os.path.join(self.trash_folder, item["path"])
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if item["file"] not in FileManager().index:
+            # Files trashed when their thumbnails were kept
+            remove_thumbnails([item["file"]])
+        AlbumStore().forget_file(item["file"], item["entry"].get("hash"))
+        self.forget([item["id"]])
+        return size
+
+
+def remove_thumbnails(f_ids: list):
+    """Remove the thumbnails and the previews ({f_id}_*) of files"""
+    f_ids = {str(f_id) for f_id in f_ids}
+    try:
+        entries = list(os.scandir(ConfigFile().thumbnails_folder))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.split("_", 1)[0] in f_ids:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def allowed_items(trash_ids: list) -> list | tuple:
+    """Items of the trash of the user, or an error response"""
+    user = Accounts().get_user()
+    store = TrashStore()
+    items = []
+    for trash_id in trash_ids:
+        item = store.get(trash_id)
+        if item is None:
+            return {"message": f"Item not found ({trash_id})"}, 404
+        if item["user"] != user["username"] and not user.get("admin"):
+            return {"message": f"Unauthorized ({trash_id})"}, 401
+        items.append(item)
+    return items
+
+
+@bp.route("/")
+@require_login
+def get_trash():
+    """Files deleted by the user (by ?user= for the admins), the latest
+    first, ?offset= and ?count= to get a page"""
+    user = Accounts().get_user()
+    username = request.args.get("user", user["username"])
+    if username != user["username"] and not user.get("admin"):
+        return {"message": "Unauthorized"}, 401
+    offset = request.args.get("offset", 0, type=int)
+    count = request.args.get("count", -1, type=int)
+    items = TrashStore().list(username, offset, count)
+    for item in items:
+        entry = item.pop("entry")
+        item.update(name=os.path.basename(entry["path"]), type=entry.get("type"))
+    return {"message": "OK", "items": items}
+
+
+@bp.route("/restore", methods=["POST"])
+@require_login
+def restore_files():
+    """Restore the items {"ids": [...]} of the trash, return their file id.
+    The items whose file is not in the trash are "missing", the ones that
+    could not be moved back are "failed" and stay in the trash"""
+    values = request_lists("ids", item_type=int, default=[])
+    if isinstance(values, tuple):
+        return values
+    items = allowed_items(values[0])
+    if isinstance(items, tuple):
+        return items
+
+    fm = FileManager()
+    store = TrashStore()
+    restored = {}
+    moved = []  # (path in the trash, path in the storage)
+    missing = []
+    failed = []
+    try:
+        with ChangeDB().batch(), fm.transaction():
+            for item in items:
+                source = os.path.join(store.trash_folder, item["path"])
+                if not os.path.exists(source):
+                    missing.append(item["id"])
+                    continue
+                try:
+                    restored[item["id"]] = f_id = store.restore(fm, item)
+                except OSError as e:
+                    print("Could not restore", source, ":", e)
+                    failed.append(item["id"])
+                    continue
+                moved.append((source, fm.get_path_id(f_id)))
+    except BaseException:
+        # The index is not saved, the files go back to the trash
+        for source, destination in moved:
+            os.rename(destination, source)
+        raise
+    store.forget(list(restored))
+    return {
+        "message": "OK",
+        "restored": restored,
+        "missing": missing,
+        "failed": failed,
+    }
+
+
+@bp.route("/purge", methods=["POST"])
+@require_login
+def purge_files():
+    """Delete for good the items {"ids": [...]} of the trash, or all the
+    items of the user without ids. This is done by a background job"""
+    values = request_lists("ids", item_type=int, default=None)
+    if isinstance(values, tuple):
+        return values
+    trash_ids = values[0]
+    if trash_ids is None:
+        username = Accounts().get_user()["username"]
+        return submit_job("purge-trash", {"user": username, "older_than": 0})
+    items = allowed_items(trash_ids)
+    if isinstance(items, tuple):
+        return items
+    return submit_job("purge-trash", {"ids": [item["id"] for item in items]})
+
+
+@register_job("purge-trash")
+def purge_trash_job(job: Job) -> dict:
+    """Delete the items of the trash `ids`, or the items deleted more than
+    `older_than` seconds ago (trash_retention by default) of `user` (every
+    user by default), by batches of job_batch_size"""
+    config = ConfigFile()
+    store = TrashStore()
+    older_than = job.params.get("older_than", config.trash_retention)
+    user = job.params.get("user")
+    purged = job.checkpoint.get("purged", 0)
+    freed = job.checkpoint.get("freed", 0)
+
+    if "ids" in job.params:
+        items = [store.get(trash_id) for trash_id in job.params["ids"]]
+        items = [item for item in items if item is not None]
+        total = len(items)
+        batches = (
+            items[start : start + config.job_batch_size]
+            for start in range(0, total, config.job_batch_size)
+        )
+    else:
+        # The purged items are forgotten, each batch starts at the oldest
+        limit = time.time() - older_than
+        total = None
+        batches = iter(lambda: store.expired(limit, config.job_batch_size, user), [])
+    job.progress(0, total)
+    done = 0
+    for batch in batches:
+        for item in batch:
+            freed += store.purge(item)
+            purged += 1
+        done += len(batch)
+        job.save_checkpoint(purged=purged, freed=freed)
+        job.progress(done)
+
+    if "ids" not in job.params:
+        # Files deleted before the trash was recorded, by modification time
+        folder = config.trash_folder
+        if user is not None:
+            folder = os.path.join(folder, user)
+        recorded = {item["path"] for item in store.list(user)}
+        limit = time.time() - older_than
+        for path, (size, mtime) in scan_tree(folder, config.scan_workers).items():
+            rel_path = os.path.relpath(os.path.join(folder, path), config.trash_folder)
+            if rel_path in recorded or mtime / 1e9 >= limit:
+                continue
+            try:
+                os.remove(os.path.join(folder, path))
+            except FileNotFoundError:
+                continue
+            purged += 1
+            freed += size
+
+    return {"message": "OK", "purged": purged, "freed": freed}
+
+
+def start_purge_timer():
+    """Submit a purge-trash job every trash_purge_interval seconds"""
+    interval = ConfigFile().trash_purge_interval
+    if not interval:
+        return
+
+    def purge():
+        try:
+            JobManager().submit("purge-trash", {}, "<trash>")
+        except Exception as e:
+            print("Could not purge the trash :", e)
+        start_purge_timer()
+
+    timer = threading.Timer(interval, purge)
+    timer.daemon = True
+    timer.start()
@@ -1,8 +1,13 @@
 import datetime
+import json
+import os
 import re
+import urllib.parse
 
-from flask import Blueprint, Response, jsonify, request
-from PIL import Image
+import werkzeug.utils
+from flask import Blueprint, Response, current_app, jsonify, request, send_file
+
+from .metadata import read_metadata
 
 
 class Singleton(type):
@@ -50,6 +55,105 @@ def blueprint_api(blueprint: Blueprint, *args, **kwargs):
     return decorator
 
 
+def stream_json(
+    payload: dict,
+    key: str,
+    items,
+    keyed: bool = False,
+    trailer=None,
+    mimetype: str | None = None,
+) -> Response:
+    """Stream `payload` as JSON, generating `payload[key]` lazily from `items`
+    (a list, or an object if `keyed` is True and items yields (key, value) pairs).
+    `trailer` can return more members to add once all the items are sent.
+    Clients accepting application/x-ndjson get the payload then one item per line."""
+    from .configuration import ConfigFile
+
+    batch_size = ConfigFile().stream_batch_size
+    ndjson = mimetype is None and (
+        request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson"]
+        )
+        == "application/x-ndjson"
+    )
+
+    def encode(item):
+        if ndjson:
+            return json.dumps(item[1] if keyed else item) + "\n"
+        if keyed:
+            return json.dumps(str(item[0])) + ":" + json.dumps(item[1])
+        return json.dumps(item)
+
+    def generate():
+        if ndjson:
+            yield json.dumps(payload) + "\n"
+        else:
+            head = json.dumps(payload)[:-1]
+            yield head + ("," if payload else "") + json.dumps(key) + ":"
+            yield "{" if keyed else "["
+
+        # Send the items in batches to keep the number of chunks reasonable
+        separator = "" if ndjson else ","
+        batch = []
+        for item in items:
+            batch.append(encode(item))
+            if len(batch) >= batch_size:
+                yield separator.join(batch)
+                batch = []
+                # The next batch must be separated from this one
+                if not ndjson:
+                    batch.append("")
+        if batch and batch != [""]:
+            yield separator.join(batch)
+
+        extra = trailer() if trailer is not None else {}
+        if ndjson:
+            if extra:
+                yield json.dumps(extra) + "\n"
+        else:
+            yield "}" if keyed else "]"
+            for name, value in extra.items():
+                yield "," + json.dumps(name) + ":" + json.dumps(value)
+            yield "}"
+
+    if mimetype is None:
+        mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(generate(), mimetype=mimetype)
+
+
+def send_stored_file(path: str, root: str, prefix: str, **kwargs) -> Response:
+    """send_file for a file inside `root`, following config.sendfile_mode:
+    - python: the WSGI server sends it (through wsgi.file_wrapper)
+    - x-sendfile: the fronting proxy sends `path` (X-Sendfile header)
+    - x-accel-redirect: nginx sends the internal location `prefix`/<relative path>
+    The proxy handles the conditional and range requests in the last two modes."""
+    from .configuration import ConfigFile
+
+    mode = ConfigFile().sendfile_mode
+    match mode:
+        case "python":
+            return send_file(path, **kwargs)
+        case "x-sendfile" | "x-accel-redirect":
+            response = werkzeug.utils.send_file(
+                path,
+                request.environ,
+                conditional=False,
+                use_x_sendfile=True,
+                response_class=current_app.response_class,
+                **kwargs,
+            )
+        case _:
+            raise ValueError(f"Unknown sendfile_mode : {mode}")
+
+    if mode == "x-accel-redirect":
+        del response.headers["X-Sendfile"]
+        relative = os.path.relpath(path, root).replace(os.sep, "/")
+        response.headers["X-Accel-Redirect"] = urllib.parse.quote(
+            prefix.rstrip("/") + "/" + relative
+        )
+    return response
+
+
 def require_login(func):
     def wrapper(*args, **kwargs):
         from flask import request
@@ -68,13 +172,18 @@ def require_login(func):
     return wrapper
 
 
+def is_admin_request() -> bool:
+    """Check if the request is made with a valid admin token"""
+    from .accounts import Accounts
+
+    if not Accounts()._check_token(get_request_token()):
+        return False
+    return bool(Accounts().get_user().get("admin"))
+
+
 def require_admin(func):
     def wrapper(*args, **kwargs):
-        from .accounts import Accounts
-
-        if not Accounts()._check_token(get_request_token()):
-            return {"message": "Unauthorized"}, 401
-        if not Accounts().get_user().get("admin"):
+        if not is_admin_request():
             return {"message": "Unauthorized"}, 401
         return func(*args, **kwargs)
 
@@ -86,50 +195,43 @@ def require_admin(func):
     return wrapper
 
 
-def get_exif_date(filename):
-    # Exif date has the format %Y:%m:%d %H:%M:%S
-    # We need to convert it to unix timestamp (int)
+def request_lists(*keys: str, item_type: type = str, default=()) -> list | tuple:
+    """Values of `keys` in the JSON object of the request, each must be a
+    list of `item_type` (`default` if it is missing, not checked), or an
+    error response"""
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return {"message": "Invalid request"}, 400
+    values = [data.get(key, default) for key in keys]
+    for key, value in zip(keys, values):
+        if value is default:
+            continue
+        # A string would be read character by character
+        if not isinstance(value, list) or not all(
+            isinstance(item, item_type) for item in value
+        ):
+            return {
+                "message": f"Invalid {key}, a list of {item_type.__name__} is expected"
+            }, 400
+    return values
 
-    convert = lambda x: int(
-        datetime.datetime.strptime(
-            x.replace("\x00", ""), "%Y:%m:%d %H:%M:%S"
-        ).timestamp()
-    )
-    image = Image.open(filename)
-    try:
-        exif = image._getexif()
-    except AttributeError:
-        exif = {}
-    if exif is None:
-        exif = {}
-
-    # 36867 is the EXIF tag for DateTimeOriginal
-    exif_date = exif.get(36867)
-    try:
-        if exif_date is not None:
-            return convert(exif_date)
-    except ValueError:
-        print(repr(exif_date))
-    # 36868 is the EXIF tag for DateTimeDigitized
-    exif_date = exif.get(36868)
-    try:
-        if exif_date is not None:
-            return convert(exif_date)
-    except ValueError:
-        print(repr(exif_date))
-    # 306 is the EXIF tag for DateTime
-    exif_date = exif.get(306)
-    try:
-        if exif_date is not None:
-            return convert(exif_date)
-    except ValueError:
-        print(repr(exif_date))
 
+def get_exif_date(filename):
+    """Date of an image from its EXIF data, or else from its name"""
+    date = read_metadata(filename).get("date")
+    if date is not None:
+        return date
     # If we reach this point, we didn't find any date
     # we try to get the date from the filename
     return get_date_filename(filename)
 
 
+def date_seconds(date: float) -> float:
+    """Date of an entry in seconds, the dates read from the file system are in
+    milliseconds"""
+    return date / 1000 if date > 1e11 else date
+
+
 def get_date_filename(filename):
     if filename is None:
         return None
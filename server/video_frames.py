@@ -0,0 +1,112 @@
+import collections
+import os
+import threading
+
+import cv2
+from PIL import Image
+
+from .configuration import ConfigFile
+from .metadata import read_metadata, video_keyframes
+from .utils import Singleton
+
+# Position of the poster frame in the video
+POSTER_POSITION = 1 / 3
+
+
+def frame_to_image(frame, max_size: int) -> Image.Image:
+    """Convert an OpenCV frame to a RGB image whose smallest side is at most
+    `max_size`"""
+    height, width = frame.shape[:2]
+    scale = max_size / min(width, height)
+    if scale < 1:
+        frame = cv2.resize(
+            frame,
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+
+def extract_frames(path: str, positions: list, max_size: int) -> list:
+    """Decode the frames at `positions` (fractions of the duration).
+
+    The keyframe closest to each position is used when the keyframes are
+    known (MP4 / MOV): the decoder starts on it, without decoding the
+    frames before. Other videos are seeked by time.
+    """
+    keyframes = video_keyframes(path)
+    cap = cv2.VideoCapture(path)
+    try:
+        duration = read_metadata(path).get("duration")
+        if not duration:
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+            duration = frames / fps if fps > 0 and frames > 0 else 0
+
+        images = []
+        last_index = None
+        for position in positions:
+            target = duration * position
+            if keyframes:
+                seconds, index = min(keyframes, key=lambda k: abs(k[0] - target))
+                if index == last_index:
+                    # Same keyframe as the previous position
+                    images.append(images[-1])
+                    continue
+                last_index = index
+                cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            else:
+                cap.set(cv2.CAP_PROP_POS_MSEC, target * 1000)
+            ok, frame = cap.read()
+            if not ok:
+                # The seek failed, use the first frame
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = cap.read()
+            if ok and frame is not None:
+                images.append(frame_to_image(frame, max_size))
+        return images
+    finally:
+        cap.release()
+
+
+class VideoFrames(metaclass=Singleton):
+    """Poster frames of the videos, kept in memory.
+
+    The frame is decoded once, for the color computed while indexing and
+    for the thumbnails of any size up to video_frame_size. The frames are
+    stored reduced (RGB, smallest side video_frame_size) in an LRU cache of
+    video_frame_cache_size entries, keyed by the path and the modification
+    time of the video.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = collections.OrderedDict()
+
+    def poster(self, path: str, size: int = 0) -> Image.Image | None:
+        """Poster frame, its smallest side is at least `size` if possible"""
+        config = ConfigFile()
+        if size > config.video_frame_size:
+            # Too large for the cache
+            frames = extract_frames(path, [POSTER_POSITION], size)
+            return frames[0] if frames else None
+
+        key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return self.frames[key]
+
+        frames = extract_frames(path, [POSTER_POSITION], config.video_frame_size)
+        if not frames:
+            return None
+        with self.lock:
+            self.frames[key] = frames[0]
+            while len(self.frames) > config.video_frame_cache_size:
+                self.frames.popitem(last=False)
+        return frames[0]
+
+    def preview(self, path: str, size: int, count: int) -> list:
+        """`count` frames spread over the video, they are not cached"""
+        positions = [(i + 0.5) / count for i in range(count)]
+        return extract_frames(path, positions, size)
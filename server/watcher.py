@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from .configuration import ConfigFile
+from .file_manager import FileManager
+
+# inotify(7) events
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify binding (Linux only), raises OSError if unavailable"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Could not watch {path}")
+        return wd
+
+    def read(self, timeout: float) -> list:
+        """Wait for events, return a list of (wd, mask, cookie, name)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+
+class Watcher:
+    """Keep the index up to date with the changes made directly in the storage.
+
+    The events of inotify are gathered for each path, a path is (re)indexed
+    once no event happened on it for watch_debounce seconds, so files still
+    being written are only read once. Files renamed inside the storage keep
+    their entry. A reconciliation scan runs every watch_reconcile_interval
+    seconds, and when events are lost (queue overflow).
+    """
+
+    def __init__(self, fm: FileManager):
+        self.fm = fm
+        self.inotify = Inotify()
+        self.watches = {}  # wd -> relative path of the folder
+        self.pending = {}  # relative path -> time of the last event
+        self.moves = {}  # new relative path -> old one
+        self.cookies = {}  # cookie of an IN_MOVED_FROM -> relative path
+        self.reconcile_needed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.watch_tree("")
+        self.thread.start()
+        print("Watching", self.fm.path, "with", len(self.watches), "folders")
+
+    def watch_tree(self, rel_folder: str) -> list:
+        """Watch a folder and its sub folders, return the files they contain"""
+        files = []
+        for root, dirs, names in os.walk(self.fm.get_file_path(rel_folder)):
+            rel_root = os.path.relpath(root, self.fm.path)
+            rel_root = "" if rel_root == "." else rel_root
+            try:
+                # Moved folders keep their wd, the path is updated
+                self.watches[self.inotify.add_watch(root, WATCH_MASK)] = rel_root
+            except OSError as e:
+                print("Watcher :", e)
+            files.extend(os.path.join(rel_root, name) for name in names)
+        return files
+
+    def handle(self, wd: int, mask: int, cookie: int, name: str):
+        now = time.monotonic()
+        if mask & IN_Q_OVERFLOW:
+            self.reconcile_needed = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        folder = self.watches.get(wd)
+        if folder is None or not name:
+            return
+        path = os.path.join(folder, name)
+
+        moved = False
+        if mask & IN_MOVED_FROM:
+            self.cookies[cookie] = path
+        elif mask & IN_MOVED_TO and cookie in self.cookies:
+            old = self.moves[path] = self.cookies.pop(cookie)
+            # Both paths are processed together
+            self.pending[old] = now
+            moved = True
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # New folder: watch it, its files may be there already
+            files = self.watch_tree(path)
+            if not moved:
+                for file in files:
+                    self.pending[file] = now
+        self.pending[path] = now
+
+    def run(self):
+        config = ConfigFile()
+        last_reconcile = time.monotonic()
+        while True:
+            try:
+                timeout = config.watch_debounce if self.pending else 60
+                for event in self.inotify.read(timeout):
+                    self.handle(*event)
+
+                now = time.monotonic()
+                interval = config.watch_reconcile_interval
+                if self.reconcile_needed or (
+                    interval and now - last_reconcile > interval
+                ):
+                    self.reconcile()
+                    last_reconcile = now
+                else:
+                    due = [
+                        path
+                        for path, last in self.pending.items()
+                        if now - last >= config.watch_debounce
+                    ]
+                    if due:
+                        self.process(due)
+            except Exception as e:
+                print("Error in the storage watcher :", e)
+                time.sleep(config.watch_debounce)
+
+    def reconcile(self):
+        self.reconcile_needed = False
+        self.pending.clear()
+        self.moves.clear()
+        self.cookies.clear()
+        self.watch_tree("")
+        with self.fm.transaction():
+            added, removed, modified = self.fm.reconcile()
+        print(
+            f"Storage reconciled : {added} files added, {removed} removed,",
+            f"{modified} modified",
+        )
+
+    def process(self, paths: list):
+        fm = self.fm
+        for path in paths:
+            del self.pending[path]
+        # Moves whose source was never seen are plain creations
+        self.cookies.clear()
+
+        with fm.transaction():
+            # Renames first, the old paths are in `paths` too
+            for path in paths:
+                if path in self.moves:
+                    self.move(path, self.moves.pop(path))
+
+            for path in paths:
+                full_path = fm.get_file_path(path)
+                if os.path.isfile(full_path):
+                    if path in fm.paths:
+                        fm.update_path(fm.paths[path])
+                    else:
+                        fm.index_path(path)
+                elif not os.path.exists(full_path):
+                    # A file or a folder was removed
+                    if path in fm.paths:
+                        f_ids = [fm.paths[path]]
+                    else:
+                        f_ids = [f_id for _, f_id in self.folder_entries(path)]
+                    for f_id in f_ids:
+                        fm.remove_entry(f_id)
+
+    def folder_entries(self, folder: str) -> list:
+        """(path, f_id) of the entries in a folder. Only folders go through
+        every path of the index, files are found in fm.paths"""
+        prefix = folder + os.sep
+        return [
+            (path, f_id)
+            for path, f_id in self.fm.paths.items()
+            if path.startswith(prefix)
+        ]
+
+    def move(self, path: str, old: str):
+        """Rename the entries of a file or a folder renamed in the storage"""
+        fm = self.fm
+        if old in fm.paths:
+            if path not in fm.paths:
+                fm.move_path(fm.paths[old], path)
+            return
+        for entry_path, f_id in self.folder_entries(old):
+            new_path = os.path.join(path, entry_path[len(old) + 1 :])
+            if new_path not in fm.paths:
+                fm.move_path(f_id, new_path)
+
+
+def start_watcher(fm: FileManager) -> Watcher | None:
+    try:
+        watcher = Watcher(fm)
+    except OSError as e:
+        print("The storage can't be watched :", e)
+        return None
+    watcher.start()
+    return watcher
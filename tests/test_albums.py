@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from server.utils import Singleton
+
+SERVER_ENV = os.path.join(os.path.dirname(__file__), "server_env")
+TEST_TOKEN = "f4bcfedf-297b-4a3d-a858-31845bb86307"
+
+
+class TestAlbums(unittest.TestCase):
+    """Files of the albums, kept by id and hash"""
+
+    def setUp(self):
+        from flask import Flask
+
+        from server import albums, file_manager
+        from server.accounts import Accounts
+        from server.configuration import ConfigFile
+
+        self.folder = tempfile.mkdtemp()
+        for name in ("accounts.json", "auth.json"):
+            shutil.copy(os.path.join(SERVER_ENV, name), self.folder)
+        config_file = os.path.join(self.folder, "config.conf")
+        with open(config_file, "w") as f:
+            f.write(
+                "\n".join(
+                    [
+                        f"storage={self.folder}/storage",
+                        f"index={self.folder}/index.json",
+                        f"accounts={self.folder}/accounts.json",
+                        f"authorization_file={self.folder}/auth.json",
+                        f"history_database={self.folder}/changes.db",
+                        f"album_database={self.folder}/albums.db",
+                    ]
+                )
+            )
+        Singleton._instances.clear()
+        config = ConfigFile(config_file)
+        self.fm = file_manager.FileManager(config)
+        Accounts(config)
+        self.store = albums.AlbumStore()
+        app = Flask(__name__)
+        app.register_blueprint(albums.bp)
+        self.client = app.test_client()
+
+        with self.fm.transaction():
+            for i in range(1, 6):
+                self.fm.add_entry(self.entry(str(i), date=1600000000 + i))
+        self.album = self.store.create("test", "Holidays")
+
+    def tearDown(self):
+        self.store.db.close()
+        Singleton._instances.clear()
+        shutil.rmtree(self.folder)
+
+    def entry(self, f_id: str, date: float, f_hash: str | None = None) -> dict:
+        return {
+            "id": f_id,
+            "date": date,
+            "path": f"test/{f_id}.jpg",
+            "type": "image",
+            "extension": ".jpg",
+            "format": "jpeg",
+            "owner": "test",
+            "color": "#000000",
+            "hash": f_hash or f_id,
+            "rights": [],
+        }
+
+    def add(self, f_ids: list) -> int:
+        return self.store.add_files(
+            self.album, {f_id: self.fm.index[f_id] for f_id in f_ids}
+        )
+
+    def post(self, path: str, data) -> int:
+        response = self.client.post(
+            "/api/albums" + path, json=data, headers={"Token": TEST_TOKEN}
+        )
+        return response.status_code
+
+    def test_add_remove(self):
+        from server.albums import visible_files
+
+        self.assertEqual(self.add(["1", "2", "3"]), 3)
+        self.assertEqual(self.add(["3", "4"]), 1)
+        self.assertEqual(self.store.get(self.album)["count"], 4)
+        self.assertEqual(self.store.remove_files(self.album, ["1", "5"]), 1)
+        self.assertEqual(self.store.get(self.album)["count"], 3)
+
+        files, cursor = visible_files(self.store.get(self.album), float("inf"), "", 2)
+        self.assertEqual(files, ["4", "3"])
+        files, cursor = visible_files(self.store.get(self.album), *cursor, 2)
+        self.assertEqual(files, ["2"])
+        self.assertIsNone(cursor)
+
+    def test_reused_id(self):
+        self.add(["1", "2"])
+        self.store.update(self.album, cover="1")
+        # The file 1 goes to the trash and its id is given to another file
+        with self.fm.transaction():
+            self.fm.remove_entries(["1"])
+            self.fm.add_entry(self.entry("1", date=1700000000, f_hash="new"))
+        self.assertEqual(self.store.albums_of("1", "new"), [])
+
+        # Adding the new file replaces the row of the old one
+        self.assertEqual(self.add(["1"]), 0)
+        self.assertEqual(self.store.albums_of("1", "new"), [self.album])
+        self.assertEqual(self.store.albums_of("1", "1"), [])
+        self.assertEqual(self.store.get(self.album)["count"], 2)
+
+        self.store.forget_file("1", "new")
+        album = self.store.get(self.album)
+        self.assertEqual(album["count"], 1)
+        self.assertIsNone(album["cover"])
+
+    def test_move_file(self):
+        self.add(["1"])
+        self.store.move_file("1", "9", "1")
+        self.assertEqual(self.store.albums_of("1", "1"), [])
+        self.assertEqual(self.store.albums_of("9", "1"), [self.album])
+
+    def test_invalid_body(self):
+        for path in (f"/{self.album}/add", f"/{self.album}/remove", "/"):
+            for data in ([1], {"files": "1"}, {"files": [1]}):
+                if path == "/" and "files" in data:
+                    continue
+                self.assertEqual(self.post(path, data), 400, (path, data))
+        response = self.client.patch(
+            f"/api/albums/{self.album}", json=[1], headers={"Token": TEST_TOKEN}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post(f"/{self.album}/add", {"files": ["1"]}), 200)
@@ -0,0 +1,125 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from PIL import Image
+
+from server.metadata import MP4_EPOCH_OFFSET, exif_date, read_metadata, video_keyframes
+
+DATE = "2021:05:12 18:30:00"
+
+
+def make_exif(orientation: int = 6) -> Image.Exif:
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"
+    exif[0x0110] = "Model X"
+    exif[0x0112] = orientation
+    exif[0x0132] = "2000:01:01 00:00:00"
+    exif.get_ifd(0x8769).update({0x9003: DATE, 0x9004: DATE})
+    exif.get_ifd(0x8825).update(
+        {1: "S", 2: (48.0, 51.0, 30.0), 3: "W", 4: (2.0, 17.0, 40.5), 5: 0, 6: 35.0}
+    )
+    return exif
+
+
+def box(kind: bytes, content: bytes) -> bytes:
+    return struct.pack(">L4s", 8 + len(content), kind) + content
+
+
+def make_mp4(created: int, rotation_matrix: tuple = (1, 0, 0, 1)) -> bytes:
+    """A MP4 file without media, moov after mdat"""
+    a, b, c, d = (v << 16 for v in rotation_matrix)
+    mvhd = struct.pack(">B3xLLLL", 0, created, created, 600, 600 * 90) + bytes(80)
+    tkhd = (
+        struct.pack(">B3xLLLLL", 0, created, created, 1, 0, 90)
+        + bytes(16)
+        + struct.pack(">9l", a, b, 0, c, d, 0, 0, 0, 1 << 30)
+        + struct.pack(">LL", 1920 << 16, 1080 << 16)
+    )
+    # 30 frames of 20 then 30 frames of 40 (timescale 600), keyframes 1, 25 and 41
+    mdia = box(
+        b"mdia",
+        box(b"mdhd", struct.pack(">B3xLLLL", 0, created, created, 600, 1800))
+        + box(b"hdlr", bytes(8) + b"vide" + bytes(12))
+        + box(
+            b"minf",
+            box(
+                b"stbl",
+                box(b"stts", struct.pack(">4xL4L", 2, 30, 20, 30, 40))
+                + box(b"stss", struct.pack(">4xL3L", 3, 1, 25, 41)),
+            ),
+        ),
+    )
+    xyz = struct.pack(">HH", 18, 0x15C7) + b"+48.8584+002.2945/"
+    moov = box(
+        b"moov",
+        box(b"mvhd", mvhd)
+        + box(b"trak", box(b"tkhd", tkhd) + mdia)
+        + box(b"udta", box(b"\xa9xyz", xyz)),
+    )
+    return box(b"ftyp", b"isom" + bytes(4)) + box(b"mdat", bytes(4096)) + moov
+
+
+class TestMetadata(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def test_jpeg(self):
+        Image.new("RGB", (320, 200)).save(self.path("a.jpg"), exif=make_exif())
+        metadata = read_metadata(self.path("a.jpg"))
+
+        # DateTimeOriginal is used before DateTime
+        self.assertEqual(metadata["date"], exif_date(DATE))
+        self.assertEqual((metadata["width"], metadata["height"]), (320, 200))
+        self.assertEqual(metadata["orientation"], 6)
+        self.assertEqual(metadata["make"], "Camera")
+        self.assertEqual(metadata["model"], "Model X")
+        latitude, longitude, altitude = metadata["gps"]
+        self.assertAlmostEqual(latitude, -(48 + 51 / 60 + 30 / 3600), places=5)
+        self.assertAlmostEqual(longitude, -(2 + 17 / 60 + 40.5 / 3600), places=5)
+        self.assertEqual(altitude, 35.0)
+
+    def test_jpeg_without_exif(self):
+        Image.new("RGB", (64, 48)).save(self.path("b.jpg"))
+        self.assertEqual(read_metadata(self.path("b.jpg")), {"width": 64, "height": 48})
+
+    def test_png(self):
+        Image.new("RGB", (30, 20)).save(self.path("c.png"), exif=make_exif(3))
+        metadata = read_metadata(self.path("c.png"))
+        self.assertEqual(metadata["date"], exif_date(DATE))
+        self.assertEqual((metadata["width"], metadata["height"]), (30, 20))
+        self.assertEqual(metadata["orientation"], 3)
+
+    def test_mp4(self):
+        created = 1620844200
+        with open(self.path("d.mp4"), "wb") as f:
+            f.write(make_mp4(created + MP4_EPOCH_OFFSET, (0, 1, -1, 0)))
+        metadata = read_metadata(self.path("d.mp4"))
+        self.assertEqual(metadata["date"], created)
+        self.assertEqual(metadata["duration"], 90)
+        self.assertEqual((metadata["width"], metadata["height"]), (1920, 1080))
+        self.assertEqual(metadata["rotation"], 90)
+        self.assertEqual(metadata["gps"], [48.8584, 2.2945])
+        self.assertEqual(
+            video_keyframes(self.path("d.mp4")),
+            [(0, 0), (480 / 600, 24), (1000 / 600, 40)],
+        )
+
+    def test_invalid(self):
+        with open(self.path("e.jpg"), "wb") as f:
+            f.write(b"\xff\xd8\xff\xe1\x00\x10Exif\x00\x00MM")
+        with open(self.path("f.mp4"), "wb") as f:
+            f.write(b"not a video")
+        self.assertEqual(read_metadata(self.path("e.jpg")), {})
+        self.assertEqual(read_metadata(self.path("f.mp4")), {})
+        self.assertEqual(read_metadata(self.path("missing.png")), {})
@@ -0,0 +1,192 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from server.utils import Singleton
+
+SERVER_ENV = os.path.join(os.path.dirname(__file__), "server_env")
+TEST_TOKEN = "f4bcfedf-297b-4a3d-a858-31845bb86307"
+THREADS = 4
+FREE_THREADS = 2
+
+
+class TestNotifier(unittest.TestCase):
+    """Waiting connections never take the last threads of waitress"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        for name in ("accounts.json", "auth.json", "index.json"):
+            shutil.copy(os.path.join(SERVER_ENV, name), cls.folder)
+        for name in ("storage", "thumbnails", "temp", "trash", "web"):
+            os.makedirs(os.path.join(cls.folder, name))
+        config_file = os.path.join(cls.folder, "config.conf")
+        with open(config_file, "w") as f:
+            f.write(
+                "\n".join(
+                    [
+                        f"storage={cls.folder}/storage",
+                        f"thumbnails_folder={cls.folder}/thumbnails",
+                        f"temp_folder={cls.folder}/temp",
+                        f"trash_folder={cls.folder}/trash",
+                        f"web_folder={cls.folder}/web",
+                        f"index={cls.folder}/index.json",
+                        f"accounts={cls.folder}/accounts.json",
+                        f"authorization_file={cls.folder}/auth.json",
+                        f"history_database={cls.folder}/changes.db",
+                        f"job_folder={cls.folder}/jobs",
+                        f"trash_database={cls.folder}/trash.db",
+                        f"album_database={cls.folder}/albums.db",
+                        "server_mode=waitress",
+                        f"threads={THREADS}",
+                        f"push_free_threads={FREE_THREADS}",
+                        "push_timeout=3",
+                    ]
+                )
+            )
+
+        import waitress
+
+        # The server is set up when it is imported, without the configuration
+        # of the other tests
+        Singleton._instances.clear()
+        os.environ["PHOTOSYNC_CONFIG"] = config_file
+        from server import main
+
+        cls.server = waitress.create_server(
+            main.app, host="127.0.0.1", port=0, threads=THREADS
+        )
+        cls.stopped = threading.Event()
+        cls.thread = threading.Thread(target=cls.serve, daemon=True)
+        cls.thread.start()
+        cls.host = f"http://127.0.0.1:{cls.server.effective_port}"
+
+    @classmethod
+    def serve(cls):
+        # Like server.run(), with a way to stop
+        while not cls.stopped.is_set():
+            cls.server.asyncore.loop(timeout=0.1, map=cls.server._map, count=1)
+        cls.server.close()
+        cls.server.task_dispatcher.shutdown()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stopped.set()
+        cls.thread.join()
+        # The other tests must not find this configuration
+        Singleton._instances.clear()
+        shutil.rmtree(cls.folder)
+
+    def get(self, path: str):
+        return requests.get(
+            self.host + "/api/files" + path, headers={"Token": TEST_TOKEN}, timeout=2
+        )
+
+    def test_waiters_leave_threads(self):
+        from server.notifications import Notifier
+
+        cursor = self.get("/changes/cursor").json()["cursor"]
+        waiters = [
+            threading.Thread(
+                target=requests.get,
+                args=(f"{self.host}/api/files/changes/wait/{cursor}/10",),
+                kwargs={"headers": {"Token": TEST_TOKEN}},
+            )
+            for _ in range(THREADS - FREE_THREADS)
+        ]
+        for waiter in waiters:
+            waiter.start()
+        deadline = time.time() + 2
+        while Notifier().count < len(waiters) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(Notifier().count, THREADS - FREE_THREADS)
+
+        # Another waiting connection is refused instead of taking a thread
+        self.assertEqual(self.get(f"/changes/wait/{cursor}/10").status_code, 503)
+        # The other requests are still answered while the waiters wait
+        for _ in range(FREE_THREADS * 2):
+            response = self.get("/changes/cursor")
+            self.assertEqual(response.status_code, 200)
+        self.assertGreater(Notifier().count, 0)
+
+        for waiter in waiters:
+            waiter.join()
+
+    def test_events_not_compressed(self):
+        cursor = self.get("/changes/cursor").json()["cursor"]
+        with requests.get(
+            f"{self.host}/api/files/changes/events?cursor={cursor}",
+            headers={"Token": TEST_TOKEN, "Accept-Encoding": "gzip"},
+            stream=True,
+            timeout=2,
+        ) as response:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertTrue(next(response.iter_lines()).startswith(b"retry:"))
+
+    def test_push_server(self):
+        from server.index_changes import ChangeDB
+        from server.push import PushServer
+
+        server = PushServer("127.0.0.1", 0)
+        server.start()
+        self.addCleanup(server.stop)
+        push_host = f"http://127.0.0.1:{server.port}/api/files"
+        cursor = self.get("/changes/cursor").json()["cursor"]
+        responses = []
+
+        def wait():
+            responses.append(
+                requests.get(
+                    f"{push_host}/changes/wait/{cursor}/10",
+                    headers={"Token": TEST_TOKEN},
+                    timeout=5,
+                )
+            )
+
+        # More waiting connections than the threads of waitress
+        waiters = [threading.Thread(target=wait) for _ in range(THREADS * 2)]
+        for waiter in waiters:
+            waiter.start()
+        deadline = time.time() + 2
+        while server.count < len(waiters) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(server.count, len(waiters))
+        for _ in range(THREADS * 2):
+            self.assertEqual(self.get("/changes/cursor").status_code, 200)
+
+        # A change wakes them up before push_timeout
+        start = time.time()
+        ChangeDB().add_change({"id": "999", "owner": "test", "rights": []})
+        ChangeDB().flush()
+        for waiter in waiters:
+            waiter.join()
+        self.assertLess(time.time() - start, 2)
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertGreater(response.json()["cursor"], cursor)
+            self.assertEqual(response.json()["removed"], ["999"])
+        # Counted until the response is sent
+        deadline = time.time() + 2
+        while server.count and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(server.count, 0)
+
+        response = requests.get(f"{push_host}/changes/wait/{cursor}/10", timeout=2)
+        self.assertEqual(response.status_code, 401)
+        with requests.get(
+            f"{push_host}/changes/events?cursor={cursor}&token={TEST_TOKEN}",
+            stream=True,
+            timeout=2,
+        ) as response:
+            self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+            # Not chunked, read until the end of each line
+            lines = response.iter_lines(chunk_size=1)
+            self.assertTrue(next(lines).startswith(b"retry:"))
+            self.assertEqual(next(lines), b"")
+            self.assertEqual(next(lines), f"id: {cursor + 1}".encode())
@@ -0,0 +1,89 @@
+import io
+import random
+import unittest
+
+import numpy as np
+from flask import Flask
+from PIL import Image
+
+from server.perceptual import (
+    MAX_RADIUS,
+    MultiIndex,
+    burst_groups,
+    distance,
+    duplicate_clusters,
+    image_hashes,
+    radius_arg,
+)
+
+
+def make_photo(seed: int) -> Image.Image:
+    """Smooth random image, like a photo (noise has no stable hash)"""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize((800, 600), Image.Resampling.BICUBIC)
+
+
+def hash_value(im: Image.Image, kind: str = "phash") -> int:
+    return int(image_hashes(im)[kind], 16)
+
+
+class TestPerceptual(unittest.TestCase):
+    def test_hashes(self):
+        photo = make_photo(0)
+        buffer = io.BytesIO()
+        photo.resize((400, 300)).save(buffer, "JPEG", quality=60)
+        copy = Image.open(buffer)
+        other = make_photo(1)
+
+        for kind in ("ahash", "dhash", "phash"):
+            value = hash_value(photo, kind)
+            self.assertLessEqual(distance(value, hash_value(copy, kind)), 4, kind)
+            self.assertGreater(distance(value, hash_value(other, kind)), 10, kind)
+
+    def test_multi_index(self):
+        rng = random.Random(0)
+        values = [rng.getrandbits(64) for _ in range(500)]
+        values += [v ^ (1 << rng.randrange(64)) for v in values[:50]]
+        index = MultiIndex(8)
+        for i, value in enumerate(values):
+            index.add(value, i)
+
+        for query in values[:20] + [rng.getrandbits(64)]:
+            expected = sorted(
+                (distance(query, v), i)
+                for i, v in enumerate(values)
+                if distance(query, v) <= 8
+            )
+            self.assertEqual(sorted(index.search(query)), expected)
+
+    def test_clusters(self):
+        hashes = {"a": 0b1111, "b": 0b0111, "c": 0b0011, "d": 1 << 60}
+        self.assertEqual(duplicate_clusters(hashes, 1), [["a", "b", "c"]])
+        self.assertEqual(duplicate_clusters(hashes, 0), [])
+
+    def test_bursts(self):
+        files = [
+            (100, "a", 0),
+            (102, "b", 1),
+            (103, "c", 3),
+            (104, "d", 1 << 63 | (1 << 62) - 1),  # Another scene
+            (200, "e", 0),
+        ]
+        self.assertEqual(burst_groups(files, 5, 4), [["a", "b", "c"]])
+
+    def test_radius(self):
+        app = Flask(__name__)
+        with app.test_request_context("/"):
+            self.assertEqual(radius_arg(6, MAX_RADIUS), 6)
+            # A configured radius above the limit is lowered
+            self.assertEqual(radius_arg(16, MAX_RADIUS), MAX_RADIUS)
+        with app.test_request_context(f"/?radius={MAX_RADIUS}"):
+            self.assertEqual(radius_arg(6, MAX_RADIUS), MAX_RADIUS)
+        # The searches would be slower than comparing every pair
+        for radius in (MAX_RADIUS + 1, 16, 64, -1):
+            with app.test_request_context(f"/?radius={radius}"):
+                self.assertEqual(radius_arg(6, MAX_RADIUS)[1], 400)
+        # Bursts only compare consecutive files, any distance can be asked
+        with app.test_request_context("/?radius=64"):
+            self.assertEqual(radius_arg(16), 64)
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from server.scanner import diff_index, scan_tree
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for path in ("a.jpg", "b/c.png", "b/d/e.mp4", "f/g.jpg"):
+            path = os.path.join(self.folder, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"0" * len(path))
+        os.symlink(os.path.join(self.folder, "b"), os.path.join(self.folder, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_scan(self):
+        expected = {}
+        for root, dirs, files in os.walk(self.folder):
+            for file in files:
+                stat = os.stat(os.path.join(root, file))
+                path = os.path.relpath(os.path.join(root, file), self.folder)
+                expected[path] = (stat.st_size, stat.st_mtime_ns)
+        self.assertEqual(scan_tree(self.folder), expected)
+        self.assertEqual(scan_tree(self.folder, workers=4), expected)
+
+    def test_diff(self):
+        files = scan_tree(self.folder)
+        size, mtime = files["a.jpg"]
+        index = {
+            "1": {"path": "a.jpg", "size": size, "mtime": mtime},
+            "2": {"path": "b/c.png", "size": 0, "mtime": 0},
+            "3": {"path": "f/g.jpg"},  # Indexed without the size
+            "4": {"path": "removed.jpg", "size": 0, "mtime": 0},
+        }
+        added, removed, modified = diff_index(index, files)
+        self.assertEqual(added, ["b/d/e.mp4"])
+        self.assertEqual(removed, ["4"])
+        self.assertEqual(modified, ["2"])
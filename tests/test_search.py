@@ -0,0 +1,125 @@
+import json
+import os
+import tempfile
+import unittest
+
+from server.search import SearchIndex, parse_query
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.index = {
+            "1": {
+                "path": "test/IMG_20210511_1.jpg",
+                "format": "jpeg",
+                "type": "image",
+                "extension": ".jpg",
+                "metadata": {"make": "Google", "model": "Pixel 7"},
+                "user_tags": {"holidays": "Brittany"},
+            },
+            "2": {
+                "path": "test/holiday/VID_2021.mp4",
+                "format": "mp4",
+                "type": "video",
+                "extension": ".mp4",
+                "metadata": {},
+                "user_tags": {},
+            },
+            "3": {
+                "path": "test/scan.png",
+                "format": "png",
+                "type": "image",
+                "extension": ".png",
+                "metadata": {"make": "Canon"},
+                "user_tags": {},
+            },
+        }
+        self.search = SearchIndex()
+        self.search.rebuild(self.index)
+
+    def ranked(self, query: str) -> list:
+        scores = self.search.search(query)
+        return sorted(scores, key=lambda f: (-scores[f], f))
+
+    def test_search(self):
+        self.assertEqual(self.ranked("pixel"), ["1"])
+        self.assertEqual(self.ranked("image"), ["1", "3"])
+        # The folder "holiday" matches the whole word, the tag "holidays" a prefix
+        self.assertEqual(self.ranked("holiday"), ["2", "1"])
+        self.assertEqual(self.ranked("holidays"), ["1"])
+        self.assertEqual(self.ranked("image can"), ["3"])
+        self.assertEqual(self.ranked("2021"), ["2", "1"])
+        self.assertEqual(self.ranked("tag:holi"), ["1"])
+        self.assertEqual(self.ranked("nothing"), [])
+        self.assertIsNone(self.search.search(" "))
+        self.assertEqual(
+            parse_query("camera:Pixel 12:30"), [(4, "pixel"), (31, "12"), (31, "30")]
+        )
+
+    def test_updates(self):
+        self.search.remove("1")
+        info = {**self.index["3"], "user_tags": {"pixel": ""}}
+        self.search.add("3", info)
+        self.assertEqual(self.ranked("pixel"), ["3"])
+        self.assertEqual(self.ranked("canon"), ["3"])
+        self.assertNotIn("google", self.search.terms)
+        self.assertEqual(self.search.terms, sorted(self.search.postings))
+
+    def test_saved(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "index.json.search")
+            self.search.add("4", {"path": "jpeg/4"})
+            self.search.save(path, (1, 2, 3))
+            with open(path) as f:
+                postings = json.load(f)["postings"]
+            # Gaps between the sorted ids, the bits once if they are the same
+            self.assertEqual(postings["image"], [[1, 2], 8])
+            self.assertEqual(postings["jpeg"], [[1, 3], [8, 2]])
+
+            loaded = SearchIndex()
+            self.assertTrue(loaded.load(path, (1, 2, 3)))
+            self.assertEqual(loaded.postings, self.search.postings)
+            self.assertEqual(loaded.terms, self.search.terms)
+            self.assertEqual(
+                {f: set(terms) for f, terms in loaded.files.items()},
+                {f: set(terms) for f, terms in self.search.files.items()},
+            )
+            self.assertEqual(loaded.search("holiday"), self.search.search("holiday"))
+
+            # Saved for another version of the index of the files
+            self.assertFalse(SearchIndex().load(path, (1, 2, 4)))
+            self.assertFalse(SearchIndex().load(path + ".missing", (1, 2, 3)))
+
+    def test_delta(self):
+        for i in range(10, 30):
+            self.search.add(str(i), {"path": f"day/{i}.jpg"})
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "index.json.search")
+            self.search.save(path, (1, 2, 3))
+            self.assertFalse(os.path.exists(path + ".delta"))
+
+            # A few changes are saved alone
+            self.search.remove("1")
+            self.search.add("10", {"path": "night/10.jpg"})
+            self.search.save(path, (1, 2, 4))
+            with open(path) as f:
+                self.assertEqual(json.load(f)["stamp"], [1, 2, 3])
+            loaded = SearchIndex()
+            self.assertTrue(loaded.load(path, (1, 2, 4)))
+            self.assertEqual(loaded.postings, self.search.postings)
+            self.assertEqual(loaded.terms, self.search.terms)
+            self.assertEqual(loaded.search("night"), self.search.search("night"))
+            self.assertNotIn("1", loaded.search("image"))
+            # The changes since the full save are kept for the next delta
+            self.assertEqual(loaded.base, (1, 2, 3))
+            self.assertEqual(set(loaded.changes), {"1", "10"})
+
+            # Saved again when too many files changed
+            for i in range(20, 30):
+                loaded.remove(str(i))
+            loaded.save(path, (1, 2, 5))
+            with open(path) as f:
+                self.assertEqual(json.load(f)["stamp"], [1, 2, 5])
+            self.assertEqual(loaded.changes, {})
+            self.assertFalse(SearchIndex().load(path, (1, 2, 4)))
+            self.assertTrue(SearchIndex().load(path, (1, 2, 5)))
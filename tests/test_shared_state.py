@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from server.shared_state import SharedFile
+
+PROCESSES = 4
+WRITES = 25
+
+
+def increment(path: str, count: int):
+    store = SharedFile(path, shared=True)
+    for _ in range(count):
+        with store.lock():
+            data = store.load({"count": 0})
+            data["count"] += 1
+            store.save(data)
+
+
+def add_files(config_file: str, owner: str, count: int):
+    from server.configuration import ConfigFile
+    from server.file_manager import FileManager
+
+    fm = FileManager(ConfigFile(config_file))
+    for i in range(count):
+        with fm.transaction():
+            fm.add_entry(
+                {
+                    "id": fm.next_id(),
+                    "path": f"{owner}/{i}.jpg",
+                    "date": i,
+                    "owner": owner,
+                    "rights": [],
+                }
+            )
+
+
+def index_file(config_file: str, path: str):
+    from server.configuration import ConfigFile
+    from server.file_manager import FileManager
+
+    fm = FileManager(ConfigFile(config_file))
+    with fm.transaction():
+        fm.add_entry(
+            {
+                "id": fm.next_id(),
+                "path": path,
+                "date": 0,
+                "owner": "<index>",
+                "rights": [],
+            }
+        )
+
+
+class TestSharedState(unittest.TestCase):
+    """Several processes modify the same files, no write must be lost"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.config_file = os.path.join(cls.folder, "config.conf")
+        with open(cls.config_file, "w") as f:
+            f.write(
+                "\n".join(
+                    [
+                        f"storage={cls.folder}/storage",
+                        f"index={cls.folder}/index.json",
+                        f"history_database={cls.folder}/changes.db",
+                        "shared_state=true",
+                    ]
+                )
+            )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def run_processes(self, target, *args):
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=target, args=(*args, f"p{i}", WRITES))
+            for i in range(PROCESSES)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+    def test_shared_file(self):
+        path = os.path.join(self.folder, "counter.json")
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=increment, args=(path, WRITES))
+            for _ in range(PROCESSES)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual(SharedFile(path).load()["count"], PROCESSES * WRITES)
+
+    def test_index(self):
+        from server.configuration import ConfigFile
+        from server.file_manager import FileManager
+
+        fm = FileManager(ConfigFile(self.config_file))
+        self.run_processes(add_files, self.config_file)
+
+        # The index of this process is reloaded since it is outdated, without
+        # waiting for a process writing it
+        self.assertTrue(fm.store.stale())
+        reader = threading.Thread(target=fm.sync)
+        with SharedFile(fm.store.path, shared=True).lock():
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+        self.assertFalse(fm.store.stale())
+
+        self.assertEqual(len(fm.index), PROCESSES * WRITES)
+        self.assertEqual(len(fm.known_files), PROCESSES * WRITES)
+        for f_id, info in fm.index.items():
+            self.assertEqual(f_id, str(info["id"]))
+        self.assertEqual(len(fm.ordered_files), PROCESSES * WRITES)
+        # The search index saved by the last writer is read, not rebuilt
+        self.assertEqual(fm.search.stamp, fm.store.stamp)
+        self.assertEqual(len(fm.search.search("p1")), WRITES)
+
+    def test_same_path(self):
+        from server.configuration import ConfigFile
+        from server.file_manager import FileManager
+
+        fm = FileManager(ConfigFile(self.config_file))
+        fm.sync()
+        info = {"path": "up/new.jpg", "date": 1, "owner": "up", "rights": []}
+
+        # Another process indexes the file before this one adds its entry
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=index_file, args=(self.config_file, info["path"])
+        )
+        process.start()
+        process.join()
+        with fm.transaction():
+            info["id"] = fm.next_id()
+            fm.add_entry(info)
+
+        entries = [f for f in fm.index.values() if f["path"] == info["path"]]
+        self.assertEqual(entries, [info])
+        self.assertEqual(len(fm.ordered_files), len(fm.index))
@@ -0,0 +1,33 @@
+import unittest
+
+from server.sharing import Shares
+
+
+class TestShares(unittest.TestCase):
+    def setUp(self):
+        self.index = {
+            "1": {"owner": "a", "rights": []},
+            "2": {"owner": "a", "rights": ["b"]},
+            "3": {"owner": "b", "rights": ["public"]},
+            "4": {"owner": "c", "rights": ["a", "b"]},
+        }
+        self.shares = Shares()
+        self.shares.rebuild(self.index)
+
+    def test_visible(self):
+        self.assertEqual(self.shares.visible("a"), {"1", "2", "3", "4"})
+        self.assertEqual(self.shares.visible("b"), {"2", "3", "4"})
+        self.assertEqual(self.shares.visible("d"), {"3"})
+        self.assertTrue(self.shares.is_shared("2", "b"))
+        self.assertTrue(self.shares.is_shared("3", "d"))
+        self.assertFalse(self.shares.is_shared("1", "b"))
+
+    def test_updates(self):
+        info = self.index["2"]
+        info["owner"] = "c"
+        info["rights"] = ["public"]
+        self.shares.add("2", info)
+        self.shares.remove("4")
+        self.assertEqual(self.shares.visible("a"), {"1", "2", "3"})
+        self.assertEqual(self.shares.visible("b"), {"2", "3"})
+        self.assertEqual(self.shares.visible("c"), {"2", "3"})
@@ -0,0 +1,145 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from server.timeline import Timeline
+from server.utils import Singleton
+
+SERVER_ENV = os.path.join(os.path.dirname(__file__), "server_env")
+TEST_TOKEN = "f4bcfedf-297b-4a3d-a858-31845bb86307"
+
+
+def timestamp(*args) -> float:
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp()
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        self.index = {
+            "1": {"owner": "a", "date": timestamp(2021, 5, 12, 23, 30)},
+            "2": {"owner": "a", "date": timestamp(2021, 5, 12, 10)},
+            "3": {"owner": "a", "date": timestamp(2021, 5, 1, 8) * 1000},  # ms
+            "4": {"owner": "a", "date": timestamp(2020, 1, 1, 12)},
+            "5": {"owner": "b", "date": timestamp(2021, 5, 12, 10)},
+        }
+        self.timeline = Timeline()
+        self.timeline.rebuild(self.index)
+
+    def summary(self, unit: str, offset: int = 0) -> list:
+        return [
+            (p["period"], p["count"], p["samples"])
+            for p in self.timeline.periods("a", unit, offset, samples=1)
+        ]
+
+    def test_periods(self):
+        self.assertEqual(
+            self.summary("day"),
+            [
+                ("2021-05-12", 2, ["1"]),
+                ("2021-05-01", 1, ["3"]),
+                ("2020-01-01", 1, ["4"]),
+            ],
+        )
+        self.assertEqual(
+            self.summary("month"), [("2021-05", 3, ["1"]), ("2020-01", 1, ["4"])]
+        )
+        self.assertEqual(self.summary("year"), [("2021", 3, ["1"]), ("2020", 1, ["4"])])
+        periods = self.timeline.periods("a", "month")
+        self.assertEqual(periods[0]["before"], int(self.index["1"]["date"]) + 1)
+        self.assertEqual(periods[0]["oldest"], self.index["3"]["date"])
+
+    def test_offset(self):
+        # 23:30 UTC is the next day in UTC+02:00
+        self.assertEqual(self.summary("day", 120)[0], ("2021-05-13", 1, ["1"]))
+        self.assertEqual(self.summary("day", -630)[1], ("2021-05-11", 1, ["2"]))
+
+    def test_updates(self):
+        self.timeline.periods("a", "year")  # Cached
+        self.timeline.remove("1", self.index["1"])
+        info = {"owner": "a", "date": timestamp(2019, 7, 4)}
+        self.timeline.add("6", info)
+        self.assertEqual(
+            self.summary("year"),
+            [("2021", 2, ["2"]), ("2020", 1, ["4"]), ("2019", 1, ["6"])],
+        )
+        self.assertEqual(self.summary("year"), self.summary("year"))
+
+
+class TestTimelineRoutes(unittest.TestCase):
+    """The periods of /timeline lead to their files in /file-list/before"""
+
+    def setUp(self):
+        from flask import Flask
+
+        from server import file_manager
+        from server.accounts import Accounts
+        from server.configuration import ConfigFile
+
+        self.folder = tempfile.mkdtemp()
+        for name in ("accounts.json", "auth.json"):
+            shutil.copy(os.path.join(SERVER_ENV, name), self.folder)
+        config_file = os.path.join(self.folder, "config.conf")
+        with open(config_file, "w") as f:
+            f.write(
+                "\n".join(
+                    [
+                        f"storage={self.folder}/storage",
+                        f"index={self.folder}/index.json",
+                        f"accounts={self.folder}/accounts.json",
+                        f"authorization_file={self.folder}/auth.json",
+                        f"history_database={self.folder}/changes.db",
+                    ]
+                )
+            )
+        Singleton._instances.clear()
+        config = ConfigFile(config_file)
+        self.fm = file_manager.FileManager(config)
+        Accounts(config)
+        app = Flask(__name__)
+        app.register_blueprint(file_manager.bp)
+        self.client = app.test_client()
+
+        dates = [timestamp(2021, 5, 12, 10), timestamp(2021, 5, 1, 8)]
+        dates += [timestamp(2020, 1, day) for day in range(1, 6)]
+        with self.fm.transaction():
+            for i, date in enumerate(dates, 1):
+                self.fm.add_entry(
+                    {
+                        "id": i,
+                        "date": date,
+                        "path": f"test/{i}.jpg",
+                        "type": "image",
+                        "extension": ".jpg",
+                        "format": "jpeg",
+                        "owner": "test",
+                        "color": "#000000",
+                        "hash": str(i),
+                    }
+                )
+
+    def tearDown(self):
+        Singleton._instances.clear()
+        shutil.rmtree(self.folder)
+
+    def get(self, path: str) -> dict:
+        response = self.client.get("/api/files" + path, headers={"Token": TEST_TOKEN})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_jump_to_period(self):
+        periods = self.get("/timeline/month?samples=1")["periods"]
+        self.assertEqual([p["period"] for p in periods], ["2021-05", "2020-01"])
+        for period in periods:
+            files = self.get(f"/file-list/before/{period['before']}/3")["files"]
+            # The page starts with the newest file of the period
+            self.assertEqual(str(files[0]["id"]), period["samples"][0])
+            self.assertEqual(files[0]["date"], period["newest"])
+            self.assertEqual(len(files), 3)
+
+    def test_offset(self):
+        response = self.client.get(
+            "/api/files/timeline/day?offset=900", headers={"Token": TEST_TOKEN}
+        )
+        self.assertEqual(response.status_code, 400)
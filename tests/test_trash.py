@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from server.utils import Singleton
+
+SERVER_ENV = os.path.join(os.path.dirname(__file__), "server_env")
+TEST_TOKEN = "f4bcfedf-297b-4a3d-a858-31845bb86307"
+
+
+class TestTrash(unittest.TestCase):
+    """Files go to the trash and come back as they were, or are purged"""
+
+    def setUp(self):
+        from flask import Flask
+
+        from server import file_manager, trash
+        from server.accounts import Accounts
+        from server.configuration import ConfigFile
+
+        self.folder = tempfile.mkdtemp()
+        for name in ("accounts.json", "auth.json"):
+            shutil.copy(os.path.join(SERVER_ENV, name), self.folder)
+        for name in ("storage/test", "thumbnails", "trash"):
+            os.makedirs(os.path.join(self.folder, name))
+        config_file = os.path.join(self.folder, "config.conf")
+        with open(config_file, "w") as f:
+            f.write(
+                "\n".join(
+                    [
+                        f"storage={self.folder}/storage",
+                        f"thumbnails_folder={self.folder}/thumbnails",
+                        f"trash_folder={self.folder}/trash",
+                        f"index={self.folder}/index.json",
+                        f"accounts={self.folder}/accounts.json",
+                        f"authorization_file={self.folder}/auth.json",
+                        f"history_database={self.folder}/changes.db",
+                        f"job_folder={self.folder}/jobs",
+                        f"trash_database={self.folder}/trash.db",
+                        f"album_database={self.folder}/albums.db",
+                        "job_batch_size=1",
+                    ]
+                )
+            )
+        Singleton._instances.clear()
+        config = ConfigFile(config_file)
+        self.fm = file_manager.FileManager(config)
+        Accounts(config)
+        self.store = trash.TrashStore()
+        app = Flask(__name__)
+        app.register_blueprint(file_manager.bp)
+        app.register_blueprint(trash.bp)
+        self.client = app.test_client()
+
+        with self.fm.transaction():
+            for i in range(1, 4):
+                self.add_file(str(i), f"test/{i}.jpg")
+
+    def tearDown(self):
+        self.store.db.close()
+        Singleton._instances.clear()
+        shutil.rmtree(self.folder)
+
+    def add_file(self, f_id: str, path: str):
+        with open(self.fm.get_file_path(path), "w") as f:
+            f.write(f_id)
+        self.fm.add_entry(
+            {
+                "id": f_id,
+                "date": 1600000000 + int(f_id),
+                "path": path,
+                "type": "image",
+                "extension": ".jpg",
+                "format": "jpeg",
+                "owner": "test",
+                "color": "#000000",
+                "hash": f_id,
+                "rights": [],
+                "mtime": os.stat(self.fm.get_file_path(path)).st_mtime_ns,
+            }
+        )
+
+    def post(self, path: str, data) -> tuple:
+        response = self.client.post(
+            "/api/trash" + path, json=data, headers={"Token": TEST_TOKEN}
+        )
+        return response.status_code, response.get_json()
+
+    def trash(self, files: list) -> dict:
+        response = self.client.post(
+            "/api/files/delete", json={"files": files}, headers={"Token": TEST_TOKEN}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()["trash_ids"]
+
+    def test_trash_restore(self):
+        thumbnail = os.path.join(self.folder, "thumbnails", "1_64x64.png")
+        open(thumbnail, "w").close()
+        trash_ids = self.trash(["1", "2"])
+        self.assertNotIn("1", self.fm.index)
+        self.assertFalse(os.path.exists(self.fm.get_file_path("test/1.jpg")))
+        self.assertFalse(os.path.exists(thumbnail))
+        self.assertEqual(len(self.store.list("test")), 2)
+
+        # The path and the id of the first file are taken meanwhile
+        with self.fm.transaction():
+            self.add_file("1", "test/1.jpg")
+        status, data = self.post("/restore", {"ids": list(trash_ids.values())})
+        self.assertEqual(status, 200)
+        self.assertEqual(data["restored"][str(trash_ids["2"])], "2")
+        f_id = data["restored"][str(trash_ids["1"])]
+        self.assertNotEqual(f_id, "1")
+        self.assertEqual(self.fm.index[f_id]["path"], "test/1_1.jpg")
+        with open(self.fm.get_path_id(f_id)) as f:
+            self.assertEqual(f.read(), "1")
+        self.assertEqual(self.store.list("test"), [])
+
+    def test_restore_failure(self):
+        trash_ids = list(self.trash(["1", "2"]).values())
+
+        # A file that cannot be moved back stays in the trash
+        with mock.patch("os.utime", side_effect=[None, OSError("busy")]):
+            status, data = self.post("/restore", {"ids": trash_ids})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data["restored"]), 1)
+        self.assertEqual(len(data["failed"]), 1)
+        self.assertEqual(len(self.store.list("test")), 1)
+
+        # Nothing is restored if the index cannot be saved
+        trash_ids = list(self.trash(["3"]).values()) + data["failed"]
+        index = dict(self.fm.index)
+        with mock.patch.object(self.fm, "save_index", side_effect=OSError("full")):
+            status, _ = self.post("/restore", {"ids": trash_ids})
+        self.assertEqual(status, 500)
+        self.assertEqual(self.fm.index.keys(), index.keys())
+        self.assertEqual(len(self.store.list("test")), 2)
+        for item in self.store.list("test"):
+            path = os.path.join(self.store.trash_folder, item["path"])
+            self.assertTrue(os.path.exists(path))
+
+    def test_purge(self):
+        from server.jobs import Job
+        from server.trash import purge_trash_job
+
+        self.trash(["1", "2"])
+        with self.store.db:
+            self.store.db.execute("UPDATE trash SET deleted = deleted - 100")
+        items = self.store.list("test")
+        self.trash(["3"])
+
+        # The recent item is kept
+        job = Job.new("purge-trash", {"older_than": 10}, "<trash>")
+        result = purge_trash_job(job)
+        self.assertEqual(result["purged"], 2)
+        self.assertEqual(result["freed"], 2)
+        self.assertEqual(job.checkpoint["purged"], 2)
+        self.assertEqual([item["file"] for item in self.store.list(None)], ["3"])
+        for item in items:
+            path = os.path.join(self.store.trash_folder, item["path"])
+            self.assertFalse(os.path.exists(path))
+
+        job = Job.new("purge-trash", {"user": "test", "older_than": 0}, "test")
+        self.assertEqual(purge_trash_job(job)["purged"], 1)
+        self.assertEqual(self.store.list(None), [])
+
+    def test_expired(self):
+        self.trash(["1", "2"])
+        now = time.time() + 1
+        self.assertEqual(len(self.store.expired(now, 1)), 1)
+        self.assertEqual(len(self.store.expired(now, 10, "test")), 2)
+        self.assertEqual(self.store.expired(now, 10, "adminact"), [])
+        self.assertEqual(self.store.expired(now - 100, 10), [])
+
+    def test_invalid_body(self):
+        for path in ("/restore", "/purge"):
+            for data in ([1], {"ids": "1"}, {"ids": [None]}):
+                status, _ = self.post(path, data)
+                self.assertEqual(status, 400, (path, data))